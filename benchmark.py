@@ -0,0 +1,526 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+import types
+import face_cropper
+import numpy as np
+import cv2
+
+try:
+    import resource  # Not available on Windows
+except ImportError:
+    resource = None
+
+
+_DEMO_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'demo')
+
+# Run in a new interpreter by run_startup_benchmarks(), so that nothing is imported or initialised beforehand
+_STARTUP_SCRIPT = """
+import json, sys, time
+start_time = time.perf_counter()
+import face_cropper
+import_time = time.perf_counter()
+image = face_cropper._read_image(sys.argv[1])
+read_time = time.perf_counter()
+cropper = face_cropper.FaceCropper()
+construction_time = time.perf_counter()
+if sys.argv[2] != 'lazy': cropper.warm_up(None if sys.argv[2] == 'warm_up' else image)
+warm_up_time = time.perf_counter()
+cropper.get_faces(image)
+first_call_time = time.perf_counter()
+cropper.get_faces(image)
+second_call_time = time.perf_counter()
+print(json.dumps({
+    'import_ms': (import_time - start_time) * 1000,
+    'construction_ms': (construction_time - read_time) * 1000,
+    'warm_up_ms': (warm_up_time - construction_time) * 1000,
+    'first_call_ms': (first_call_time - warm_up_time) * 1000,
+    'second_call_ms': (second_call_time - first_call_time) * 1000
+}))
+"""
+
+
+class Landmark:
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+
+def _get_synthetic_landmarks(mesh=face_cropper._FACE_MESH):
+    """
+    Generate a planar (non-folding) layout of the face mesh by pinning its outline to an ellipse and placing every other landmark at
+    the average of its neighbours (Tutte embedding). Gives a realistic triangle layout without needing the FaceMesh network.
+    :param mesh: An iterable of (v1, v2, v3) vertex tuples specifying a mesh without holes.
+    :return: An (n, 3) float32 numpy array containing the normalised coordinates of the landmarks (with z set to 0).
+    """
+
+    outline = face_cropper._get_mesh_outline(mesh)
+    landmark_count = max(max(triangle) for triangle in mesh) + 1
+
+    laplacian = np.zeros((landmark_count, landmark_count))
+    for triangle in mesh:
+        for v1, v2 in ((triangle[0], triangle[1]), (triangle[1], triangle[2]), (triangle[2], triangle[0])):
+            laplacian[v1, v2] = laplacian[v2, v1] = -1
+    np.fill_diagonal(laplacian, 0)
+    np.fill_diagonal(laplacian, -np.sum(laplacian, axis=1))
+
+    coordinates = np.zeros((landmark_count, 2))
+    angles = np.linspace(0, 2 * np.pi, len(outline), endpoint=False)
+    coordinates[outline] = np.column_stack((0.5 + 0.3 * np.cos(angles), 0.5 + 0.4 * np.sin(angles)))
+
+    laplacian[outline] = 0
+    laplacian[outline, outline] = 1
+    coordinates = np.linalg.solve(laplacian, coordinates)
+
+    return np.column_stack((coordinates, np.zeros(landmark_count))).astype(np.float32)
+
+
+def _get_segmented_face_image_per_triangle(image, mesh, landmarks):
+    """
+    The original implementation of face_cropper._get_segmented_face_image(), kept as a baseline for comparison.
+    """
+
+    landmarks = [Landmark(x, y) for x, y, _ in landmarks.tolist()]
+
+    mask = np.zeros(np.shape(image), dtype=np.uint8)
+    for triangle in mesh:
+        mask_vertices = np.ndarray.astype(np.rint(np.array([
+            [landmarks[triangle[0]].x * image.shape[1], landmarks[triangle[0]].y * image.shape[0]],
+            [landmarks[triangle[1]].x * image.shape[1], landmarks[triangle[1]].y * image.shape[0]],
+            [landmarks[triangle[2]].x * image.shape[1], landmarks[triangle[2]].y * image.shape[0]]
+        ])), int)
+        cv2.fillPoly(mask, [mask_vertices], (255, 255, 255))
+    return cv2.bitwise_and(image, mask)
+
+
+def _get_peak_rss():
+    """
+    Return the peak resident set size of this process so far (in MiB), or None if it can't be measured on this platform.
+    """
+
+    if resource is None: return None
+
+    # ru_maxrss is in bytes on macOS and in KiB on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss / (1024 * 1024) if sys.platform == 'darwin' else peak_rss / 1024
+
+
+def _measure(function, number, warm_up=1):
+    """
+    Call the specified function repeatedly and return statistics of its latency.
+    :param function: The function to call (without arguments).
+    :param number: The number of timed calls.
+    :param warm_up: The number of untimed calls made first (e.g. to initialise lazily created state). Defaults to 1.
+    :return: A dict containing the median and 95th percentile latency (in milliseconds), the number of calls per second, and the peak RSS
+    of the process so far (in MiB).
+    """
+
+    for _ in range(warm_up): function()
+
+    latencies = []
+    for _ in range(number):
+        start_time = time.perf_counter()
+        function()
+        latencies.append(time.perf_counter() - start_time)
+
+    return {
+        'median_ms': float(np.median(latencies)) * 1000,
+        'p95_ms': float(np.percentile(latencies, 95)) * 1000,
+        'per_second': number / sum(latencies),
+        'peak_rss_mib': _get_peak_rss()
+    }
+
+
+def run_micro_benchmarks(number=50, crop_sizes=(128, 256, 512, 1024)):
+    """
+    Time each helper of the pipeline in isolation on synthetic face crops of the specified sizes.
+    :param number: The number of timed calls of each helper. Defaults to 50.
+    :param crop_sizes: The side lengths (in pixels) of the square face crops. Defaults to (128, 256, 512, 1024).
+    :return: A list of dicts, each containing the name of the benchmark, the crop size, and the statistics returned by _measure().
+    """
+
+    landmarks = _get_synthetic_landmarks()
+    random_generator = np.random.default_rng(0)
+    results = []
+
+    for crop_size in crop_sizes:
+        image = random_generator.integers(0, 256, (crop_size, crop_size, 3), dtype=np.uint8)
+        source_image = random_generator.integers(0, 256, (crop_size * 3, crop_size * 3, 3), dtype=np.uint8)
+        face_box = types.SimpleNamespace(xmin=0.4, ymin=0.4, width=0.2, height=0.2)  # Stands in for a RelativeBoundingBox
+        rotation_matrix = cv2.getRotationMatrix2D((crop_size / 2, crop_size / 2), 30, 1)
+        corrected_landmarks = face_cropper._rotate_landmarks(landmarks, rotation_matrix, image.shape)
+
+        benchmarks = {
+            '_get_segmented_face_image[per_triangle]': lambda: _get_segmented_face_image_per_triangle(image, face_cropper._FACE_MESH, landmarks),
+            '_get_segmented_face_image[mesh]': lambda: face_cropper._get_segmented_face_image(image, face_cropper._FACE_MESH_TRIANGLES, landmarks),
+            '_get_segmented_face_image[outline]': lambda: face_cropper._get_segmented_face_image(image, face_cropper._FACE_OUTLINE, landmarks),
+            '_rotate_landmarks': lambda: face_cropper._rotate_landmarks(landmarks, rotation_matrix, image.shape),
+            '_get_roll_corrected_image_and_landmarks': lambda: face_cropper._get_roll_corrected_image_and_landmarks(image, landmarks),
+            '_get_roll_corrected_face_crop': lambda: face_cropper._get_roll_corrected_face_crop(image, landmarks),
+            '_get_aligned_face_image': lambda: face_cropper._get_aligned_face_image(image, landmarks, (112, 112)),
+            '_get_inflated_face_image': lambda: face_cropper._get_inflated_face_image(source_image, face_box, 1),
+            '_crop_within_bounds': lambda: face_cropper._crop_within_bounds(image, *face_cropper._get_landmarks_bounds(corrected_landmarks))
+        }
+
+        for name, function in benchmarks.items():
+            results.append(dict(benchmark=name, crop_size=crop_size, **_measure(function, number)))
+
+    return results
+
+
+def _get_mosaic_image(image, faces_per_side, max_side):
+    """
+    Tile an image in a square grid and resize the grid so that its longest side has the specified length.
+    :param image: The image to be tiled.
+    :param faces_per_side: The number of tiles along each side of the grid.
+    :param max_side: The length (in pixels) of the longest side of the resized grid.
+    :return: The resized grid image.
+    """
+
+    mosaic_image = np.tile(image, (faces_per_side, faces_per_side, 1))
+    scale = max_side / max(mosaic_image.shape[0], mosaic_image.shape[1])
+
+    return cv2.resize(mosaic_image, (round(mosaic_image.shape[1] * scale), round(mosaic_image.shape[0] * scale)), interpolation=cv2.INTER_AREA)
+
+
+def _read_demo_images(video_frame_count):
+    """
+    Read the demo image, and the specified number of frames of the demo video (as RGB images).
+    :return: A (demo_image, demo_video_frames) tuple.
+    """
+
+    demo_image = cv2.cvtColor(cv2.imread(os.path.join(_DEMO_DIRECTORY, 'demo_1.jpg')), cv2.COLOR_BGR2RGB)
+
+    demo_video_frames = []
+    video = cv2.VideoCapture(os.path.join(_DEMO_DIRECTORY, 'demo_1.mp4'))
+    while len(demo_video_frames) < video_frame_count:
+        read_successful, image_bgr = video.read()
+        if not read_successful: break
+        demo_video_frames.append(cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB))
+    video.release()
+
+    return demo_image, demo_video_frames
+
+
+def run_macro_benchmarks(number=10, max_sides=(640, 1280, 2560), faces_per_side=(1, 2, 3), face_cropper_kwargs=None):
+    """
+    Time FaceCropper.get_faces() end to end, for each (remove_background, correct_roll) combination, on the demo image, the frames of the demo
+    video, and mosaics of the face in the demo image with different resolutions and numbers of faces.
+    :param number: The number of timed calls for each image (or the number of demo video frames). Defaults to 10.
+    :param max_sides: The lengths (in pixels) of the longest side of the mosaics. Defaults to (640, 1280, 2560).
+    :param faces_per_side: The numbers of faces along each side of the mosaics. Defaults to (1, 2, 3).
+    :param face_cropper_kwargs: Keyword arguments to pass to the FaceCropper constructor. Defaults to None.
+    :return: A list of dicts, each containing a description of the input, the flags, the number of faces cropped per image, and the
+    statistics returned by _measure() (where per_second is the number of images per second).
+    """
+
+    cropper = face_cropper.FaceCropper(**(face_cropper_kwargs or {}))
+    demo_image, demo_video_frames = _read_demo_images(number)
+
+    # The face in the demo image is small, so the mosaics tile the area around it rather than the whole image
+    face_box, _, _ = cropper._detect_faces(demo_image)[0]
+    face_tile = face_cropper._get_inflated_face_image(demo_image, face_box, 2)
+
+    inputs = [('demo_1.jpg', [demo_image]), ('demo_1.mp4', demo_video_frames)]
+    for max_side in max_sides:
+        for faces in faces_per_side:
+            inputs.append(('mosaic_{0}px_{1}x{1}'.format(max_side, faces), [_get_mosaic_image(face_tile, faces, max_side)]))
+
+    results = []
+    for name, images in inputs:
+        for remove_background in [False, True]:
+            for correct_roll in [False, True]:
+                image_iterator = iter(images * number)
+                results.append(dict(
+                    input=name,
+                    resolution=list(images[0].shape[:2]),
+                    remove_background=remove_background,
+                    correct_roll=correct_roll,
+                    faces=len(cropper.get_faces(images[0], remove_background, correct_roll)),
+                    **_measure(lambda: cropper.get_faces(next(image_iterator), remove_background, correct_roll), len(images) if len(images) > 1 else number, 0)
+                ))
+
+    return results
+
+
+def _get_video_face_crops(count, face_cropper_object):
+    """
+    Get the inflated face crops of the face in evenly spaced frames of the demo video, which have a variety of poses.
+    :param count: The number of face crops.
+    :param face_cropper_object: The FaceCropper object detecting the faces.
+    :return: A list of numpy.ndarray RGB images containing inflated face crops.
+    """
+
+    video = cv2.VideoCapture(os.path.join(_DEMO_DIRECTORY, 'demo_1.mp4'))
+    frame_count = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+    face_crops = []
+
+    for frame_index in np.linspace(0, frame_count - 1, 4 * count).astype(int):
+        video.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
+        read_successful, image_bgr = video.read()
+        if not read_successful: continue
+        face_crops.extend(face_cropper_object._get_inflated_face_images(cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB))[:1])
+        if len(face_crops) == count: break
+
+    video.release()
+    return face_crops
+
+
+def _get_inter_ocular_distance(landmark_coordinates):
+    """
+    :param landmark_coordinates: (n, 2) array containing the pixel coordinates of the landmarks of a face.
+    :return: The distance (in pixels) between the centres of the eyes of the face.
+    """
+
+    return np.linalg.norm(np.mean(landmark_coordinates[face_cropper._LEFT_EYE_LANDMARK_INDICES], axis=0) -
+                          np.mean(landmark_coordinates[face_cropper._RIGHT_EYE_LANDMARK_INDICES], axis=0))
+
+
+def run_landmark_batching_benchmarks(number=10, batch_sizes=(4, 9, 16), tile_sizes=(128, 192, 256)):
+    """
+    Compare detecting the landmarks of several faces in one mosaic (see FaceCropper's landmark_batch_size) with detecting them one face at a
+    time, on the inflated face crops of frames of the demo video.
+    :param number: The number of timed runs of each configuration. Defaults to 10.
+    :param batch_sizes: The numbers of faces in a mosaic. Defaults to (4, 9, 16).
+    :param tile_sizes: The side lengths (in pixels) of the tiles of a mosaic. Defaults to (128, 192, 256).
+    :return: A list of dicts, each containing the batch size, tile size, the statistics returned by _measure() for the per-face path and the
+    mosaic (without retrying missed faces), the speedup, the fraction of faces found in the mosaic (recall), and the mean and maximum error
+    of the landmarks found in the mosaic relative to the per-face landmarks, normalised by the inter-ocular distance (NME, as in landmark
+    detection literature; e.g. 0.05 is an error of 5% of the distance between the eyes)
+    """
+
+    per_face_cropper = face_cropper.FaceCropper()
+    face_crops = _get_video_face_crops(max(batch_sizes), per_face_cropper)
+    reference_landmarks = [per_face_cropper._detect_landmarks(face_crop) for face_crop in face_crops]
+
+    results = []
+    for batch_size in batch_sizes:
+        batch = [face_crop for face_crop, landmarks in zip(face_crops, reference_landmarks) if landmarks is not None][:batch_size]
+        batch_reference_landmarks = [landmarks for landmarks in reference_landmarks if landmarks is not None][:batch_size]
+        per_face_result = _measure(lambda: [per_face_cropper._detect_landmarks(face_crop) for face_crop in batch], number)
+
+        for tile_size in tile_sizes:
+            mosaic_cropper = face_cropper.FaceCropper(landmark_batch_size=batch_size, landmark_tile_size=tile_size)
+            detector = mosaic_cropper.mosaic_landmark_detector
+            mosaic_result = _measure(lambda: face_cropper._detect_landmarks_in_mosaic(detector, batch, tile_size), number)
+
+            errors = []
+            for face_crop, landmarks, mosaic_landmarks in zip(batch, batch_reference_landmarks,
+                                                              face_cropper._detect_landmarks_in_mosaic(detector, batch, tile_size)):
+                if mosaic_landmarks is None: continue
+                coordinates = face_cropper._get_landmark_pixel_coordinates(landmarks, face_crop.shape)
+                mosaic_coordinates = face_cropper._get_landmark_pixel_coordinates(mosaic_landmarks, face_crop.shape)
+                errors.append(np.mean(np.linalg.norm(mosaic_coordinates - coordinates, axis=1)) / _get_inter_ocular_distance(coordinates))
+
+            results.append({
+                'batch_size': len(batch),
+                'tile_size': tile_size,
+                'per_face': per_face_result,
+                'mosaic': mosaic_result,
+                'speedup': per_face_result['median_ms'] / mosaic_result['median_ms'],
+                'recall': len(errors) / len(batch),
+                'mean_nme': float(np.mean(errors)) if errors else None,
+                'max_nme': float(np.max(errors)) if errors else None
+            })
+            mosaic_cropper.close()
+
+    return results
+
+
+def _get_crop_allocations(crop_faces, frames_face_records):
+    """
+    Measure the memory allocated by numpy (and OpenCV, whose output arrays are numpy arrays) while cropping the faces of each frame, with tracemalloc.
+    :param crop_faces: A function taking the FaceRecord objects of a frame and cropping their faces.
+    :param frames_face_records: A list containing the FaceRecord objects of each frame.
+    :return: A dict containing the mean number of kibibytes per frame of the peak memory allocated while cropping each face (summed over the
+    faces of the frame), and of the memory kept afterwards (i.e. the returned face images and any buffers grown for them).
+    """
+
+    peak_bytes = retained_bytes = 0
+    tracemalloc.start()
+    try:
+        for face_records in frames_face_records:
+            for face_record in face_records:
+                tracemalloc.reset_peak()
+                start_bytes = tracemalloc.get_traced_memory()[0]
+                face_image = crop_faces([face_record])
+                end_bytes, face_peak_bytes = tracemalloc.get_traced_memory()
+                peak_bytes += face_peak_bytes - start_bytes
+                retained_bytes += end_bytes - start_bytes
+                del face_image
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'peak_kib_per_frame': peak_bytes / len(frames_face_records) / 1024,
+        'retained_kib_per_frame': retained_bytes / len(frames_face_records) / 1024
+    }
+
+
+def run_allocation_benchmarks(number=10, upscale=4, face_cropper_kwargs=({}, {'roll_correction_mode': face_cropper.FaceCropper.IMAGE_ROLL_CORRECTION},
+                                                                         {'output_size': (224, 224)})):
+    """
+    Compare the memory allocated while cropping the faces in frames of the demo video with FaceCropper's reuse_buffers disabled, enabled, and
+    enabled with preallocated out images (see FaceCropper.get_faces()). Only the cropping is measured, as the memory allocated by the
+    mediapipe graphs is not visible to tracemalloc (the faces and landmarks are detected beforehand).
+    :param number: The number of demo video frames. Defaults to 10.
+    :param upscale: The factor the frames are upscaled by, as the face in the demo video is small. Defaults to 4.
+    :param face_cropper_kwargs: The keyword arguments of each FaceCropper configuration to compare. Defaults to the default configuration,
+    FaceCropper.IMAGE_ROLL_CORRECTION and a fixed output_size.
+    :return: A list of dicts, each containing the configuration, the flags, the variant ('allocate', 'reuse_buffers' or 'reuse_buffers_and_out'),
+    the allocations returned by _get_crop_allocations(), and the statistics returned by _measure() (where per_second is the number of frames per second).
+    """
+
+    _, demo_video_frames = _read_demo_images(number)
+    detection_cropper = face_cropper.FaceCropper()
+    frames_face_records = [detection_cropper.get_face_records(cv2.resize(image, None, fx=upscale, fy=upscale)) for image in demo_video_frames]
+    detection_cropper.close()
+
+    max_face_size = max(max(face_record.inflated_face_image.shape[:2]) for face_records in frames_face_records for face_record in face_records)
+    out = np.empty((max(len(face_records) for face_records in frames_face_records), max_face_size, max_face_size, 3), dtype=np.uint8)
+
+    results = []
+    for kwargs in face_cropper_kwargs:
+        for remove_background in [False, True]:
+            for correct_roll in [False, True]:
+                for variant in ['allocate', 'reuse_buffers', 'reuse_buffers_and_out']:
+                    cropper = face_cropper.FaceCropper(reuse_buffers=variant != 'allocate', **kwargs)
+                    variant_out = out if variant == 'reuse_buffers_and_out' else None
+
+                    def crop_faces(face_records):
+                        return [cropper._get_face_image(face_record.inflated_face_image, remove_background, correct_roll, face_record.landmarks,
+                                                        None if variant_out is None else variant_out[face_index])
+                                for face_index, face_record in enumerate(face_records)]
+
+                    # The buffers are grown to the size of the largest face first, as in a long-running process
+                    for face_records in frames_face_records: crop_faces(face_records)
+                    frame_iterator = iter(frames_face_records)
+                    results.append(dict(
+                        face_cropper_kwargs={key: list(value) if isinstance(value, tuple) else value for key, value in kwargs.items()},
+                        remove_background=remove_background,
+                        correct_roll=correct_roll,
+                        variant=variant,
+                        **_get_crop_allocations(crop_faces, frames_face_records),
+                        **_measure(lambda: crop_faces(next(frame_iterator)), len(frames_face_records), 0)
+                    ))
+                    cropper.close()
+
+    return results
+
+
+def run_startup_benchmarks(number=5, variants=('lazy', 'warm_up', 'warm_up_with_image')):
+    """
+    Time the cold start of the pipeline in new Python processes on the demo image: importing face_cropper, constructing a FaceCropper,
+    FaceCropper.warm_up(), and the first and second FaceCropper.get_faces() calls.
+    :param number: The number of processes started for each variant. Defaults to 5.
+    :param variants: 'lazy' to call get_faces() straight after construction (so the first call builds the graphs and imports mediapipe),
+    'warm_up' to call warm_up() first, and 'warm_up_with_image' to call warm_up() with the demo image first. Defaults to all three.
+    :return: A list of dicts, each containing the variant and the median of each duration (in milliseconds) over the processes.
+    """
+
+    demo_image_path = os.path.join(_DEMO_DIRECTORY, 'demo_1.jpg')
+    module_directory = os.path.dirname(os.path.abspath(face_cropper.__file__))
+
+    results = []
+    for variant in variants:
+        runs = []
+        for _ in range(number):
+            output = subprocess.run([sys.executable, '-c', _STARTUP_SCRIPT, demo_image_path, variant], cwd=module_directory,
+                                    stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True, text=True).stdout
+            runs.append(json.loads(output.strip().splitlines()[-1]))
+
+        results.append(dict(variant=variant, **{key: float(np.median([run[key] for run in runs])) for key in runs[0]}))
+
+    return results
+
+
+def run_landmark_resolution_benchmarks(number=10, crop_sides=(512, 1024, 2048, 4096), max_sides=(192, 256, 384, 512), face_count=4):
+    """
+    Compare detecting the landmarks of large inflated face crops at full resolution with downscaling them first (see FaceCropper's
+    landmark_max_side), on the inflated face crops of frames of the demo video upscaled to different sizes (e.g. like close-up photos).
+    :param number: The number of timed runs of each configuration. Defaults to 10.
+    :param crop_sides: The lengths (in pixels) the longest side of the face crops is upscaled to. Defaults to (512, 1024, 2048, 4096).
+    :param max_sides: The landmark_max_side values compared with full resolution. Defaults to (192, 256, 384, 512).
+    :param face_count: The number of face crops detected in each timed run. Defaults to 4.
+    :return: A list of dicts, each containing the crop side, the landmark_max_side, the statistics returned by _measure() for full resolution
+    and for landmark_max_side, the speedup, the fraction of faces with landmarks at full resolution that still have landmarks (recall), and
+    the mean and maximum NME of the landmarks relative to those at full resolution (see run_landmark_batching_benchmarks())
+    """
+
+    full_resolution_cropper = face_cropper.FaceCropper()
+    video_face_crops = _get_video_face_crops(face_count, full_resolution_cropper)
+
+    results = []
+    for crop_side in crop_sides:
+        face_crops = [cv2.resize(face_crop, (round(face_crop.shape[1] * crop_side / max(face_crop.shape[:2])),
+                                             round(face_crop.shape[0] * crop_side / max(face_crop.shape[:2]))), interpolation=cv2.INTER_CUBIC)
+                      for face_crop in video_face_crops]
+        reference_landmarks = [full_resolution_cropper._detect_landmarks(face_crop) for face_crop in face_crops]
+        full_resolution_result = _measure(lambda: [full_resolution_cropper._detect_landmarks(face_crop) for face_crop in face_crops], number)
+
+        for max_side in max_sides:
+            if max_side >= crop_side: continue
+            downscaling_cropper = face_cropper.FaceCropper(landmark_max_side=max_side)
+            downscaled_result = _measure(lambda: [downscaling_cropper._detect_landmarks(face_crop) for face_crop in face_crops], number)
+
+            errors = []
+            for face_crop, landmarks in zip(face_crops, reference_landmarks):
+                if landmarks is None: continue
+                downscaled_landmarks = downscaling_cropper._detect_landmarks(face_crop)
+                if downscaled_landmarks is None: continue
+                coordinates = face_cropper._get_landmark_pixel_coordinates(landmarks, face_crop.shape)
+                downscaled_coordinates = face_cropper._get_landmark_pixel_coordinates(downscaled_landmarks, face_crop.shape)
+                errors.append(np.mean(np.linalg.norm(downscaled_coordinates - coordinates, axis=1)) / _get_inter_ocular_distance(coordinates))
+
+            reference_count = sum(landmarks is not None for landmarks in reference_landmarks)
+            results.append({
+                'crop_side': crop_side,
+                'landmark_max_side': max_side,
+                'full_resolution': full_resolution_result,
+                'downscaled': downscaled_result,
+                'speedup': full_resolution_result['median_ms'] / downscaled_result['median_ms'],
+                'recall': len(errors) / reference_count if reference_count else None,
+                'mean_nme': float(np.mean(errors)) if errors else None,
+                'max_nme': float(np.max(errors)) if errors else None
+            })
+            downscaling_cropper.close()
+
+    full_resolution_cropper.close()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the face cropping pipeline and print the results as JSON.')
+    parser.add_argument('--micro', action='store_true', help='Only run the benchmarks of the pipeline helpers.')
+    parser.add_argument('--macro', action='store_true', help='Only run the end to end benchmarks of FaceCropper.get_faces().')
+    parser.add_argument('--landmark-batching', action='store_true',
+                        help='Only run the accuracy and speed comparison of batching landmark detection in mosaics against the per-face path.')
+    parser.add_argument('--allocations', action='store_true',
+                        help='Only run the comparison of the memory allocated per frame with and without reusing buffers.')
+    parser.add_argument('--startup', action='store_true',
+                        help='Only run the cold start benchmarks (import, construction, warm-up and first call latency) in new processes.')
+    parser.add_argument('--landmark-resolution', action='store_true',
+                        help='Only run the accuracy and speed comparison of detecting the landmarks of large faces at full and reduced resolution.')
+    parser.add_argument('--number', type=int, default=None, help='The number of timed calls of each benchmark.')
+    parser.add_argument('--output', default=None, help='Write the results to this file instead of printing them.')
+    args = parser.parse_args()
+
+    results = {'python': sys.version.split()[0], 'numpy': np.__version__, 'opencv': cv2.__version__}
+    number_kwargs = {} if args.number is None else {'number': args.number}
+    run_all = not (args.micro or args.macro or args.landmark_batching or args.allocations or args.startup or args.landmark_resolution)
+    if args.micro or run_all: results['micro'] = run_micro_benchmarks(**number_kwargs)
+    if args.macro or run_all: results['macro'] = run_macro_benchmarks(**number_kwargs)
+    if args.landmark_batching or run_all: results['landmark_batching'] = run_landmark_batching_benchmarks(**number_kwargs)
+    if args.allocations or run_all: results['allocations'] = run_allocation_benchmarks(**number_kwargs)
+    if args.startup or run_all: results['startup'] = run_startup_benchmarks(**number_kwargs)
+    if args.landmark_resolution or run_all: results['landmark_resolution'] = run_landmark_resolution_benchmarks(**number_kwargs)
+
+    if args.output is None:
+        print(json.dumps(results, indent=2))
+    else:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
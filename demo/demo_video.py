@@ -1,7 +1,7 @@
 import cv2
 from face_cropper import FaceCropper
 
-face_cropper = FaceCropper()
+face_cropper = FaceCropper(colour_order=FaceCropper.BGR)  # Crop faces straight from (and into) OpenCV's BGR frames
 
 camera = cv2.VideoCapture(0, cv2.CAP_DSHOW)  # Capture video with default camera (Use DSHOW API for reading to avoid SourceReader warning)
 # camera = cv2.VideoCapture('demo_1.mp4')  # Read video from specified path
@@ -10,14 +10,14 @@ while True:
     read_successful, image_bgr = camera.read()
     if not read_successful: raise RuntimeError('Image could not be read!')
 
-    faces_rgb = face_cropper.get_faces_debug(cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB))
+    faces_bgr = face_cropper.get_faces_debug(image_bgr)
 
-    if not faces_rgb:
+    if not faces_bgr:
         print("No faces detected!")
     else:
         cv2.imshow('Image', image_bgr)
-        for face_id, face_rgb in enumerate(faces_rgb):
-            cv2.imshow('Face {0}'.format(face_id), cv2.cvtColor(face_rgb, cv2.COLOR_RGB2BGR))
+        for face_id, face_bgr in enumerate(faces_bgr):
+            cv2.imshow('Face {0}'.format(face_id), face_bgr)
 
     if cv2.pollKey() != -1:  # User pressed key
         camera.release()
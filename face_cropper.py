@@ -1,11 +1,48 @@
-import mediapipe as mp
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import hashlib
+import itertools
+import json
+import multiprocessing
+import multiprocessing.resource_tracker
+import multiprocessing.shared_memory
+import os
+import queue
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+import uuid
 import numpy as np
 import cv2
 
+try:
+    import fcntl  # Not available on Windows
+except ImportError:
+    fcntl = None
+
 
 # Indices for the relevant landmarks
-_LEFT_EYE_LANDMARK_INDICES = [362, 382, 381, 380, 374, 373, 390, 249, 263, 466, 388, 387, 386, 385, 384, 398]
-_RIGHT_EYE_LANDMARK_INDICES = [33, 7, 163, 144, 145, 153, 154, 155, 133, 173, 157, 158, 159, 160, 161, 246]
+_LEFT_EYE_LANDMARK_INDICES = np.array([362, 382, 381, 380, 374, 373, 390, 249, 263, 466, 388, 387, 386, 385, 384, 398])
+_RIGHT_EYE_LANDMARK_INDICES = np.array([33, 7, 163, 144, 145, 153, 154, 155, 133, 173, 157, 158, 159, 160, 161, 246])
+
+# Indices of the nose tip and mouth corner (left and right from the perspective of the image) landmarks
+_NOSE_TIP_LANDMARK_INDEX = 1
+_MOUTH_CORNER_LANDMARK_INDICES = np.array([61, 291])
+
+# Indices of the landmarks at the edges of the face at eye level (left and right from the perspective of the image), and at the top of the
+# forehead and the bottom of the chin, used to estimate the yaw and pitch of faces
+_FACE_EDGE_LANDMARK_INDICES = np.array([234, 454])
+_FOREHEAD_AND_CHIN_LANDMARK_INDICES = np.array([10, 152])
+
+# Canonical [x, y] pixel coordinates of the eye centres, nose tip and mouth corners (each pair ordered left to right from the perspective
+# of the image) in a 112x112 aligned face image, as used by common face recognition models (e.g. ArcFace)
+_FIVE_POINT_TEMPLATE = np.array([[38.2946, 51.6963], [73.5318, 51.5014], [56.0252, 71.7366], [41.5493, 92.3655], [70.7299, 92.2041]])
+_FIVE_POINT_TEMPLATE_SIZE = (112, 112)
 
 # (v1, v2, v3) vertex tuples specifying a mesh (in terms of landmark indices) spanning the full face
 # (extracted from mediapipe\modules\face_geometry\data\canonical_face_model.obj).
@@ -283,6 +320,43 @@ _FACE_MESH = frozenset([
 ])
 
 
+def _get_mesh_outline(mesh):
+    """
+    Calculate and return the outline of a mesh, i.e. the ordered loop of vertices on the edges that belong to only one triangle.
+    :param mesh: An iterable of (v1, v2, v3) vertex tuples specifying a mesh without holes.
+    :return: A list of vertices ordered along the outline of the mesh.
+    """
+
+    edge_counts = {}
+    for triangle in mesh:
+        for edge in ((triangle[0], triangle[1]), (triangle[1], triangle[2]), (triangle[2], triangle[0])):
+            edge = frozenset(edge)
+            edge_counts[edge] = edge_counts.get(edge, 0) + 1
+
+    neighbours = {}
+    for edge, count in edge_counts.items():
+        if count == 1:
+            v1, v2 = edge
+            neighbours.setdefault(v1, []).append(v2)
+            neighbours.setdefault(v2, []).append(v1)
+
+    outline = [min(neighbours)]
+    previous_vertex = None
+    while True:
+        next_vertex = neighbours[outline[-1]][0] if neighbours[outline[-1]][0] != previous_vertex else neighbours[outline[-1]][1]
+        if next_vertex == outline[0]: return outline
+        previous_vertex = outline[-1]
+        outline.append(next_vertex)
+
+
+# _FACE_MESH as an (n, 3) integer array, so that the vertices of all triangles can be looked up with a single indexing operation
+_FACE_MESH_TRIANGLES = np.array(sorted(_FACE_MESH), dtype=np.int32)
+
+# (1, n) integer array specifying a single polygon (in terms of landmark indices) along the outline of _FACE_MESH. Much faster to
+# rasterise than _FACE_MESH, but does not include parts of the face that fold outside the outline (e.g. the nose under high yaw)
+_FACE_OUTLINE = np.array([_get_mesh_outline(_FACE_MESH)], dtype=np.int32)
+
+
 def _get_bounding_box_inflation_factor(eye_coordinates, amplification=2, base_inflation=1):
     """
     Calculate and return the factor at which the perimeter of the bounding box of a face should be inflated by. This is calculated
@@ -309,54 +383,156 @@ def _get_inflated_face_image(image, face_box, inflation):
     :return: A sub-image containing only the face.
     """
 
+    return _crop_within_bounds(image, *_get_inflated_face_bounds(face_box, inflation, image.shape))
+
+
+def _get_inflated_face_bounds(face_box, inflation, image_size):
+    """
+    Calculate and return the pixel boundaries of a face bounding box, with its perimeter inflated around the center using the provided inflation factor.
+    :param face_box: The bounding box of the detected face. Must be a mediapipe.framework.formats.location_data_pb2.RelativeBoundingBox object.
+    :param inflation: The factor by which the bounding box of a face should be inflated. E.g. 0.5 will inflate the box's perimeter by 50% around the centre.
+    :param image_size: (height, width) tuple containing the dimensions of the image containing the face.
+    :return: (top, bottom, left, right) tuple containing the inclusive (and unclipped) boundaries of the inflated box.
+    """
+
     width_inflation, height_inflation = face_box.width * inflation, face_box.height * inflation
 
-    return _crop_within_bounds(
-        image,
-        round((face_box.ymin - height_inflation / 2) * image.shape[0]),                    # top
-        round((face_box.ymin + face_box.height + height_inflation / 2) * image.shape[0]),  # bottom
-        round((face_box.xmin - width_inflation / 2) * image.shape[1]),                     # left
-        round((face_box.xmin + face_box.width + width_inflation / 2) * image.shape[1])     # right
+    return (
+        round((face_box.ymin - height_inflation / 2) * image_size[0]),                    # top
+        round((face_box.ymin + face_box.height + height_inflation / 2) * image_size[0]),  # bottom
+        round((face_box.xmin - width_inflation / 2) * image_size[1]),                     # left
+        round((face_box.xmin + face_box.width + width_inflation / 2) * image_size[1])     # right
     )
 
 
-def _get_segmented_face_image(image, mesh, landmarks):
+def _get_inflated_bounds(bounds, inflation):
+    """
+    Inflate the perimeter of a rectangle around its centre.
+    :param bounds: (top, bottom, left, right) tuple containing the inclusive pixel boundaries of the rectangle.
+    :param inflation: The factor by which the rectangle should be inflated. E.g. 0.5 will inflate the rectangle's perimeter by 50% around the centre.
+    :return: (top, bottom, left, right) tuple containing the inclusive (and unclipped) boundaries of the inflated rectangle.
+    """
+
+    height_inflation, width_inflation = (bounds[1] - bounds[0]) * inflation / 2, (bounds[3] - bounds[2]) * inflation / 2
+
+    return round(bounds[0] - height_inflation), round(bounds[1] + height_inflation), round(bounds[2] - width_inflation), round(bounds[3] + width_inflation)
+
+
+def _get_bounds_iou(bounds_1, bounds_2):
+    """
+    Calculate and return the intersection over union of two rectangles.
+    :param bounds_1: (top, bottom, left, right) tuple containing the inclusive boundaries of the first rectangle.
+    :param bounds_2: (top, bottom, left, right) tuple containing the inclusive boundaries of the second rectangle.
+    :return: The area of the intersection of the rectangles divided by the area of their union, between 0 and 1.
+    """
+
+    intersection_height = min(bounds_1[1], bounds_2[1]) - max(bounds_1[0], bounds_2[0]) + 1
+    intersection_width = min(bounds_1[3], bounds_2[3]) - max(bounds_1[2], bounds_2[2]) + 1
+    if intersection_height <= 0 or intersection_width <= 0: return 0
+
+    intersection_area = intersection_height * intersection_width
+    area_1 = (bounds_1[1] - bounds_1[0] + 1) * (bounds_1[3] - bounds_1[2] + 1)
+    area_2 = (bounds_2[1] - bounds_2[0] + 1) * (bounds_2[3] - bounds_2[2] + 1)
+
+    return intersection_area / (area_1 + area_2 - intersection_area)
+
+
+def _get_mediapipe():
+    """
+    Import mediapipe when it is first needed rather than with this module, as it takes most of the import time (e.g. for the CLI, or
+    processes that only use the helpers or a FaceCropperPool).
+    :return: The mediapipe module.
+    """
+
+    import mediapipe
+    return mediapipe
+
+
+def _get_landmark_array(landmarks):
+    """
+    Convert the landmarks detected by mp.solutions.face_mesh.FaceMesh into an array. This should be done once per face, as all
+    other functions in this module take landmarks in this form.
+    :param landmarks: The landmarks of a face. Must be a list of mediapipe.framework.formats.landmark_pb2.NormalizedLandmark objects.
+    :return: An (n, 3) float32 numpy array where each row contains the normalised [x, y, z] coordinates of a landmark.
+    """
+
+    return np.array([(landmark.x, landmark.y, landmark.z) for landmark in landmarks], dtype=np.float32)
+
+
+def _get_landmark_pixel_coordinates(landmarks, image_size):
+    """
+    Calculate and return the (unrounded) pixel coordinates of the landmarks in an image.
+    :param landmarks: (n, 2) or (n, 3) array containing the normalised coordinates of the landmarks.
+    :param image_size: (height, width) tuple containing the dimensions of the image containing the landmarks.
+    :return: An (n, 2) float64 numpy array where each row contains the [x, y] pixel coordinates of a landmark.
+    """
+
+    return landmarks[:, :2] * np.array([image_size[1], image_size[0]], dtype=np.float64)
+
+
+def _get_segmented_face_image(image, mesh, landmarks, out=None, buffer_pool=None):
     """
     Set non-face pixels in the specified image to 0 and return it
     :param image: The image containing the face
-    :param mesh: A list of (v1, v2, v3) vertex tuples specifying a mesh (in terms of landmark indices) spanning the face in the image.
-    :param landmarks: Landmark coordinates for the face in the image. Must be a list of mediapipe.framework.formats.landmark_pb2.NormalizedLandmark objects.
+    :param mesh: An (n, k) array (or list of k-tuples) of polygons specifying a mesh (in terms of landmark indices) spanning the face in the image.
+    E.g. _FACE_MESH_TRIANGLES (k=3), or _FACE_OUTLINE (n=1).
+    :param landmarks: (n, 3) array containing the normalised landmark coordinates for the face in the image (see _get_landmark_array()).
+    :param out: An array with the same shape and type as the image to write the segmented image into. Defaults to None to allocate a new one.
+    :param buffer_pool: A _BufferPool object to draw the mask from. Defaults to None to allocate a new one.
     :return: An image with non-face pixels set to 0
     """
-    mask = np.zeros(np.shape(image), dtype=np.uint8)
-    for triangle in mesh:
-        mask_vertices = np.ndarray.astype(np.rint(np.array([
-            [landmarks[triangle[0]].x * image.shape[1], landmarks[triangle[0]].y * image.shape[0]],
-            [landmarks[triangle[1]].x * image.shape[1], landmarks[triangle[1]].y * image.shape[0]],
-            [landmarks[triangle[2]].x * image.shape[1], landmarks[triangle[2]].y * image.shape[0]]
-        ])), np.int)
-        cv2.fillPoly(mask, [mask_vertices], (255, 255, 255))
-    return cv2.bitwise_and(image, mask)
+
+    mask = _get_face_mask(image.shape, mesh, _get_landmark_pixel_coordinates(landmarks, image.shape),
+                          None if buffer_pool is None else buffer_pool.get('mask', image.shape[:2]))
+
+    if out is None: return cv2.copyTo(image, mask)
+
+    # cv2.copyTo() leaves the pixels of an existing destination outside the mask unchanged
+    out.fill(0)
+    return cv2.copyTo(image, mask, out)
+
+
+def _get_face_mask(image_size, mesh, landmark_coordinates, out=None):
+    """
+    Create and return a mask of the face pixels in an image.
+    :param image_size: (height, width) tuple containing the dimensions of the image containing the face.
+    :param mesh: An (n, k) array (or list of k-tuples) of polygons specifying a mesh (in terms of landmark indices) spanning the face in the image.
+    :param landmark_coordinates: (n, 2) array containing the [x, y] pixel coordinates of the landmarks in the image.
+    :param out: A (height, width) uint8 array to draw the mask into. Defaults to None to allocate a new one.
+    :return: A single-channel uint8 image where face pixels are 255 and non-face pixels are 0
+    """
+
+    mask_vertices = np.ndarray.astype(np.rint(landmark_coordinates[np.asarray(mesh)]), np.int32)
+
+    # cv2.fillPoly() fills multiple polygons with the even-odd rule, which would leave holes where triangles of a folded mesh
+    # overlap, so each polygon is filled separately (the vertices are precomputed, so this is cheap)
+    if out is None:
+        mask = np.zeros(image_size[:2], dtype=np.uint8)
+    else:
+        mask = out
+        mask.fill(0)
+    for polygon_vertices in mask_vertices:
+        cv2.fillPoly(mask, [polygon_vertices], 255)
+
+    return mask
 
 
 def _get_left_and_right_eye_centres(left_eye_landmarks, right_eye_landmarks):
     """
     Calculate and return the normalised coordinates of the centres of the left and right eyes in the face. The y
     coordinate is converted from a row number to a height value so that the y coordinate increases for points higher up in the image.
-    :param left_eye_landmarks: The landmarks for the left eye (left from the perspective of the image, not the scene).
-    Must be a list of mediapipe.framework.formats.landmark_pb2.NormalizedLandmark objects.
-    :param right_eye_landmarks: The landmarks for the right eye (right from the perspective of the image, not the scene).
-    Must be a list of mediapipe.framework.formats.landmark_pb2.NormalizedLandmark objects.
+    :param left_eye_landmarks: (n, 2) or (n, 3) array containing the normalised coordinates of the landmarks for the left eye (left from the
+    perspective of the image, not the scene). E.g. landmarks[_LEFT_EYE_LANDMARK_INDICES].
+    :param right_eye_landmarks: (n, 2) or (n, 3) array containing the normalised coordinates of the landmarks for the right eye (right from the
+    perspective of the image, not the scene). E.g. landmarks[_RIGHT_EYE_LANDMARK_INDICES].
     :return: ([l_x, l_y], [r_x, r_y]) tuple of two numpy arrays containing the normalised coordinates of the centres of the left and right eyes respectively.
     """
 
-    left_eye_centre = np.array([
-        np.sum([landmark.x for landmark in left_eye_landmarks]) / len(left_eye_landmarks),
-        1 - np.sum([landmark.y for landmark in left_eye_landmarks]) / len(left_eye_landmarks)])
+    left_eye_centre = np.mean(left_eye_landmarks[:, :2], axis=0, dtype=np.float64)
+    left_eye_centre[1] = 1 - left_eye_centre[1]
 
-    right_eye_centre = np.array([
-        np.sum([landmark.x for landmark in right_eye_landmarks]) / len(right_eye_landmarks),
-        1 - np.sum([landmark.y for landmark in right_eye_landmarks]) / len(right_eye_landmarks)])
+    right_eye_centre = np.mean(right_eye_landmarks[:, :2], axis=0, dtype=np.float64)
+    right_eye_centre[1] = 1 - right_eye_centre[1]
 
     return left_eye_centre, right_eye_centre
 
@@ -374,7 +550,7 @@ def _get_eyes_midpoint(left_eye_centre, right_eye_centre, image_size):
 
     return np.ndarray.astype(np.rint(np.array([
         (left_eye_centre[0] + right_eye_centre[0]) * image_size[1] / 2,
-        (left_eye_centre[1] + right_eye_centre[1]) * image_size[0] / 2])), np.int)
+        (left_eye_centre[1] + right_eye_centre[1]) * image_size[0] / 2])), int)
 
 
 def _get_face_roll_angle(left_eye_centre, right_eye_centre):
@@ -412,8 +588,7 @@ def _rotate_landmarks(landmarks, rotation_matrix, image_size):
     """
     Rotate the landmark points using the specified rotation matrix. The new points are rounded to the nearest
     values and converted to integer types.
-    :param landmarks: The landmarks to be rotated. Must be a list of
-    mediapipe.framework.formats.landmark_pb2.NormalizedLandmark objects.
+    :param landmarks: (n, 3) array containing the normalised coordinates of the landmarks to be rotated.
     :param rotation_matrix: 3x2 transformation matrix for rotation around a specified point, by a specified angle.
     :param image_size: (height, width) tuple containing the dimensions of the image containing the landmarks.
     :return: A 2xn integer numpy matrix where n is the number of landmarks. The first row contains the new x values while
@@ -421,28 +596,199 @@ def _rotate_landmarks(landmarks, rotation_matrix, image_size):
     column stores the first landmark's new location, and so on.
     """
 
-    return np.ndarray.astype(np.rint(np.matmul(rotation_matrix, np.array([
-            np.multiply([landmark.x for landmark in landmarks], image_size[1]),
-            np.multiply([landmark.y for landmark in landmarks], image_size[0]),
-            np.ones(len(landmarks))]))), np.int)
+    return np.ndarray.astype(np.rint(np.matmul(rotation_matrix, np.row_stack((
+            _get_landmark_pixel_coordinates(landmarks, image_size).T,
+            np.ones(len(landmarks)))))), int)
+
+
+def _get_roll_correction_matrix(face_landmarks, image_size):
+    """
+    Calculate and return the matrix for correcting the roll of a face, i.e. rotating it around the midpoint between the eyes by the
+    negative of its roll angle.
+    :param face_landmarks: (n, 3) array containing the normalised coordinates of the face landmarks.
+    :param image_size: (height, width) tuple containing the dimensions of the image containing the face.
+    :return: 2x3 transformation matrix for correcting the roll of the face.
+    """
+
+    left_eye_centre, right_eye_centre = _get_left_and_right_eye_centres(
+        face_landmarks[_LEFT_EYE_LANDMARK_INDICES], face_landmarks[_RIGHT_EYE_LANDMARK_INDICES])
+    eyes_midpoint = _get_eyes_midpoint(left_eye_centre, right_eye_centre, image_size)
+
+    roll_angle = _get_face_roll_angle(left_eye_centre, right_eye_centre)
+    return cv2.getRotationMatrix2D((round(eyes_midpoint[0]), round(eyes_midpoint[1])), -roll_angle, 1)
 
 
-def _get_roll_corrected_image_and_landmarks(face_image, face_landmarks):
+def _get_roll_corrected_image_and_landmarks(face_image, face_landmarks, out=None):
     """
     Correct the roll of the given face image and landmarks
     :param face_image: The face image to be roll-corrected
-    :param face_landmarks: Face landmarks to be roll-corrected. Must be a list of mediapipe.framework.formats.landmark_pb2.NormalizedLandmark objects.
+    :param face_landmarks: (n, 3) array containing the normalised coordinates of the face landmarks to be roll-corrected.
+    :param out: An array with the same shape and type as the face image to write the corrected image into. Defaults to None to allocate a new one.
     :return: A (corrected_face_image, corrected_face_landmarks) tuple
     """
-    left_eye_centre, right_eye_centre = _get_left_and_right_eye_centres(
-        [face_landmarks[landmark] for landmark in _LEFT_EYE_LANDMARK_INDICES],
-        [face_landmarks[landmark] for landmark in _RIGHT_EYE_LANDMARK_INDICES])
-    eyes_midpoint = _get_eyes_midpoint(left_eye_centre, right_eye_centre, face_image.shape)
+    rotation_matrix = _get_roll_correction_matrix(face_landmarks, face_image.shape)
 
-    roll_angle = _get_face_roll_angle(left_eye_centre, right_eye_centre)
-    rotation_matrix = cv2.getRotationMatrix2D((round(eyes_midpoint[0]), round(eyes_midpoint[1])), -roll_angle, 1)
+    return (cv2.warpAffine(face_image, rotation_matrix, (face_image.shape[1], face_image.shape[0]), dst=out),
+            _rotate_landmarks(face_landmarks, rotation_matrix, face_image.shape))
+
+
+def _get_landmarks_bounds(landmarks):
+    """
+    Calculate and return the boundaries of the minimum rectangle spanning all of the specified landmarks.
+    :param landmarks: A 2xn integer numpy matrix containing the pixel coordinates of the landmarks (x values in the first row, y values in the second).
+    :return: (top, bottom, left, right) tuple containing the inclusive boundaries of the rectangle.
+    """
+
+    return np.min(landmarks[1, :]), np.max(landmarks[1, :]), np.min(landmarks[0, :]), np.max(landmarks[0, :])
+
+
+def _clip_bounds(image_size, top, bottom, left, right):
+    """
+    Clip the specified boundaries to the perimeter of an image. All edge parameters are inclusive.
+    :param image_size: (height, width) tuple containing the dimensions of the image.
+    :param top: Minimum integer y coordinate of the boundary (as a row number).
+    :param bottom: Maximum integer y coordinate of the boundary (as a row number).
+    :param left: Minimum integer x coordinate of the boundary.
+    :param right: Maximum integer x coordinate of the boundary.
+    :return: The clipped (top, bottom, left, right) tuple.
+    """
+
+    if top < 0: top = 0
+    elif top >= image_size[0]: top = image_size[0] - 1
+
+    if bottom < 0: bottom = 0
+    elif bottom >= image_size[0]: bottom = image_size[0] - 1
+
+    if left < 0: left = 0
+    elif left >= image_size[1]: left = image_size[1] - 1
+
+    if right < 0: right = 0
+    elif right >= image_size[1]: right = image_size[1] - 1
+
+    return top, bottom, left, right
+
+
+def _get_face_quality(face_landmarks, image_size, score=None):
+    """
+    Calculate cheap quality metrics of a face from its landmarks, so that faces unlikely to be useful can be rejected before any of their
+    pixels are processed. The yaw and pitch are estimated from how far off-centre the nose tip is between the edges of the face, measured
+    along (and perpendicular to) the line between the eye centres, so they are independent of the roll of the face.
+    :param face_landmarks: (n, 3) array containing the normalised coordinates of the face landmarks.
+    :param image_size: (height, width) tuple containing the dimensions of the (inflated face) image containing the landmarks.
+    :param score: The detection confidence of the face. Defaults to None.
+    :return: A dict containing:
+        - score: The detection confidence of the face (or None)
+        - face_size: The length (in pixels) of the shorter side of the minimum rectangle spanning all landmarks
+        - yaw_asymmetry: A value in [-1, 1] that is 0 for frontal faces, and approaches 1 (-1) as the face turns towards the right (left)
+          of the image, i.e. as the nose tip approaches the edge of the face
+        - pitch_asymmetry: A value in [-1, 1] that is about 0 for frontal faces, and increases (decreases) as the face looks down (up), i.e. as the
+          nose tip approaches the chin (forehead)
+        - clipped_fraction: The fraction of the area of the minimum rectangle spanning all landmarks that is outside the image, i.e. that is
+          cut off the face crop by _crop_within_bounds()
+    """
+
+    landmark_coordinates = _get_landmark_pixel_coordinates(face_landmarks, image_size)
+
+    horizontal_axis = (np.mean(landmark_coordinates[_LEFT_EYE_LANDMARK_INDICES], axis=0) -
+                       np.mean(landmark_coordinates[_RIGHT_EYE_LANDMARK_INDICES], axis=0))
+    horizontal_axis /= np.linalg.norm(horizontal_axis) or 1
+    vertical_axis = np.array([-horizontal_axis[1], horizontal_axis[0]])
 
-    return cv2.warpAffine(face_image, rotation_matrix, (face_image.shape[1], face_image.shape[0])), _rotate_landmarks(face_landmarks, rotation_matrix, face_image.shape)
+    nose_tip = landmark_coordinates[_NOSE_TIP_LANDMARK_INDEX]
+    left_edge, right_edge = landmark_coordinates[_FACE_EDGE_LANDMARK_INDICES]
+    forehead, chin = landmark_coordinates[_FOREHEAD_AND_CHIN_LANDMARK_INDICES]
+    left_distance, right_distance = (nose_tip - left_edge) @ horizontal_axis, (right_edge - nose_tip) @ horizontal_axis
+    top_distance, bottom_distance = (nose_tip - forehead) @ vertical_axis, (chin - nose_tip) @ vertical_axis
+
+    top, bottom, left, right = _get_landmarks_bounds(np.ndarray.astype(np.rint(landmark_coordinates.T), int))
+    clipped_top, clipped_bottom, clipped_left, clipped_right = _clip_bounds(image_size, top, bottom, left, right)
+    area = (bottom - top + 1) * (right - left + 1)
+    clipped_area = (clipped_bottom - clipped_top + 1) * (clipped_right - clipped_left + 1)
+
+    return {
+        'score': None if score is None else float(score),
+        'face_size': int(min(bottom - top, right - left) + 1),
+        'yaw_asymmetry': float(np.clip((left_distance - right_distance) / ((left_distance + right_distance) or 1), -1, 1)),
+        'pitch_asymmetry': float(np.clip((top_distance - bottom_distance) / ((top_distance + bottom_distance) or 1), -1, 1)),
+        'clipped_fraction': float(1 - clipped_area / area)
+    }
+
+
+def _get_aligned_face_image(face_image, face_landmarks, output_size, correct_roll=True, align_to_template=False, segmentation_mesh=None,
+                            out=None, buffer_pool=None):
+    """
+    Crop out the face in the given image, scaled (keeping its aspect ratio) to fit the specified size and centred, and optionally with its roll corrected
+    and/or background removed. The rotation, translation and scaling are combined into a single similarity transform, so only one warp is done
+    directly from the given image (which can be a view of a larger image), and the cost scales with the output size.
+    :param face_image: The image containing the face
+    :param face_landmarks: (n, 3) array containing the normalised coordinates of the face landmarks in the image.
+    :param output_size: (width, height) tuple containing the dimensions of the output image.
+    :param correct_roll: Whether the roll in the face should be corrected. Defaults to True.
+    :param align_to_template: Whether the face should instead be aligned so that its eye centres, nose tip and mouth corners best match
+    _FIVE_POINT_TEMPLATE (scaled to the output size), as expected by common face recognition models. Defaults to False.
+    :param segmentation_mesh: The mesh used to set non-face pixels to 0 (see _get_segmented_face_image()). Defaults to None to keep the background.
+    :param out: A (height, width, channels) array with the same type as the face image to write the aligned face image into. Defaults to None
+    to allocate a new one.
+    :param buffer_pool: A _BufferPool object to draw the intermediate images from. Defaults to None to allocate them.
+    :return: An image of the specified size containing the aligned face
+    """
+
+    transformation_matrix = _get_alignment_matrix(face_image.shape, face_landmarks, output_size, correct_roll, align_to_template)
+
+    if segmentation_mesh is None:
+        return cv2.warpAffine(face_image, transformation_matrix, tuple(output_size), dst=out)
+
+    landmark_coordinates = _get_landmark_pixel_coordinates(face_landmarks, face_image.shape)
+    aligned_image_shape = (output_size[1], output_size[0]) + face_image.shape[2:]
+    aligned_face_image = cv2.warpAffine(face_image, transformation_matrix, tuple(output_size),
+                                        dst=None if buffer_pool is None else buffer_pool.get('aligned', aligned_image_shape, face_image.dtype))
+    mask = _get_face_mask(aligned_image_shape, segmentation_mesh, np.matmul(landmark_coordinates, transformation_matrix[:, :2].T) + transformation_matrix[:, 2],
+                          None if buffer_pool is None else buffer_pool.get('mask', aligned_image_shape[:2]))
+
+    if out is None: return cv2.copyTo(aligned_face_image, mask)
+
+    out.fill(0)
+    return cv2.copyTo(aligned_face_image, mask, out)
+
+
+def _get_alignment_matrix(image_size, face_landmarks, output_size, correct_roll=True, align_to_template=False):
+    """
+    Calculate and return the similarity transform used by _get_aligned_face_image() to map the given image to the aligned face.
+    :param image_size: (height, width) tuple containing the dimensions of the image containing the face.
+    :param face_landmarks: (n, 3) array containing the normalised coordinates of the face landmarks in the image.
+    :param output_size: (width, height) tuple containing the dimensions of the output image.
+    :param correct_roll: Whether the roll in the face should be corrected. Defaults to True.
+    :param align_to_template: Whether the face should be aligned to _FIVE_POINT_TEMPLATE (see _get_aligned_face_image()). Defaults to False.
+    Faces whose landmarks are too degenerate to be aligned to the template are aligned as with align_to_template=False.
+    :return: 2x3 transformation matrix from pixel coordinates in the image to pixel coordinates in the aligned face image.
+    """
+
+    landmark_coordinates = _get_landmark_pixel_coordinates(face_landmarks, image_size)
+
+    if align_to_template:
+        face_points = np.row_stack((
+            np.mean(landmark_coordinates[_RIGHT_EYE_LANDMARK_INDICES], axis=0),
+            np.mean(landmark_coordinates[_LEFT_EYE_LANDMARK_INDICES], axis=0),
+            landmark_coordinates[_NOSE_TIP_LANDMARK_INDEX],
+            landmark_coordinates[_MOUTH_CORNER_LANDMARK_INDICES]))
+        template_points = _FIVE_POINT_TEMPLATE * (output_size[0] / _FIVE_POINT_TEMPLATE_SIZE[0], output_size[1] / _FIVE_POINT_TEMPLATE_SIZE[1])
+        transformation_matrix = cv2.estimateAffinePartial2D(face_points, template_points, method=cv2.LMEDS)[0]
+        # No transform is found for degenerate points (e.g. coincident landmarks), in which case the face is aligned as without the template
+        if transformation_matrix is not None: return transformation_matrix
+
+    if correct_roll:
+        transformation_matrix = _get_roll_correction_matrix(face_landmarks, image_size)
+    else:
+        transformation_matrix = np.array([[1, 0, 0], [0, 1, 0]], dtype=np.float64)
+
+    # Scale the minimum rectangle spanning the transformed landmarks to fit the output size, and move it to the centre
+    transformed_coordinates = np.matmul(landmark_coordinates, transformation_matrix[:, :2].T) + transformation_matrix[:, 2]
+    minimum, maximum = np.min(transformed_coordinates, axis=0), np.max(transformed_coordinates, axis=0)
+    scale = min(output_size[0] / max(maximum[0] - minimum[0], 1), output_size[1] / max(maximum[1] - minimum[1], 1))
+    transformation_matrix = transformation_matrix * scale
+    transformation_matrix[:, 2] += np.array(output_size) / 2 - scale * (minimum + maximum) / 2
+
+    return transformation_matrix
 
 
 def _crop_within_bounds(image, top, bottom, left, right):
@@ -459,19 +805,302 @@ def _crop_within_bounds(image, top, bottom, left, right):
     :return: The cropped image.
     """
 
-    if top < 0: top = 0
-    elif top >= image.shape[0]: top = image.shape[0] - 1
+    top, bottom, left, right = _clip_bounds(image.shape, top, bottom, left, right)
 
-    if bottom < 0: bottom = 0
-    elif bottom >= image.shape[0]: bottom = image.shape[0] - 1
+    return image[top:bottom+1, left:right+1]
 
-    if left < 0: left = 0
-    elif left >= image.shape[1]: left = image.shape[1] - 1
 
-    if right < 0: right = 0
-    elif right >= image.shape[1]: right = image.shape[1] - 1
+def _get_roll_corrected_face_crop(face_image, face_landmarks, out=None):
+    """
+    Correct the roll of the given face image and crop it to the minimum rectangle spanning all face landmarks. Equivalent to cropping the
+    output of _get_roll_corrected_image_and_landmarks() with _crop_within_bounds(), but only the pixels inside the crop are warped, so the
+    cost scales with the size of the face rather than the size of the face image.
+    :param face_image: The face image to be roll-corrected
+    :param face_landmarks: (n, 3) array containing the normalised coordinates of the face landmarks to be roll-corrected.
+    :param out: An array at least as large as the crop to write it into (see _get_output_view()). Defaults to None to allocate a new one.
+    :return: A (corrected_face_crop, corrected_face_landmarks) tuple. The pixel coordinates in corrected_face_landmarks are relative to the crop.
+    """
+
+    rotation_matrix = _get_roll_correction_matrix(face_landmarks, face_image.shape)
+    corrected_face_landmarks = _rotate_landmarks(face_landmarks, rotation_matrix, face_image.shape)
+    top, bottom, left, right = _clip_bounds(face_image.shape, *_get_landmarks_bounds(corrected_face_landmarks))
+
+    # Shift the rotated image so that the top-left corner of the crop is at the origin
+    rotation_matrix[:, 2] -= (left, top)
+
+    return (cv2.warpAffine(face_image, rotation_matrix, (right - left + 1, bottom - top + 1),
+                           dst=_get_output_view(out, (bottom - top + 1, right - left + 1) + face_image.shape[2:], face_image.dtype)),
+            corrected_face_landmarks - np.array([[left], [top]]))
+
+
+def _get_output_view(out, shape, dtype):
+    """
+    Get the top-left corner of a preallocated array with the given shape, to write an image into.
+    :param out: A numpy.ndarray at least as high and as wide as the image, with the same number of channels and type, or None.
+    :param shape: The shape of the image.
+    :param dtype: The type of the image.
+    :return: A view of out, or None if out is None or can't hold the image.
+    """
+
+    if out is None or out.dtype != dtype or out.shape[2:] != tuple(shape[2:]) or out.shape[0] < shape[0] or out.shape[1] < shape[1]:
+        return None
+
+    return out[:shape[0], :shape[1]]
+
+
+def _get_face_crop_matrix(image_size, face_landmarks, correct_roll):
+    """
+    Calculate and return the transform mapping an image to the face cropped from it by _crop_within_bounds() (after
+    _get_roll_corrected_image_and_landmarks() if correct_roll) or by _get_roll_corrected_face_crop().
+    :param image_size: (height, width) tuple containing the dimensions of the image containing the face.
+    :param face_landmarks: (n, 3) array containing the normalised coordinates of the face landmarks in the image.
+    :param correct_roll: Whether the roll in the face is corrected.
+    :return: 2x3 transformation matrix from pixel coordinates in the image to pixel coordinates in the cropped face.
+    """
+
+    if correct_roll:
+        transformation_matrix = _get_roll_correction_matrix(face_landmarks, image_size)
+        landmarks = _rotate_landmarks(face_landmarks, transformation_matrix, image_size)
+    else:
+        transformation_matrix = np.array([[1, 0, 0], [0, 1, 0]], dtype=np.float64)
+        landmarks = np.ndarray.astype(np.rint(_get_landmark_pixel_coordinates(face_landmarks, image_size).T), int)
+
+    top, _, left, _ = _clip_bounds(image_size, *_get_landmarks_bounds(landmarks))
+    transformation_matrix[:, 2] -= (left, top)
+
+    return transformation_matrix
+
+
+def _get_out_image(out, index):
+    """
+    Get an image from a sequence of preallocated images to write cropped faces into (see FaceCropper.get_faces()).
+    :param out: A sequence of numpy.ndarray images, or None.
+    :param index: The index of the face.
+    :return: The image for the face, or None if out is None or has no image for it.
+    """
+
+    return None if out is None or index >= len(out) else out[index]
+
+
+def _get_downscaled_image(image, max_side):
+    """
+    Downscale an image so that its longest side is at most the specified length, keeping its aspect ratio.
+    :param image: The image to be downscaled.
+    :param max_side: The maximum length (in pixels) of the longest side of the downscaled image.
+    :return: The downscaled image, or the original image if it is already small enough.
+    """
+
+    scale = max_side / max(image.shape[0], image.shape[1])
+    if scale >= 1: return image
+
+    # cv2.INTER_AREA would alias less, but is several times slower than the face detection itself on large images (which downscales its
+    # input to the network's much smaller input size anyway)
+    return cv2.resize(image, (max(1, round(image.shape[1] * scale)), max(1, round(image.shape[0] * scale))), interpolation=cv2.INTER_LINEAR)
+
+
+# cv2.imdecode() flags decoding colour and grayscale images at 1/1, 1/2, 1/4 and 1/8 of their resolution
+_IMREAD_FLAGS = {1: (cv2.IMREAD_COLOR, cv2.IMREAD_GRAYSCALE), 2: (cv2.IMREAD_REDUCED_COLOR_2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+                 4: (cv2.IMREAD_REDUCED_COLOR_4, cv2.IMREAD_REDUCED_GRAYSCALE_4), 8: (cv2.IMREAD_REDUCED_COLOR_8, cv2.IMREAD_REDUCED_GRAYSCALE_8)}
+
+
+def _decode_image(data, colour_order, reduction=1):
+    """
+    Decode an encoded (e.g. JPEG or PNG) image directly into the specified colour order, optionally at reduced resolution. JPEG images are
+    decoded at reduced resolution by the decoder itself (skipping most of the decoding work), rather than downscaled after being decoded.
+    :param data: A bytes-like object containing the encoded image.
+    :param colour_order: The colour order to decode the image into (see colour_order in FaceCropper.__init__()).
+    :param reduction: 1, 2, 4 or 8 to decode the image at 1/reduction of its resolution. Defaults to 1.
+    :return: The decoded numpy.ndarray image.
+    """
+
+    if reduction not in _IMREAD_FLAGS: raise ValueError('reduction must be 1, 2, 4 or 8, not {}'.format(reduction))
+
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), _IMREAD_FLAGS[reduction][colour_order == FaceCropper.GRAY])
+    if image is None: raise ValueError('The image could not be decoded')
+
+    # OpenCV decodes colour images as BGR, which is converted in place rather than into a copy
+    if colour_order == FaceCropper.RGB: cv2.cvtColor(image, cv2.COLOR_BGR2RGB, image)
+
+    return image
+
+
+def _get_mosaic_image(images, tile_size, tile_margin=0.1):
+    """
+    Scale images to fit square tiles (keeping their aspect ratio) and tile them in a grid on a black canvas.
+    :param images: A list of numpy.ndarray RGB images
+    :param tile_size: The side length (in pixels) of the tiles
+    :param tile_margin: The fraction of the tile size left empty on each side of an image, so that faces in neighbouring tiles are kept apart.
+    Defaults to 0.1 (10%)
+    :return: A (mosaic_image, placements, columns) tuple, where placements is a list of (top, left, scale) tuples containing the pixel position of
+    the top left corner of each image on the canvas and the factor it was scaled by, and columns is the number of tiles in each row of the grid
+    """
+
+    columns = int(np.ceil(np.sqrt(len(images))))
+    rows = int(np.ceil(len(images) / columns))
+    mosaic_image = np.zeros((rows * tile_size, columns * tile_size, 3), dtype=np.uint8)
+    placements = []
+
+    for index, image in enumerate(images):
+        scale = tile_size * (1 - 2 * tile_margin) / max(image.shape[0], image.shape[1])
+        width, height = max(1, round(image.shape[1] * scale)), max(1, round(image.shape[0] * scale))
+        top = (index // columns) * tile_size + (tile_size - height) // 2
+        left = (index % columns) * tile_size + (tile_size - width) // 2
+
+        mosaic_image[top:top + height, left:left + width] = cv2.resize(image, (width, height), interpolation=cv2.INTER_LINEAR)
+        placements.append((top, left, (width / image.shape[1], height / image.shape[0])))
+
+    return mosaic_image, placements, columns
+
+
+def _detect_landmarks_in_mosaic(landmark_detector, images, tile_size):
+    """
+    Detect the landmarks of the face in each of several images with a single run of mp.solutions.face_mesh.FaceMesh, by tiling the images
+    on a canvas (see _get_mosaic_image()). Each set of landmarks detected in the canvas is assigned to the tile containing its centre, and
+    mapped back to the coordinates of the image in that tile.
+    :param landmark_detector: An mp.solutions.face_mesh.FaceMesh object with max_num_faces of at least len(images), in static_image_mode
+    :param images: A list of numpy.ndarray RGB images, each containing a face (e.g. inflated face crops)
+    :param tile_size: The side length (in pixels) of the tiles
+    :return: A list containing, for each image, an (n, 3) array with the normalised landmark coordinates of its face (see _get_landmark_array()),
+    or None if no landmarks were detected in its tile
+    """
+
+    mosaic_image, placements, columns = _get_mosaic_image(images, tile_size)
+    all_face_landmarks = [None] * len(images)
+
+    detected_landmarks = landmark_detector.process(mosaic_image).multi_face_landmarks
+    if detected_landmarks is None: return all_face_landmarks
+
+    mosaic_size = np.array([mosaic_image.shape[1], mosaic_image.shape[0], mosaic_image.shape[1]])
+    for landmarks in detected_landmarks:
+        # Landmarks in pixels of the canvas (z is scaled by the canvas width, like x)
+        landmark_coordinates = _get_landmark_array(landmarks.landmark) * mosaic_size
+        centre_x, centre_y = np.mean(landmark_coordinates[:, :2], axis=0)
+        index = int(centre_y // tile_size) * columns + int(centre_x // tile_size)
+        if not 0 <= index < len(images) or all_face_landmarks[index] is not None: continue
+
+        top, left, (scale_x, scale_y) = placements[index]
+        image_size = np.array([images[index].shape[1] * scale_x, images[index].shape[0] * scale_y, images[index].shape[1] * scale_x])
+        all_face_landmarks[index] = ((landmark_coordinates - [left, top, 0]) / image_size).astype(np.float32)
+
+    return all_face_landmarks
+
+
+def _put_in_queue(item_queue, item, stopped, drop_oldest=False):
+    """
+    Put an item in a bounded queue, waiting for a free slot unless the specified event is set.
+    :param item_queue: The queue.Queue object to put the item in.
+    :param item: The item to put in the queue.
+    :param stopped: A threading.Event object which is set when the item is no longer needed.
+    :param drop_oldest: Whether the oldest item in the queue should be discarded to make space when the queue is full, instead of waiting. Defaults to False.
+    """
+
+    while not stopped.is_set():
+        try:
+            if drop_oldest:
+                item_queue.put_nowait(item)
+            else:
+                item_queue.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            if drop_oldest:
+                try: item_queue.get_nowait()
+                except queue.Empty: pass
+
+
+def _get_from_queue(item_queue, stopped):
+    """
+    Remove and return the next item in a queue, waiting for one unless the specified event is set.
+    :param item_queue: The queue.Queue object to get the item from.
+    :param stopped: A threading.Event object which is set when no more items are needed.
+    :return: The next item in the queue, or None if the event was set.
+    """
+
+    while not stopped.is_set():
+        try:
+            return item_queue.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return None
+
+
+def _read_video_frames(video, frame_queue, stopped, frame_step, latest_frame_only, colour_conversion=cv2.COLOR_BGR2RGB):
+    """
+    Read the frames of a video, convert them to RGB and put them in a queue as (frame_index, timestamp, image) tuples, followed by None
+    once the video ends (or an exception if reading fails). Meant to be run in a background thread.
+    :param video: The cv2.VideoCapture object to read frames from.
+    :param frame_queue: The queue.Queue object to put the frames in.
+    :param stopped: A threading.Event object which is set when no more frames are needed.
+    :param frame_step: Only every frame_step-th frame is retrieved and put in the queue. The other frames are only grabbed (which still
+    decodes them with most backends), not converted or queued.
+    :param latest_frame_only: Whether frames waiting in the queue should be discarded when a newer frame is read.
+    :param colour_conversion: The cv2.cvtColor() code converting the (BGR) frames into the colour order of the queue, or None to queue them
+    as they are decoded. Defaults to cv2.COLOR_BGR2RGB.
+    """
+
+    try:
+        frame_index = 0
+        while not stopped.is_set():
+            if frame_index % frame_step != 0:
+                if not video.grab(): break
+            else:
+                read_successful, image_bgr = video.read()
+                if not read_successful: break
+                _put_in_queue(
+                    frame_queue,
+                    (frame_index, video.get(cv2.CAP_PROP_POS_MSEC),
+                     image_bgr if colour_conversion is None else cv2.cvtColor(image_bgr, colour_conversion)),
+                    stopped,
+                    latest_frame_only
+                )
+            frame_index += 1
+        _put_in_queue(frame_queue, None, stopped)
+    except Exception as exception:
+        _put_in_queue(frame_queue, exception, stopped)
+
+
+class _BufferPool:
+    """
+    Scratch buffers for the intermediate images of FaceCropper (e.g. masks and segmented or roll-corrected inflated face crops), which are
+    reused for each face instead of being allocated again. Each buffer is identified by a slot name and a type, and grows to the largest
+    size requested from it, so the memory used is bounded by the largest face seen rather than by the number of different face sizes.
+    A buffer is overwritten the next time its slot is requested, so images drawn from it must not be returned to the caller.
+    """
+
+    def __init__(self):
+        """
+        Initialise a _BufferPool object.
+        """
+
+        self._buffers = {}
+
+
+    def get(self, slot, shape, dtype=np.uint8):
+        """
+        Get a buffer of the specified shape and type. Its contents are undefined.
+        :param slot: The name of the buffer. Buffers that are used at the same time must have different names.
+        :param shape: The shape of the buffer.
+        :param dtype: The type of the buffer. Defaults to numpy.uint8.
+        :return: A C-contiguous numpy.ndarray
+        """
+
+        size = int(np.prod(shape))
+        key = (slot, np.dtype(dtype))
+
+        buffer = self._buffers.get(key)
+        if buffer is None or buffer.size < size:
+            buffer = self._buffers[key] = np.empty(size, dtype=dtype)
+
+        return buffer[:size].reshape(shape)
+
+
+    @property
+    def nbytes(self):
+        """
+        The total size of the buffers in bytes.
+        """
+
+        return sum(buffer.nbytes for buffer in self._buffers.values())
 
-    return image[top:bottom+1, left:right+1]
 
 
 class FaceCropper:
@@ -510,9 +1139,41 @@ class FaceCropper:
     STATIC_MODE = True
     TRACKING_MODE = False
 
+    # segmentation_mode values
+    MESH_SEGMENTATION = 0
+    OUTLINE_SEGMENTATION = 1
+
+    # roll_correction_mode values
+    IMAGE_ROLL_CORRECTION = 0
+    ROI_ROLL_CORRECTION = 1
+
+    # face_ranking values
+    SCORE_RANKING = 0
+    SIZE_RANKING = 1
+
+    # mask_format values
+    BLACKED_OUT_MASK = 0
+    ALPHA_MASK = 1
+    BIT_MASK = 2
+    POLYGON_MASK = 3
+
+    # colour_order and output_colour_order values
+    RGB = 0
+    BGR = 1
+    GRAY = 2
+
+    # cv2.cvtColor() codes converting images from one colour order to another
+    _COLOUR_CONVERSIONS = {(RGB, BGR): cv2.COLOR_RGB2BGR, (RGB, GRAY): cv2.COLOR_RGB2GRAY, (BGR, RGB): cv2.COLOR_BGR2RGB,
+                           (BGR, GRAY): cv2.COLOR_BGR2GRAY, (GRAY, RGB): cv2.COLOR_GRAY2RGB, (GRAY, BGR): cv2.COLOR_GRAY2BGR}
 
     def __init__(self, min_face_detector_confidence=0.5, face_detector_model_selection=LONG_RANGE,
-                 landmark_detector_static_image_mode=STATIC_MODE, min_landmark_detector_confidence=0.5):
+                 landmark_detector_static_image_mode=STATIC_MODE, min_landmark_detector_confidence=0.5,
+                 segmentation_mode=MESH_SEGMENTATION, roll_correction_mode=ROI_ROLL_CORRECTION, detection_max_side=None,
+                 detection_pyramid_fallback=False, output_size=None, align_to_template=False, stats=None, cache=None,
+                 landmark_batch_size=None, landmark_tile_size=256, min_face_size=None, max_faces=None, face_ranking=SCORE_RANKING,
+                 max_face_overlap=None, debug_capture=None, mask_format=BLACKED_OUT_MASK, reuse_buffers=True,
+                 landmark_max_side=None, min_landmark_face_size=None, max_yaw_asymmetry=None, max_pitch_asymmetry=None,
+                 max_clipped_fraction=None, colour_order=RGB, output_colour_order=None):
         """
         Initialise a FaceCropper object.
         :param min_face_detector_confidence:
@@ -535,262 +1196,2969 @@ class FaceCropper:
         From mp.solutions.face_mesh.FaceMesh documentation:
         "Minimum confidence value ([0.0, 1.0]) from the face detection model for the detection to be considered successful. See details in
         https://google.github.io/mediapipe/solutions/face_mesh#min_detection_confidence". Defaults to 0.5.
+        :param segmentation_mode: How non-face pixels are found when removing the background. 0 (FaceCropper.MESH_SEGMENTATION) to keep
+        pixels inside any triangle of the face mesh, or 1 (FaceCropper.OUTLINE_SEGMENTATION) to keep pixels inside the outline of the face mesh.
+        The outline is much faster to rasterise, but may cut off parts of faces with high yaw or pitch (e.g. the nose). Defaults to 0.
+        :param roll_correction_mode: How the roll of faces is corrected. 0 (FaceCropper.IMAGE_ROLL_CORRECTION) to rotate the whole inflated face
+        image and then crop the face out of it, or 1 (FaceCropper.ROI_ROLL_CORRECTION) to only rotate the pixels inside the final crop. Both give
+        the same output (up to interpolation rounding), but 1 is faster as the inflated face image can be several times larger than the face. Defaults to 1.
+        :param detection_max_side: Images are downscaled so that their longest side is at most this many pixels before being passed to
+        mp.solutions.face_detection.FaceDetection. Faces and landmarks are still cropped from the full resolution image, as the detected bounding
+        boxes are relative to the image size. Speeds up detection on large images, but small faces may be missed. Defaults to None to detect faces at full resolution.
+        :param detection_pyramid_fallback: Whether faces should be detected again at twice the resolution (up to the full resolution) when no
+        faces are detected in a downscaled image. Only used with detection_max_side. Defaults to False.
+        :param output_size: (width, height) tuple. If specified, each cropped face is scaled (keeping its aspect ratio) to fit this size and
+        centred, using a single warp from the inflated face image for the roll correction, crop and scaling (see _get_aligned_face_image()), so all
+        cropped faces have the same dimensions. Defaults to None to return the cropped faces at their original size.
+        :param align_to_template: Whether each face should instead be aligned so that its eye centres, nose tip and mouth corners best match the
+        canonical 5-point template used by common face recognition models (e.g. ArcFace), scaled to output_size. Only used with output_size. Defaults to False.
+        :param stats: A FaceCropperStats object (or any object with the same add_stage_time() and increment() methods) to record the time spent in
+        each stage of the pipeline and per-image counters in. Can also be set later with the stats attribute. Defaults to None to not record anything.
+        :param cache: A FaceCache object to store the detected faces and landmarks of each image in, keyed by a hash of its pixels (see
+        get_face_records()), so they are not detected again when the same image is seen again. Can be shared by FaceCropper objects with the
+        same configuration. Defaults to None to not cache anything.
+        :param landmark_batch_size: Experimental. If specified, the inflated face crops of an image are scaled down and tiled onto a canvas in
+        batches of up to this many, and mp.solutions.face_mesh.FaceMesh runs once on each canvas (see _detect_landmarks_in_mosaic()) rather than
+        once for each face. Faces without landmarks in the canvas are retried on their own. Faster for images with many faces, but landmarks
+        are less accurate (see benchmark.py --landmark-batching). Defaults to None to detect the landmarks of each face separately.
+        :param landmark_tile_size: The side length (in pixels) of the square tile each face crop is scaled to fit when landmark_batch_size is
+        specified. Defaults to 256.
+        :param min_face_size: Detected faces whose bounding box is shorter or narrower than this many pixels (in the full resolution image) are
+        ignored before their landmarks are detected. Defaults to None to keep faces of any size.
+        :param max_faces: The maximum number of detected faces per image whose landmarks are detected. Faces are ranked by face_ranking. Defaults
+        to None to keep any number of faces.
+        :param face_ranking: How faces are ranked for max_faces. 0 (FaceCropper.SCORE_RANKING) to keep the faces with the highest detection
+        confidence, or 1 (FaceCropper.SIZE_RANKING) to keep the faces with the largest bounding boxes. Defaults to 0.
+        :param max_face_overlap: Detected faces whose bounding box overlaps that of a face with a higher detection confidence by more than this
+        intersection over union (between 0 and 1) are ignored as duplicates. Defaults to None to keep overlapping faces.
+        :param debug_capture: A DebugCapture object to record the intermediate results of a sample of get_faces() calls with. Defaults to None
+        to not record anything.
+        :param mask_format: How the face pixels are returned when removing the background. The mask follows the same roll correction, crop and
+        scaling as the cropped face:
+            - 0 (FaceCropper.BLACKED_OUT_MASK): Each cropped face is returned with non-face pixels set to 0
+            - 1 (FaceCropper.ALPHA_MASK): Each cropped face is returned as an RGBA image, whose alpha channel is 255 for face pixels and 0 otherwise
+            - 2 (FaceCropper.BIT_MASK): A (face_image, bit_mask) tuple is returned for each face, where bit_mask is the mask packed 8 pixels
+              per byte along each row (i.e. numpy.packbits(mask, axis=1)), which is unpacked with numpy.unpackbits(bit_mask, axis=1, count=width)
+            - 3 (FaceCropper.POLYGON_MASK): A (face_image, polygon) tuple is returned for each face, where polygon is a (k, 2) float32 array
+              containing the [x, y] pixel coordinates of the outline of the face mesh in face_image (regardless of segmentation_mode)
+        The face_image is not masked in formats 1-3, so the background can be removed (or composited) later. Defaults to 0.
+        :param reuse_buffers: Whether the intermediate images of each face (e.g. masks and roll-corrected inflated face crops) should be drawn
+        from buffers that are reused for every face, rather than allocated for each face. The returned face images are never such buffers.
+        Defaults to True.
+        :param landmark_max_side: Inflated face crops are downscaled so that their longest side is at most this many pixels before being passed
+        to mp.solutions.face_mesh.FaceMesh. The landmarks are normalised, so they still locate the face in the full resolution crop, and the roll
+        correction, segmentation and output crop keep full quality. Speeds up the landmark stage for very large faces (e.g. close-up photos),
+        which FaceMesh scales down to its much smaller input size anyway (see benchmark.py --landmark-resolution). Defaults to None to detect
+        landmarks at full resolution.
+        :param min_landmark_face_size: Faces whose landmarks span a rectangle shorter or narrower than this many pixels are rejected right after
+        their landmarks are detected, before any pixels are processed (see _get_face_quality() and FaceRecord.quality). Defaults to None to
+        keep faces of any size.
+        :param max_yaw_asymmetry: Faces whose yaw asymmetry (between -1 and 1, see _get_face_quality()) is larger than this in magnitude are
+        rejected. Defaults to None to keep faces of any yaw.
+        :param max_pitch_asymmetry: Faces whose pitch asymmetry (between -1 and 1, see _get_face_quality()) is larger than this in magnitude are
+        rejected. Defaults to None to keep faces of any pitch.
+        :param max_clipped_fraction: Faces with more than this fraction (between 0 and 1) of the rectangle spanning their landmarks outside the
+        image are rejected. Defaults to None to keep faces cut off by the edge of the image.
+        :param colour_order: The colour order of the images passed to this FaceCropper object: 0 (FaceCropper.RGB), 1 (FaceCropper.BGR, e.g. as
+        decoded by OpenCV) or 2 (FaceCropper.GRAY, for (height, width) grayscale images). Faces are cropped from the image as it is, and only the
+        (downscaled) images and face crops passed to the mediapipe networks are converted to RGB, so callers don't have to convert whole images
+        first. Defaults to 0.
+        :param output_colour_order: The colour order of the cropped faces (see colour_order). Only the cropped faces are converted. Defaults to
+        None to return them in colour_order.
         """
 
-        self.face_detector = mp.solutions.face_detection.FaceDetection(min_detection_confidence=min_face_detector_confidence,
-                                                                       model_selection=face_detector_model_selection)
+        # The graphs are built the first time they are used (see the face_detector, landmark_detector and mosaic_landmark_detector properties)
+        self._face_detector_kwargs = {'min_detection_confidence': min_face_detector_confidence, 'model_selection': face_detector_model_selection}
+        self._landmark_detector_kwargs = {'static_image_mode': landmark_detector_static_image_mode,
+                                          'min_detection_confidence': min_landmark_detector_confidence}
+        self._face_detector = None
+        self._landmark_detector = None
+        self._mosaic_landmark_detector = None
 
-        self.landmark_detector = mp.solutions.face_mesh.FaceMesh(max_num_faces=1,
-                                                                 static_image_mode=landmark_detector_static_image_mode,
-                                                                 min_detection_confidence=min_landmark_detector_confidence)
+        self.landmark_batch_size = landmark_batch_size
+        self.landmark_tile_size = landmark_tile_size
 
+        self.segmentation_mesh = _FACE_OUTLINE if segmentation_mode == FaceCropper.OUTLINE_SEGMENTATION else _FACE_MESH_TRIANGLES
+        self.roll_correction_mode = roll_correction_mode
+        self.detection_max_side = detection_max_side
+        self.detection_pyramid_fallback = detection_pyramid_fallback
+        self.landmark_max_side = landmark_max_side
+        self.min_landmark_face_size = min_landmark_face_size
+        self.max_yaw_asymmetry = max_yaw_asymmetry
+        self.max_pitch_asymmetry = max_pitch_asymmetry
+        self.max_clipped_fraction = max_clipped_fraction
+        self.colour_order = colour_order
+        self.output_colour_order = colour_order if output_colour_order is None else output_colour_order
+        self._network_colour_conversion = FaceCropper._COLOUR_CONVERSIONS.get((colour_order, FaceCropper.RGB))
+        self._output_colour_conversion = FaceCropper._COLOUR_CONVERSIONS.get((colour_order, self.output_colour_order))
+        self._filters_quality = any(threshold is not None for threshold in (min_landmark_face_size, max_yaw_asymmetry, max_pitch_asymmetry,
+                                                                              max_clipped_fraction))
+        self.output_size = output_size
+        self.align_to_template = align_to_template
+        self.min_face_size = min_face_size
+        self.max_faces = max_faces
+        self.face_ranking = face_ranking
+        self.max_face_overlap = max_face_overlap
+        self.stats = stats
+        self.cache = cache
+        self.debug_capture = debug_capture
+        self.mask_format = mask_format
+        self._buffer_pool = _BufferPool() if reuse_buffers else None
+        # The configuration affecting detected faces and landmarks, which is part of the cache keys
+        self._cache_key_prefix = repr((min_face_detector_confidence, face_detector_model_selection, landmark_detector_static_image_mode,
+                                       min_landmark_detector_confidence, detection_max_side, detection_pyramid_fallback,
+                                       landmark_batch_size, landmark_tile_size, min_face_size, max_faces, face_ranking, max_face_overlap,
+                                       landmark_max_side, min_landmark_face_size, max_yaw_asymmetry, max_pitch_asymmetry,
+                                       max_clipped_fraction, colour_order)).encode()
 
-    def get_faces(self, image, remove_background=False, correct_roll=True):
+
+    @property
+    def face_detector(self):
         """
-        Crop out (and optionally correct the roll and/or remove background of) each detected face in the specified image and return them in a list.
-        :param image: A numpy.ndarray RGB image containing faces to be cropped
-        :param remove_background: Whether non-face (i.e. background) pixels should be set to 0. Defaults to False
-        :param correct_roll: Whether the roll in faces should be corrected. Defaults to True
-        :return: A list of numpy.ndarray RGB images containing the cropped faces
+        The mp.solutions.face_detection.FaceDetection graph, which is built (importing mediapipe) the first time it is used.
         """
 
-        face_images = []
+        if self._face_detector is None:
+            self._face_detector = _get_mediapipe().solutions.face_detection.FaceDetection(**self._face_detector_kwargs)
 
-        detected_faces = self.face_detector.process(image).detections
-        if detected_faces is None: return face_images
+        return self._face_detector
 
-        for face in detected_faces:
-            # The mp.solutions.face_detection.FaceDetection network may rarely 'find' a face completely outside the image, so ignore those
-            if 0 <= face.location_data.relative_bounding_box.xmin <= 1 and 0 <= face.location_data.relative_bounding_box.ymin <= 1:
-                inflation_factor = _get_bounding_box_inflation_factor(face.location_data.relative_keypoints[:2])
-                inflated_face_image = _get_inflated_face_image(image, face.location_data.relative_bounding_box, inflation_factor)
-                detected_landmarks = self.landmark_detector.process(inflated_face_image).multi_face_landmarks
-
-                if detected_landmarks is not None:
-                    face_landmarks = detected_landmarks[0].landmark
-
-                    if remove_background:
-                        inflated_face_image = _get_segmented_face_image(inflated_face_image, _FACE_MESH, face_landmarks)
-
-                    if correct_roll:
-                        inflated_face_image, face_landmarks = _get_roll_corrected_image_and_landmarks(inflated_face_image, face_landmarks)
-                    else:
-                        face_landmarks = np.ndarray.astype(np.rint(np.array([
-                            np.multiply([landmark.x for landmark in face_landmarks], inflated_face_image.shape[1]),
-                            np.multiply([landmark.y for landmark in face_landmarks], inflated_face_image.shape[0])])), np.int)
-
-                    face_images.append(
-                        _crop_within_bounds(
-                            inflated_face_image,
-                            face_landmarks[1, np.argmin(face_landmarks[1, :])], face_landmarks[1, np.argmax(face_landmarks[1, :])],
-                            face_landmarks[0, np.argmin(face_landmarks[0, :])], face_landmarks[0, np.argmax(face_landmarks[0, :])]
-                        )
-                    )
 
-        return face_images
+    @property
+    def landmark_detector(self):
+        """
+        The mp.solutions.face_mesh.FaceMesh graph (with max_num_faces=1), which is built (importing mediapipe) the first time it is used.
+        """
 
+        if self._landmark_detector is None:
+            self._landmark_detector = _get_mediapipe().solutions.face_mesh.FaceMesh(max_num_faces=1, **self._landmark_detector_kwargs)
 
-    def get_faces_debug(self, image, remove_background=False, correct_roll=True):
+        return self._landmark_detector
+
+
+    @property
+    def mosaic_landmark_detector(self):
         """
-        Identical to get_faces(), except it displays the following debug information:
-            - Annotations of face detection boxes and eye coordinates from mp.solutions.face_detection.FaceDetection, approximate roll angle,
-              inflation factor, and inflated face detection boxes
-            - Annotations of landmarks detected from mp.solutions.face_mesh.FaceMesh, eye coordinates, and roll angle
-            - Output images for each (remove_background, correct_roll) combination
-        :param image: A numpy.ndarray RGB image containing faces to be cropped
-        :param remove_background: Whether non-face (i.e. background) pixels should be set to 0
-        :param correct_roll: Whether the roll in faces should be corrected
-        :return: A list of numpy.ndarray RGB images containing the cropped faces
+        The mp.solutions.face_mesh.FaceMesh graph (with max_num_faces=landmark_batch_size) used to detect the landmarks of batches of faces,
+        which is built (importing mediapipe) the first time it is used, or None if landmark_batch_size is None.
         """
 
-        face_images = []
+        if self._mosaic_landmark_detector is None and self.landmark_batch_size is not None:
+            self._mosaic_landmark_detector = _get_mediapipe().solutions.face_mesh.FaceMesh(
+                max_num_faces=self.landmark_batch_size, static_image_mode=True,
+                min_detection_confidence=self._landmark_detector_kwargs['min_detection_confidence'])
 
-        detected_faces = self.face_detector.process(image).detections
-        if detected_faces is None: return face_images
+        return self._mosaic_landmark_detector
 
-        # IMAGE_DEBUG START #
-        image_debug = image.copy()
-        for face in detected_faces:
-            # Face detection box
-            face_box = face.location_data.relative_bounding_box
-            cv2.rectangle(
-                image_debug,
-                (round(face_box.xmin * image.shape[1]), round(face_box.ymin * image.shape[0])),
-                (round((face_box.xmin + face_box.width) * image.shape[1]),
-                 round((face_box.ymin + face_box.height) * image.shape[0])),
-                (0, 255, 0)
-            )
-            # Eye coordinates
-            eye_coordinates = face.location_data.relative_keypoints[:2]
-            inflation_factor = _get_bounding_box_inflation_factor(eye_coordinates)
-            for eye_coordinate in eye_coordinates:
-                cv2.circle(image_debug, (round(eye_coordinate.x * image.shape[1]), round(eye_coordinate.y * image.shape[0])), 1, (0, 255, 0))
-            # Roll line
-            cv2.line(
-                image_debug,
-                (round(eye_coordinates[0].x * image.shape[1]), round(eye_coordinates[0].y * image.shape[0])),
-                (round(eye_coordinates[1].x * image.shape[1]), round(eye_coordinates[1].y * image.shape[0])),
-                (255, 0, 0)
-            )
-            # Horizontal line
-            cv2.line(
-                image_debug,
-                (round(eye_coordinates[0].x * image.shape[1]), round(eye_coordinates[0].y * image.shape[0])),
-                (round(eye_coordinates[1].x * image.shape[1]), round(eye_coordinates[0].y * image.shape[0])),
-                (255, 0, 0)
-            )
-            # Roll angle
-            cv2.putText(
-                image_debug,
-                'roll_angle: {:.2f}'.format(_get_face_roll_angle([eye_coordinates[1].x, 1 - eye_coordinates[1].y], [eye_coordinates[0].x, 1 - eye_coordinates[0].y])),
-                (round(eye_coordinates[0].x * image.shape[1]), round(eye_coordinates[0].y * image.shape[0] + 40)), cv2.FONT_HERSHEY_PLAIN, 1, (255, 0, 255)
-            )
-            # Inflation factor
-            cv2.putText(
-                image_debug,
-                'inflation_factor: {:.2f}'.format(inflation_factor),
-                (round(eye_coordinates[0].x * image.shape[1]), round(eye_coordinates[0].y * image.shape[0] + 80)), cv2.FONT_HERSHEY_PLAIN, 1, (255, 0, 255)
-            )
-            # Inflated face detection box
-            width_inflation, height_inflation = face_box.width * inflation_factor, face_box.height * inflation_factor
-            cv2.rectangle(
-                image_debug,
-                (round((face_box.xmin - width_inflation / 2) * image.shape[1]), round((face_box.ymin + face_box.height + height_inflation / 2) * image.shape[0])),
-                (round((face_box.xmin + face_box.width + width_inflation / 2) * image.shape[1]), round((face_box.ymin - height_inflation / 2) * image.shape[0])),
-                (0, 0, 255)
-            )
-        cv2.imshow('image_debug', cv2.cvtColor(image_debug, cv2.COLOR_RGB2BGR))
-        # IMAGE_DEBUG END #
 
-        for face in detected_faces:
-            # The mp.solutions.face_detection.FaceDetection network may rarely 'find' a face completely outside the image, so ignore those
-            if 0 <= face.location_data.relative_bounding_box.xmin <= 1 and 0 <= face.location_data.relative_bounding_box.ymin <= 1:
-                inflation_factor = _get_bounding_box_inflation_factor(face.location_data.relative_keypoints[:2])
-                inflated_face_image = _get_inflated_face_image(image, face.location_data.relative_bounding_box, inflation_factor)
-                detected_landmarks = self.landmark_detector.process(inflated_face_image).multi_face_landmarks
-
-                if detected_landmarks is not None:
-                    face_landmarks = detected_landmarks[0].landmark
-
-                    # INFLATED_FACE_IMAGE_DEBUG START #
-                    inflated_face_image_debug = inflated_face_image.copy()
-                    for i, landmark in enumerate(face_landmarks):
-                        # Eye landmarks
-                        if i in _LEFT_EYE_LANDMARK_INDICES or i in _RIGHT_EYE_LANDMARK_INDICES:
-                            cv2.circle(inflated_face_image_debug, (round(landmark.x * inflated_face_image.shape[1]), round(landmark.y * inflated_face_image.shape[0])), 1, (255, 0, 0))
-                        # Face landmarks
-                        else:
-                            cv2.circle(inflated_face_image_debug, (round(landmark.x*inflated_face_image.shape[1]), round(landmark.y*inflated_face_image.shape[0])), 1, (0, 255, 0))
-                    # Eye coordinates
-                    left_eye_centre, right_eye_centre = _get_left_and_right_eye_centres(
-                        [face_landmarks[landmark] for landmark in _LEFT_EYE_LANDMARK_INDICES],
-                        [face_landmarks[landmark] for landmark in _RIGHT_EYE_LANDMARK_INDICES])
-                    for eye_coordinate in [left_eye_centre, right_eye_centre]:
-                        cv2.circle(inflated_face_image_debug, (round(eye_coordinate[0]*inflated_face_image.shape[1]), round((1-eye_coordinate[1])*inflated_face_image.shape[0])), 2, (255, 255, 0))
-                    # Eye midpoint
-                    eyes_midpoint = _get_eyes_midpoint(left_eye_centre, right_eye_centre, inflated_face_image.shape)
-                    cv2.circle(inflated_face_image_debug, (eyes_midpoint[0], inflated_face_image.shape[0] - eyes_midpoint[1]), 2, (0, 0, 255))
-                    # Roll line
-                    cv2.line(
-                        inflated_face_image_debug,
-                        (round(left_eye_centre[0] * inflated_face_image.shape[1]), round((1-left_eye_centre[1]) * inflated_face_image.shape[0])),
-                        (round(right_eye_centre[0] * inflated_face_image.shape[1]), round((1-right_eye_centre[1]) * inflated_face_image.shape[0])),
-                        (255, 0, 0)
-                    )
-                    # Horizontal line
-                    cv2.line(
-                        inflated_face_image_debug,
-                        (round(right_eye_centre[0] * inflated_face_image.shape[1]), round((1-right_eye_centre[1]) * inflated_face_image.shape[0])),
-                        (round(left_eye_centre[0] * inflated_face_image.shape[1]), round((1-right_eye_centre[1]) * inflated_face_image.shape[0])),
-                        (255, 0, 0)
-                    )
-                    # Roll angle
-                    cv2.putText(
-                        inflated_face_image_debug,
-                        'roll_angle: {:.2f}'.format(_get_face_roll_angle(left_eye_centre, right_eye_centre)),
-                        (round(right_eye_centre[0] * inflated_face_image.shape[1]), round((1 - right_eye_centre[1]) * inflated_face_image.shape[0] + 20)),
-                        cv2.FONT_HERSHEY_PLAIN, 1, (255, 0, 255)
-                    )
-                    inflated_face_image_segmented = _get_segmented_face_image(inflated_face_image, _FACE_MESH, face_landmarks)
-                    cv2.imshow('inflated_face_image_debug', cv2.cvtColor(np.row_stack((
-                                np.column_stack((
-                                        inflated_face_image_debug,
-                                        inflated_face_image_segmented
-                                    )
-                                ),
-                                np.column_stack((
-                                        _get_roll_corrected_image_and_landmarks(inflated_face_image, face_landmarks)[0],
-                                        _get_roll_corrected_image_and_landmarks(inflated_face_image_segmented, face_landmarks)[0]
-                                    )
-                                )
-                            )
-                        ), cv2.COLOR_RGB2BGR)
-                    )
-                    # INFLATED_FACE_IMAGE_DEBUG END #
-
-                    # OUTPUT_IMAGE_DEBUG START #
-                    landmarks = np.ndarray.astype(np.rint(np.array([
-                            np.multiply([landmark.x for landmark in face_landmarks], inflated_face_image.shape[1]),
-                            np.multiply([landmark.y for landmark in face_landmarks], inflated_face_image.shape[0])])), np.int)
-                    cv2.imshow('output_image_debug', cv2.cvtColor(np.column_stack((
-                                   _crop_within_bounds(
-                                        inflated_face_image,
-                                        landmarks[1, np.argmin(landmarks[1, :])],
-                                        landmarks[1, np.argmax(landmarks[1, :])],
-                                        landmarks[0, np.argmin(landmarks[0, :])],
-                                        landmarks[0, np.argmax(landmarks[0, :])]
-                                    ),
-                                   _crop_within_bounds(
-                                       inflated_face_image_segmented,
-                                       landmarks[1, np.argmin(landmarks[1, :])],
-                                       landmarks[1, np.argmax(landmarks[1, :])],
-                                       landmarks[0, np.argmin(landmarks[0, :])],
-                                       landmarks[0, np.argmax(landmarks[0, :])]
-                                   ),
-                            )
-                        ), cv2.COLOR_RGB2BGR)
-                    )
-                    # OUTPUT_IMAGE_DEBUG END #
-
-                    # OUTPUT_IMAGE_CORRECTED_DEBUG START #
-                    corrected_inflated_face_image, corrected_landmarks = _get_roll_corrected_image_and_landmarks(inflated_face_image, face_landmarks)
-                    corrected_inflated_face_image_segmented, corrected_landmarks = _get_roll_corrected_image_and_landmarks(inflated_face_image_segmented, face_landmarks)
-                    cv2.imshow('output_image_corrected_debug', cv2.cvtColor(np.column_stack((
-                                   _crop_within_bounds(
-                                        corrected_inflated_face_image,
-                                        corrected_landmarks[1, np.argmin(corrected_landmarks[1, :])],
-                                        corrected_landmarks[1, np.argmax(corrected_landmarks[1, :])],
-                                        corrected_landmarks[0, np.argmin(corrected_landmarks[0, :])],
-                                        corrected_landmarks[0, np.argmax(corrected_landmarks[0, :])]
-                                    ),
-                                   _crop_within_bounds(
-                                       corrected_inflated_face_image_segmented,
-                                       corrected_landmarks[1, np.argmin(corrected_landmarks[1, :])],
-                                       corrected_landmarks[1, np.argmax(corrected_landmarks[1, :])],
-                                       corrected_landmarks[0, np.argmin(corrected_landmarks[0, :])],
-                                       corrected_landmarks[0, np.argmax(corrected_landmarks[0, :])]
-                                   ),
-                            )
-                        ), cv2.COLOR_RGB2BGR)
-                    )
-                    # OUTPUT_IMAGE_CORRECTED_DEBUG END #
-
-                    if remove_background:
-                        inflated_face_image = _get_segmented_face_image(inflated_face_image, _FACE_MESH, face_landmarks)
-
-                    if correct_roll:
-                        inflated_face_image, face_landmarks = _get_roll_corrected_image_and_landmarks(inflated_face_image, face_landmarks)
-                    else:
-                        face_landmarks = np.ndarray.astype(np.rint(np.array([
-                            np.multiply([landmark.x for landmark in face_landmarks], inflated_face_image.shape[1]),
-                            np.multiply([landmark.y for landmark in face_landmarks], inflated_face_image.shape[0])])), np.int)
-
-                    face_images.append(
-                        _crop_within_bounds(
-                            inflated_face_image,
-                            face_landmarks[1, np.argmin(face_landmarks[1, :])], face_landmarks[1, np.argmax(face_landmarks[1, :])],
-                            face_landmarks[0, np.argmin(face_landmarks[0, :])], face_landmarks[0, np.argmax(face_landmarks[0, :])]
-                        )
-                    )
+    def warm_up(self, image=None):
+        """
+        Build the graphs and run each of them once, so that their initialisation (e.g. loading the models and creating the inference
+        engines) isn't paid by the first get_faces() call (e.g. before a worker starts serving requests). Nothing is recorded in stats.
+        :param image: A numpy.ndarray RGB image to also run the pipeline on (without cropping faces), ideally containing a face like the
+        images that will be processed, as mp.solutions.face_mesh.FaceMesh only initialises its landmark model once it finds a face.
+        Defaults to None to only run the graphs on a blank image.
+        """
 
-        return face_images
+        stats, self.stats = self.stats, None
+
+        try:
+            blank_image = np.zeros((self.landmark_tile_size, self.landmark_tile_size, 3), dtype=np.uint8)
+            self.face_detector.process(blank_image)
+            self.landmark_detector.process(blank_image)
+            if self.mosaic_landmark_detector is not None: _detect_landmarks_in_mosaic(self.mosaic_landmark_detector, [blank_image] * 2, self.landmark_tile_size)
+
+            if image is not None: self._detect_all_landmarks(self._get_inflated_face_images(image))
+        finally:
+            self.stats = stats
+
+
+    def get_faces(self, image, remove_background=False, correct_roll=True, out=None):
+        """
+        Crop out (and optionally correct the roll and/or remove background of) each detected face in the specified image and return them in a list.
+        :param image: A numpy.ndarray image containing faces to be cropped, in colour_order (RGB by default, see __init__())
+        :param remove_background: Whether non-face (i.e. background) pixels should be set to 0. Defaults to False
+        :param correct_roll: Whether the roll in faces should be corrected. Defaults to True
+        :param out: A sequence of preallocated numpy.ndarray images to write the cropped faces into, in order (e.g. a (k, height, width, 3) uint8
+        array with output_size). Each face is written into the top-left corner of its image, and returned as a view of it, so the images must be
+        at least as large as the faces, and have the same number of channels (4 with FaceCropper.ALPHA_MASK). Faces without a (large enough)
+        image in out are returned in new arrays. Defaults to None to return every face in a new array.
+        :return: A list of numpy.ndarray images (in output_colour_order) containing the cropped faces
+        """
+
+        if self.debug_capture is not None and self.debug_capture.is_sampled():
+            face_images, debug_record = self._get_faces_and_debug_record(image, remove_background, correct_roll, out)
+            self.debug_capture.submit(*self._get_rgb_debug_images(image, face_images, debug_record))
+            return face_images
+
+        if self.cache is not None:
+            return [face_record.get_face_image(remove_background, correct_roll, _get_out_image(out, face_index))
+                    for face_index, face_record in enumerate(self.get_face_records(image))]
+
+        face_images = []
+        inflated_face_images = self._get_inflated_face_images(image)
+
+        for inflated_face_image, face_landmarks in zip(inflated_face_images, self._detect_all_landmarks(inflated_face_images)):
+            if face_landmarks is None: continue
+            if self._filters_quality and not self._is_accepted_quality(_get_face_quality(face_landmarks, inflated_face_image.shape)): continue
+            face_images.append(self._get_face_image(inflated_face_image, remove_background, correct_roll, face_landmarks,
+                                                    _get_out_image(out, len(face_images))))
+
+        return face_images
+
+
+    def get_faces_from_bytes(self, data, remove_background=False, correct_roll=True, reduction=1, out=None):
+        """
+        Decode an encoded (e.g. JPEG or PNG) image directly into colour_order (see __init__()), and crop out its faces as in get_faces().
+        :param data: A bytes-like object containing the encoded image (e.g. the contents of an image file or an upload)
+        :param remove_background: Whether non-face (i.e. background) pixels should be set to 0. Defaults to False
+        :param correct_roll: Whether the roll in faces should be corrected. Defaults to True
+        :param reduction: 1, 2, 4 or 8 to decode the image at 1/reduction of its resolution, which is much faster for large JPEG images. The faces
+        are cropped from the reduced image, so this is for when neither the detection nor the cropped faces need the full resolution (e.g. with
+        output_size). Defaults to 1 to decode the image at full resolution.
+        :param out: A sequence of preallocated numpy.ndarray images to write the cropped faces into (see get_faces()). Defaults to None
+        :return: A list of numpy.ndarray images (in output_colour_order) containing the cropped faces
+        """
+
+        return self.get_faces(_decode_image(data, self.colour_order, reduction), remove_background, correct_roll, out)
+
+
+    def _detect_faces(self, image, debug_detections=None):
+        """
+        Detect faces in the specified image with mp.solutions.face_detection.FaceDetection, and calculate the factor their bounding boxes
+        should be inflated by (steps 1 and 2 of the pipeline).
+        :param image: A numpy.ndarray RGB image containing faces to be cropped
+        :param debug_detections: A list to append a dict to for each face detected by mp.solutions.face_detection.FaceDetection (including the
+        faces that are ignored), containing its 'face_box' (xmin, ymin, width, height), 'score', 'eye_keypoints', approximate 'roll_angle'
+        (from the eye keypoints), 'inflation_factor', and whether it was 'kept'. Defaults to None
+        :return: A list of (face_box, inflation_factor, score) tuples, where face_box is a mediapipe.framework.formats.location_data_pb2.RelativeBoundingBox
+        object and score is the detection confidence
+        """
+
+        faces = []
+        stats = self.stats
+
+        if stats is not None: start_time = time.perf_counter()
+        detected_faces = self._process_face_detector(image)
+        if stats is not None:
+            stats.add_stage_time('detection', time.perf_counter() - start_time)
+            stats.increment('images')
+
+        if detected_faces is None: return faces
+
+        for face in detected_faces:
+            # The mp.solutions.face_detection.FaceDetection network may rarely 'find' a face completely outside the image, so ignore those
+            if 0 <= face.location_data.relative_bounding_box.xmin <= 1 and 0 <= face.location_data.relative_bounding_box.ymin <= 1:
+                faces.append((
+                    face.location_data.relative_bounding_box,
+                    _get_bounding_box_inflation_factor(face.location_data.relative_keypoints[:2]),
+                    face.score[0]
+                ))
+
+        if stats is not None:
+            stats.increment('faces_detected', len(detected_faces))
+            stats.increment('faces_out_of_bounds', len(detected_faces) - len(faces))
+
+        if self.min_face_size is not None or self.max_faces is not None or self.max_face_overlap is not None:
+            faces = self._filter_faces(faces, image.shape)
+
+        if debug_detections is not None:
+            kept_faces = set((face_box.xmin, face_box.ymin, face_box.width, face_box.height, score) for face_box, _, score in faces)
+            for face in detected_faces:
+                face_box = face.location_data.relative_bounding_box
+                eye_keypoints = face.location_data.relative_keypoints[:2]
+                debug_detections.append({
+                    'face_box': [face_box.xmin, face_box.ymin, face_box.width, face_box.height],
+                    'score': face.score[0],
+                    'eye_keypoints': [[eye_keypoint.x, eye_keypoint.y] for eye_keypoint in eye_keypoints],
+                    'roll_angle': _get_face_roll_angle([eye_keypoints[1].x, 1 - eye_keypoints[1].y], [eye_keypoints[0].x, 1 - eye_keypoints[0].y]),
+                    'inflation_factor': _get_bounding_box_inflation_factor(eye_keypoints),
+                    'kept': (face_box.xmin, face_box.ymin, face_box.width, face_box.height, face.score[0]) in kept_faces
+                })
+
+        return faces
+
+
+    def _filter_faces(self, faces, image_size):
+        """
+        Drop detected faces that are too small, that overlap a face with a higher detection confidence, or that are beyond the maximum number
+        of faces (see min_face_size, max_face_overlap, max_faces and face_ranking in __init__()), so their landmarks aren't detected.
+        :param faces: A list of (face_box, inflation_factor, score) tuples (see _detect_faces())
+        :param image_size: The size of the image the faces were detected in
+        :return: A list of the (face_box, inflation_factor, score) tuples that are kept, in their original order
+        """
+
+        face_bounds = [_get_inflated_face_bounds(face_box, 0, image_size) for face_box, _, _ in faces]
+        face_indices = range(len(faces))
+        too_small_count = overlapping_count = over_limit_count = 0
+
+        if self.min_face_size is not None:
+            face_indices = [i for i in face_indices if min(face_bounds[i][1] - face_bounds[i][0], face_bounds[i][3] - face_bounds[i][2]) + 1 >= self.min_face_size]
+            too_small_count = len(faces) - len(face_indices)
+
+        if self.max_face_overlap is not None:
+            kept_indices = []
+            for i in sorted(face_indices, key=lambda i: faces[i][2], reverse=True):
+                if all(_get_bounds_iou(face_bounds[i], face_bounds[j]) <= self.max_face_overlap for j in kept_indices): kept_indices.append(i)
+            overlapping_count = len(face_indices) - len(kept_indices)
+            face_indices = kept_indices
+
+        if self.max_faces is not None and len(face_indices) > self.max_faces:
+            if self.face_ranking == FaceCropper.SIZE_RANKING:
+                ranking_key = lambda i: (face_bounds[i][1] - face_bounds[i][0] + 1) * (face_bounds[i][3] - face_bounds[i][2] + 1)
+            else:
+                ranking_key = lambda i: faces[i][2]
+            over_limit_count = len(face_indices) - self.max_faces
+            face_indices = sorted(face_indices, key=ranking_key, reverse=True)[:self.max_faces]
+
+        if self.stats is not None:
+            self.stats.increment('faces_too_small', too_small_count)
+            self.stats.increment('faces_overlapping', overlapping_count)
+            self.stats.increment('faces_over_limit', over_limit_count)
+
+        return [faces[i] for i in sorted(face_indices)]
+
+
+    def _is_accepted_quality(self, quality):
+        """
+        Check the quality metrics of a face against the thresholds of this FaceCropper object (see min_landmark_face_size, max_yaw_asymmetry,
+        max_pitch_asymmetry and max_clipped_fraction in __init__()), and count the face as low quality in stats if it is rejected.
+        :param quality: The quality metrics of the face (see _get_face_quality())
+        :return: Whether the face should be kept
+        """
+
+        accepted = ((self.min_landmark_face_size is None or quality['face_size'] >= self.min_landmark_face_size) and
+                    (self.max_yaw_asymmetry is None or abs(quality['yaw_asymmetry']) <= self.max_yaw_asymmetry) and
+                    (self.max_pitch_asymmetry is None or abs(quality['pitch_asymmetry']) <= self.max_pitch_asymmetry) and
+                    (self.max_clipped_fraction is None or quality['clipped_fraction'] <= self.max_clipped_fraction))
+
+        if not accepted and self.stats is not None: self.stats.increment('faces_low_quality')
+
+        return accepted
+
+
+    def _get_network_image(self, image, slot=None):
+        """
+        Convert an image (or face crop) in colour_order to RGB for the mediapipe networks (see __init__()).
+        :param image: A numpy.ndarray image in colour_order
+        :param slot: The name of the buffer of buffer_pool to convert the image into, which is reused for the next image with the same slot.
+        Defaults to None to convert it into a new array.
+        :return: The numpy.ndarray RGB image, or the image itself if it is already RGB
+        """
+
+        if self._network_colour_conversion is None: return image
+        if slot is None or self._buffer_pool is None: return cv2.cvtColor(image, self._network_colour_conversion)
+
+        return cv2.cvtColor(image, self._network_colour_conversion, self._buffer_pool.get(slot, image.shape[:2] + (3,), image.dtype))
+
+
+    def _process_face_detector(self, image):
+        """
+        Run mp.solutions.face_detection.FaceDetection on the specified image, downscaled to detection_max_side and converted to RGB (see __init__()).
+        :param image: A numpy.ndarray image (in colour_order) containing faces
+        :return: The detections of mp.solutions.face_detection.FaceDetection (relative to the image size), or None if no faces were detected
+        """
+
+        if self.detection_max_side is None: return self.face_detector.process(self._get_network_image(image, 'detector_input')).detections
+
+        max_side = self.detection_max_side
+        while True:
+            detected_faces = self.face_detector.process(self._get_network_image(_get_downscaled_image(image, max_side), 'detector_input')).detections
+            if detected_faces is not None or not self.detection_pyramid_fallback or max_side >= max(image.shape[0], image.shape[1]):
+                return detected_faces
+            max_side *= 2
+
+
+    def _get_inflated_face_images(self, image):
+        """
+        Detect faces in the specified image and crop them out with inflated bounding boxes (see _detect_faces()).
+        :param image: A numpy.ndarray RGB image containing faces to be cropped
+        :return: A list of numpy.ndarray RGB images containing the inflated face crops
+        """
+
+        return [_get_inflated_face_image(image, face_box, inflation_factor) for face_box, inflation_factor, _ in self._detect_faces(image)]
+
+
+    def _detect_landmarks(self, inflated_face_image):
+        """
+        Detect the landmarks of the face in an inflated face crop with mp.solutions.face_mesh.FaceMesh (step 3 of the pipeline), downscaled to
+        landmark_max_side and converted to RGB (see __init__()).
+        :param inflated_face_image: A numpy.ndarray image (in colour_order) containing an inflated face crop
+        :return: (n, 3) array containing the normalised landmark coordinates of the face (see _get_landmark_array()) in the full resolution
+        inflated face crop, or None if no landmarks were detected
+        """
+
+        stats = self.stats
+
+        if stats is not None: start_time = time.perf_counter()
+        if self.landmark_max_side is not None: inflated_face_image = _get_downscaled_image(inflated_face_image, self.landmark_max_side)
+        detected_landmarks = self.landmark_detector.process(self._get_network_image(inflated_face_image, 'landmark_input')).multi_face_landmarks
+        if stats is not None:
+            stats.add_stage_time('landmarks', time.perf_counter() - start_time)
+            if detected_landmarks is None: stats.increment('faces_without_landmarks')
+
+        if detected_landmarks is None: return None
+
+        return _get_landmark_array(detected_landmarks[0].landmark)
+
+
+    def _detect_all_landmarks(self, inflated_face_images):
+        """
+        Detect the landmarks of the faces in inflated face crops, one at a time or in mosaics of landmark_batch_size crops (see __init__()).
+        :param inflated_face_images: A list of numpy.ndarray RGB images containing inflated face crops
+        :return: A list containing, for each inflated face crop, the normalised landmark coordinates of its face (see _detect_landmarks()), or None
+        if no landmarks were detected
+        """
+
+        if self.landmark_batch_size is None or len(inflated_face_images) < 2:
+            return [self._detect_landmarks(inflated_face_image) for inflated_face_image in inflated_face_images]
+
+        all_face_landmarks = []
+        for batch_start in range(0, len(inflated_face_images), self.landmark_batch_size):
+            batch = inflated_face_images[batch_start:batch_start + self.landmark_batch_size]
+            if len(batch) == 1:
+                all_face_landmarks.append(self._detect_landmarks(batch[0]))
+                continue
+
+            stats = self.stats
+            if stats is not None: start_time = time.perf_counter()
+            face_landmarks = _detect_landmarks_in_mosaic(self.mosaic_landmark_detector, [self._get_network_image(image) for image in batch],
+                                                         self.landmark_tile_size)
+            if stats is not None: stats.add_stage_time('landmarks', time.perf_counter() - start_time)
+
+            # Faces missed in the mosaic (e.g. too small after scaling down) are retried on their own
+            all_face_landmarks.extend(self._detect_landmarks(inflated_face_image) if landmarks is None else landmarks
+                                      for inflated_face_image, landmarks in zip(batch, face_landmarks))
+
+        return all_face_landmarks
+
+
+    def _get_face_image(self, inflated_face_image, remove_background, correct_roll, face_landmarks=None, out=None):
+        """
+        Detect the landmarks of the face in an inflated face crop (unless they are given), and crop the face out of it (steps 3 and 4 of the pipeline).
+        :param inflated_face_image: A numpy.ndarray image (in colour_order) containing an inflated face crop (see _get_inflated_face_images())
+        :param remove_background: Whether non-face (i.e. background) pixels should be set to 0
+        :param correct_roll: Whether the roll in the face should be corrected
+        :param face_landmarks: (n, 3) array containing the normalised landmark coordinates of the face in the inflated face crop. Defaults to
+        None to detect them with _detect_landmarks().
+        :param out: A preallocated numpy.ndarray image to write the cropped face into (see get_faces()). Defaults to None to return it in a new array.
+        :return: A numpy.ndarray image (in output_colour_order) containing the cropped face (or a different output if remove_background, see mask_format in
+        __init__()), or None if no landmarks were detected
+        """
+
+        if face_landmarks is None:
+            face_landmarks = self._detect_landmarks(inflated_face_image)
+            if face_landmarks is None: return None
+
+        stats = self.stats
+        buffer_pool = self._buffer_pool
+
+        # Other mask formats crop the face with its background, and draw the mask in the coordinates of the cropped face afterwards
+        separate_mask = remove_background and self.mask_format != FaceCropper.BLACKED_OUT_MASK
+        if separate_mask:
+            inflated_face_image_size, normalised_face_landmarks, masked_out = inflated_face_image.shape, face_landmarks, out
+            remove_background = False
+            # An RGBA out image is filled in by _get_masked_face_output() (OpenCV can't write into its colour channels, as they aren't contiguous)
+            if self.mask_format == FaceCropper.ALPHA_MASK: out = None
+
+        # Faces in a different output colour order are cropped into a new (or pooled) array first, and converted into out afterwards
+        output_colour_conversion = self._output_colour_conversion
+        if output_colour_conversion is not None: out, converted_out = None, out
+
+        pooled = False  # Whether face_image is a view of a buffer in buffer_pool, which is reused for the next face
+        if self.output_size is not None:
+            if stats is not None: start_time = time.perf_counter()
+            face_image = _get_aligned_face_image(inflated_face_image, face_landmarks, self.output_size, correct_roll, self.align_to_template,
+                                                 self.segmentation_mesh if remove_background else None,
+                                                 _get_output_view(out, (self.output_size[1], self.output_size[0]) + inflated_face_image.shape[2:],
+                                                                  inflated_face_image.dtype), buffer_pool)
+            if stats is not None: stats.add_stage_time('alignment', time.perf_counter() - start_time)
+
+        else:
+            if remove_background:
+                if stats is not None: start_time = time.perf_counter()
+                inflated_face_image = _get_segmented_face_image(
+                    inflated_face_image, self.segmentation_mesh, face_landmarks,
+                    None if buffer_pool is None else buffer_pool.get('segmented', inflated_face_image.shape, inflated_face_image.dtype), buffer_pool)
+                pooled = buffer_pool is not None
+                if stats is not None: stats.add_stage_time('segmentation', time.perf_counter() - start_time)
+
+            if stats is not None: start_time = time.perf_counter()
+            if correct_roll and self.roll_correction_mode == FaceCropper.ROI_ROLL_CORRECTION:
+                face_image = _get_roll_corrected_face_crop(inflated_face_image, face_landmarks, out)[0]
+                pooled = False
+            else:
+                if correct_roll:
+                    inflated_face_image, face_landmarks = _get_roll_corrected_image_and_landmarks(
+                        inflated_face_image, face_landmarks,
+                        None if buffer_pool is None else buffer_pool.get('roll_corrected', inflated_face_image.shape, inflated_face_image.dtype))
+                    pooled = buffer_pool is not None
+                else:
+                    face_landmarks = np.ndarray.astype(np.rint(_get_landmark_pixel_coordinates(face_landmarks, inflated_face_image.shape).T), int)
+                face_image = _crop_within_bounds(inflated_face_image, *_get_landmarks_bounds(face_landmarks))
+            if stats is not None: stats.add_stage_time('roll_correction' if correct_roll else 'crop', time.perf_counter() - start_time)
+
+        if output_colour_conversion is not None:
+            output_view = _get_output_view(converted_out, face_image.shape[:2] + ((3,) if self.output_colour_order != FaceCropper.GRAY else ()),
+                                           face_image.dtype)
+            face_image = cv2.cvtColor(face_image, output_colour_conversion, output_view)
+        else:
+            # Crops (of the image or of a buffer) that weren't written into out are copied into it
+            output_view = _get_output_view(out, face_image.shape, face_image.dtype)
+            if output_view is not None and not np.may_share_memory(output_view, face_image):
+                np.copyto(output_view, face_image)
+                face_image = output_view
+            elif pooled and output_view is None:
+                face_image = face_image.copy()
+
+        if stats is not None:
+            stats.increment('faces_cropped')
+            stats.increment('output_pixels', face_image.shape[0] * face_image.shape[1])
+
+        if separate_mask: return self._get_masked_face_output(face_image, inflated_face_image_size, normalised_face_landmarks, correct_roll, masked_out)
+
+        return face_image
+
+
+    def _get_face_landmark_coordinates(self, inflated_face_image_size, face_landmarks, correct_roll):
+        """
+        Calculate the pixel coordinates of the landmarks of a face in its cropped face image (following the roll correction, crop and scaling
+        of _get_face_image()).
+        :param inflated_face_image_size: The size of the inflated face crop the face is cropped from
+        :param face_landmarks: (n, 3) array containing the normalised landmark coordinates of the face in the inflated face crop
+        :param correct_roll: Whether the roll in the face is corrected
+        :return: An (n, 2) float64 numpy array where each row contains the [x, y] pixel coordinates of a landmark in the cropped face image
+        """
+
+        if self.output_size is not None:
+            transformation_matrix = _get_alignment_matrix(inflated_face_image_size, face_landmarks, self.output_size, correct_roll, self.align_to_template)
+        else:
+            transformation_matrix = _get_face_crop_matrix(inflated_face_image_size, face_landmarks, correct_roll)
+
+        return (np.matmul(_get_landmark_pixel_coordinates(face_landmarks, inflated_face_image_size), transformation_matrix[:, :2].T) +
+                transformation_matrix[:, 2])
+
+
+    def _get_masked_face_output(self, face_image, inflated_face_image_size, face_landmarks, correct_roll, out=None):
+        """
+        Combine a cropped face with its mask in the format specified by mask_format (see __init__()).
+        :param face_image: A numpy.ndarray image (in output_colour_order) containing the cropped face (with its background)
+        :param inflated_face_image_size: The size of the inflated face crop the face was cropped from
+        :param face_landmarks: (n, 3) array containing the normalised landmark coordinates of the face in the inflated face crop
+        :param correct_roll: Whether the roll in the face was corrected
+        :param out: A preallocated numpy.ndarray RGBA image to write the output into with FaceCropper.ALPHA_MASK (see get_faces()). Defaults to
+        None to return it in a new array.
+        :return: An RGBA (BGRA, or grayscale and alpha) image (FaceCropper.ALPHA_MASK), or a (face_image, bit_mask) or (face_image, polygon) tuple
+        """
+
+        stats = self.stats
+        if stats is not None: start_time = time.perf_counter()
+
+        landmark_coordinates = self._get_face_landmark_coordinates(inflated_face_image_size, face_landmarks, correct_roll)
+
+        if self.mask_format == FaceCropper.POLYGON_MASK:
+            face_output = (face_image, landmark_coordinates[_FACE_OUTLINE[0]].astype(np.float32))
+        else:
+            mask = _get_face_mask(face_image.shape, self.segmentation_mesh, landmark_coordinates,
+                                  None if self._buffer_pool is None else self._buffer_pool.get('mask', face_image.shape[:2]))
+            if self.mask_format == FaceCropper.BIT_MASK:
+                face_output = (face_image, np.packbits(mask, axis=1))
+            else:
+                channels = face_image.shape[2] if face_image.ndim == 3 else 1
+                face_output = _get_output_view(out, face_image.shape[:2] + (channels + 1,), face_image.dtype)
+                if face_output is None:
+                    face_output = np.dstack((face_image, mask))
+                else:
+                    face_output[..., :channels] = face_image.reshape(face_image.shape[:2] + (channels,))
+                    face_output[..., channels] = mask
+
+        if stats is not None: stats.add_stage_time('segmentation', time.perf_counter() - start_time)
+
+        return face_output
+
+
+    def close(self):
+        """
+        Close the mp.solutions.face_detection.FaceDetection and mp.solutions.face_mesh.FaceMesh graphs that have been built, freeing their
+        resources. The FaceCropper object can't be used afterwards.
+        """
+
+        for graph in (self._face_detector, self._landmark_detector, self._mosaic_landmark_detector):
+            if graph is not None: graph.close()
+
+
+    def get_face_records(self, image):
+        """
+        Detect each face in the specified image along with its landmarks, without cropping it out. The cropped face images are only computed
+        when they are accessed on the returned records, so this is cheaper than get_faces() when only the geometry of the faces is needed.
+        :param image: A numpy.ndarray RGB image containing faces. The records keep a reference to it (rather than a copy) to crop the faces from,
+        so it should not be modified while the records are used.
+        :return: A list of FaceRecord objects, one for each face whose landmarks were detected (and whose quality is accepted, see
+        _is_accepted_quality())
+        """
+
+        if self.cache is not None:
+            cache_key = self._get_cache_key(image)
+            faces = self.cache.get(cache_key)
+            if self.stats is not None: self.stats.increment('cache_misses' if faces is None else 'cache_hits')
+            if faces is not None: return [FaceRecord(self, image, *face) for face in faces]
+
+        faces = []  # (score, face_box, inflation_factor, inflated_bounds, face_landmarks) tuples
+        face_records = []
+
+        detected_faces = self._detect_faces(image)
+        all_inflated_bounds = [tuple(int(bound) for bound in _clip_bounds(image.shape, *_get_inflated_face_bounds(face_box, inflation_factor, image.shape)))
+                               for face_box, inflation_factor, _ in detected_faces]
+        all_face_landmarks = self._detect_all_landmarks([image[top:bottom + 1, left:right + 1] for top, bottom, left, right in all_inflated_bounds])
+
+        for (face_box, inflation_factor, score), inflated_bounds, face_landmarks in zip(detected_faces, all_inflated_bounds, all_face_landmarks):
+            if face_landmarks is None: continue
+            face = (score, (face_box.xmin, face_box.ymin, face_box.width, face_box.height), inflation_factor, inflated_bounds, face_landmarks)
+            face_record = FaceRecord(self, image, *face)
+            if self._filters_quality and not self._is_accepted_quality(face_record.quality): continue
+            faces.append(face)
+            face_records.append(face_record)
+
+        if self.cache is not None: self.cache.put(cache_key, faces)
+
+        return face_records
+
+
+    def _get_cache_key(self, image):
+        """
+        Get the key of an image in the cache: a hash of its pixels, shape and type, and of the configuration of this FaceCropper object that
+        affects the detected faces and landmarks (but not of the configuration that only affects how faces are cropped, e.g. output_size).
+        :param image: A numpy.ndarray RGB image
+        :return: A hexadecimal string
+        """
+
+        # BLAKE2b is among the fastest hashes in hashlib without hardware support, and long enough to make collisions negligible
+        image_hash = hashlib.blake2b(self._cache_key_prefix, digest_size=16)
+        image_hash.update(repr((image.shape, image.dtype.str)).encode())
+        image_hash.update(memoryview(np.ascontiguousarray(image)).cast('B'))
+
+        return image_hash.hexdigest()
+
+
+    def _get_faces_and_debug_record(self, image, remove_background, correct_roll, out=None):
+        """
+        Identical to get_faces() (without the cache), except the intermediate results of the pipeline are also returned as data.
+        :param image: A numpy.ndarray RGB image containing faces to be cropped
+        :param remove_background: Whether non-face (i.e. background) pixels should be set to 0
+        :param correct_roll: Whether the roll in faces should be corrected
+        :param out: A sequence of preallocated numpy.ndarray images to write the cropped faces into (see get_faces()). Defaults to None
+        :return: A (face_images, debug_record) tuple, where face_images is a list of numpy.ndarray RGB images containing the cropped faces, and
+        debug_record is a JSON serialisable dict containing the 'image_size', 'remove_background' and 'correct_roll' arguments, the 'detections'
+        (see _detect_faces()), and for each kept face its 'inflated_bounds' (top, bottom, left, right), its 'landmarks' normalised to the
+        inflated bounds (or None if no landmarks were detected), its 'roll_angle' (from the landmarks), its 'quality' (see _get_face_quality()),
+        whether it was 'rejected' by the quality thresholds (see _is_accepted_quality()), and the 'face_image_size' of its crop (or None if it
+        was not cropped)
+        """
+
+        debug_detections = []
+        detected_faces = self._detect_faces(image, debug_detections)
+        all_inflated_bounds = [tuple(int(bound) for bound in _clip_bounds(image.shape, *_get_inflated_face_bounds(face_box, inflation_factor, image.shape)))
+                               for face_box, inflation_factor, _ in detected_faces]
+        all_face_landmarks = self._detect_all_landmarks([image[top:bottom + 1, left:right + 1] for top, bottom, left, right in all_inflated_bounds])
+
+        face_images = []
+        debug_faces = []
+        for (_, _, score), inflated_bounds, face_landmarks in zip(detected_faces, all_inflated_bounds, all_face_landmarks):
+            debug_face = {'inflated_bounds': list(inflated_bounds), 'landmarks': None, 'roll_angle': None, 'quality': None, 'rejected': False,
+                          'face_image_size': None}
+            debug_faces.append(debug_face)
+            if face_landmarks is None: continue
+
+            top, bottom, left, right = inflated_bounds
+            debug_face['landmarks'] = face_landmarks.tolist()
+            debug_face['roll_angle'] = _get_face_roll_angle(*_get_left_and_right_eye_centres(
+                face_landmarks[_LEFT_EYE_LANDMARK_INDICES], face_landmarks[_RIGHT_EYE_LANDMARK_INDICES]))
+            debug_face['quality'] = _get_face_quality(face_landmarks, (bottom - top + 1, right - left + 1), score)
+            if self._filters_quality and not self._is_accepted_quality(debug_face['quality']):
+                debug_face['rejected'] = True
+                continue
+
+            face_image = self._get_face_image(image[top:bottom + 1, left:right + 1], remove_background, correct_roll, face_landmarks,
+                                              _get_out_image(out, len(face_images)))
+            face_images.append(face_image)
+            debug_face['face_image_size'] = list(_get_face_output_image(face_image).shape[:2])
+
+        return face_images, {
+            'image_size': list(image.shape[:2]),
+            'remove_background': remove_background,
+            'correct_roll': correct_roll,
+            'detections': debug_detections,
+            'faces': debug_faces
+        }
+
+
+    def _get_rgb_debug_images(self, image, face_images, debug_record):
+        """
+        Convert an image and its cropped faces to RGB for render_debug_images() and DebugCapture objects (see colour_order and output_colour_order
+        in __init__()).
+        :param image: The numpy.ndarray image (in colour_order) the faces were cropped from
+        :param face_images: A list of the outputs of get_faces() for the image
+        :param debug_record: The debug record of the image (see _get_faces_and_debug_record())
+        :return: An (image, debug_record, face_images) tuple, with the image and face images in RGB (or the arguments themselves if they already are)
+        """
+
+        if self.colour_order != FaceCropper.RGB: image = _get_rgb_image(image, self.colour_order)
+        if self.output_colour_order != FaceCropper.RGB:
+            face_images = [_get_rgb_image(_get_face_output_image(face_image), self.output_colour_order) for face_image in face_images]
+
+        return image, debug_record, face_images
+
+
+    def get_faces_debug(self, image, remove_background=False, correct_roll=True):
+        """
+        Identical to get_faces(), except it displays the debug images rendered by render_debug_images() in windows (which requires a display).
+        To debug faces without a display, use a DebugCapture object instead.
+        :param image: A numpy.ndarray RGB image containing faces to be cropped
+        :param remove_background: Whether non-face (i.e. background) pixels should be set to 0
+        :param correct_roll: Whether the roll in faces should be corrected
+        :return: A list of numpy.ndarray RGB images containing the cropped faces
+        """
+
+        face_images, debug_record = self._get_faces_and_debug_record(image, remove_background, correct_roll)
+
+        for name, debug_image in render_debug_images(*self._get_rgb_debug_images(image, face_images, debug_record)).items():
+            cv2.imshow(name, cv2.cvtColor(debug_image, cv2.COLOR_RGB2BGR))
+
+        return face_images
+
+
+    def iter_video(self, source, remove_background=False, correct_roll=True, frame_step=1, latest_frame_only=False, queue_size=4):
+        """
+        Crop out the faces in each frame of a video, overlapping the decoding of frames, face detection, and landmark detection:
+            - Frames are decoded (and converted to colour_order, see __init__()) in a background thread
+            - mp.solutions.face_detection.FaceDetection runs in a second background thread
+            - mp.solutions.face_mesh.FaceMesh and the rest of the pipeline run in the thread iterating over the generator
+        The stages are connected by bounded queues, so decoding blocks (or drops frames, see latest_frame_only) when processing falls behind.
+        Stopping the iteration early (e.g. with break) stops the background threads.
+        :param source: A video file path, a camera index, or a cv2.VideoCapture object to read frames from. Video captures opened from a path or
+        camera index are released when the iteration ends.
+        :param remove_background: Whether non-face (i.e. background) pixels should be set to 0. Defaults to False
+        :param correct_roll: Whether the roll in faces should be corrected. Defaults to True
+        :param frame_step: Only every frame_step-th frame is processed. The other frames are grabbed from the video, but not converted or
+        processed. Defaults to 1 to process every frame.
+        :param latest_frame_only: Whether frames that have not been processed yet should be dropped when a newer frame is decoded (or has its
+        faces detected), so at most one frame waits in front of each stage and the output keeps up with a live camera at the cost of skipping
+        frames. Defaults to False.
+        :param queue_size: The maximum number of frames waiting between consecutive stages. Defaults to 4.
+        :return: A generator yielding a (frame_index, timestamp, image, face_images) tuple for each processed frame, where frame_index is the
+        index of the frame in the video, timestamp is the position of the frame in milliseconds (as reported by cv2.VideoCapture), image is the
+        numpy.ndarray frame (in colour_order), and face_images is a list of numpy.ndarray images (in output_colour_order) containing the cropped faces
+        """
+
+        video = source if isinstance(source, cv2.VideoCapture) else cv2.VideoCapture(source)
+        frame_queue = queue.Queue(1 if latest_frame_only else queue_size)
+        face_queue = queue.Queue(1 if latest_frame_only else queue_size)
+        stopped = threading.Event()
+        threads = [
+            threading.Thread(target=_read_video_frames, daemon=True, args=(
+                video, frame_queue, stopped, frame_step, latest_frame_only, FaceCropper._COLOUR_CONVERSIONS.get((FaceCropper.BGR, self.colour_order)))),
+            threading.Thread(target=self._detect_video_faces, args=(frame_queue, face_queue, stopped, latest_frame_only), daemon=True)
+        ]
+        for thread in threads: thread.start()
+
+        try:
+            while True:
+                item = _get_from_queue(face_queue, stopped)
+                if item is None: return
+                if isinstance(item, Exception): raise item
+
+                frame_index, timestamp, image, inflated_face_images = item
+                face_images = []
+                for inflated_face_image, face_landmarks in zip(inflated_face_images, self._detect_all_landmarks(inflated_face_images)):
+                    if face_landmarks is None: continue
+                    if self._filters_quality and not self._is_accepted_quality(_get_face_quality(face_landmarks, inflated_face_image.shape)): continue
+                    face_images.append(self._get_face_image(inflated_face_image, remove_background, correct_roll, face_landmarks))
+
+                yield frame_index, timestamp, image, face_images
+        finally:
+            stopped.set()
+            for thread in threads: thread.join()
+            if video is not source: video.release()
+
+
+    def _detect_video_faces(self, frame_queue, face_queue, stopped, latest_frame_only=False):
+        """
+        Take (frame_index, timestamp, image) tuples from a queue, and put (frame_index, timestamp, image, inflated_face_images) tuples in
+        another queue (see _get_inflated_face_images()) until a None or an exception is taken, which is passed on. Meant to be run in a background thread.
+        :param frame_queue: The queue.Queue object to take the frames from.
+        :param face_queue: The queue.Queue object to put the inflated face images in.
+        :param stopped: A threading.Event object which is set when no more frames are needed.
+        :param latest_frame_only: Whether frames waiting in face_queue should be discarded when a newer frame has its faces detected. Defaults to False.
+        """
+
+        try:
+            while True:
+                frame = _get_from_queue(frame_queue, stopped)
+                if frame is None or isinstance(frame, Exception):
+                    _put_in_queue(face_queue, frame, stopped)
+                    return
+
+                frame_index, timestamp, image = frame
+                _put_in_queue(face_queue, (frame_index, timestamp, image, self._get_inflated_face_images(image)), stopped, latest_frame_only)
+        except Exception as exception:
+            _put_in_queue(face_queue, exception, stopped)
+
+
+
+class FaceRecord:
+    """
+    A face detected by FaceCropper.get_face_records(). Holds the geometry of the face, while the cropped face images are computed the first
+    time they are accessed (and then cached):
+        - score: The detection confidence of mp.solutions.face_detection.FaceDetection
+        - face_box: (xmin, ymin, width, height) tuple containing the normalised bounding box from mp.solutions.face_detection.FaceDetection
+        - inflation_factor: The factor the bounding box was inflated by (see _get_bounding_box_inflation_factor())
+        - inflated_bounds: (top, bottom, left, right) tuple containing the inclusive pixel boundaries of the inflated bounding box in the image
+        - landmarks: (n, 3) array containing the landmark coordinates from mp.solutions.face_mesh.FaceMesh, normalised to the inflated bounding box
+        - roll_angle: The roll angle of the face in degrees (see _get_face_roll_angle())
+        - crop_bounds: (top, bottom, left, right) tuple containing the inclusive pixel boundaries in the image of the minimum rectangle spanning
+          all face landmarks (i.e. the crop without roll correction)
+        - quality: A dict containing the quality metrics of the face that FaceCropper's quality thresholds are checked against: its 'score',
+          'face_size', 'yaw_asymmetry', 'pitch_asymmetry' and 'clipped_fraction' (see _get_face_quality())
+    """
+
+    __slots__ = ('face_cropper', 'image', 'score', 'face_box', 'inflation_factor', 'inflated_bounds', 'landmarks', 'roll_angle', 'crop_bounds', 'quality',
+                 '_face_images')
+
+
+    def __init__(self, face_cropper, image, score, face_box, inflation_factor, inflated_bounds, landmarks):
+        """
+        Initialise a FaceRecord object.
+        :param face_cropper: The FaceCropper object that detected the face, used to crop the face images.
+        :param image: The numpy.ndarray RGB image containing the face.
+        :param score: The detection confidence of mp.solutions.face_detection.FaceDetection.
+        :param face_box: (xmin, ymin, width, height) tuple containing the normalised bounding box of the face.
+        :param inflation_factor: The factor the bounding box was inflated by.
+        :param inflated_bounds: (top, bottom, left, right) tuple containing the inclusive pixel boundaries of the inflated bounding box (within the image).
+        :param landmarks: (n, 3) array containing the landmark coordinates of the face, normalised to the inflated bounding box.
+        """
+
+        self.face_cropper = face_cropper
+        self.image = image
+        self.score = score
+        self.face_box = face_box
+        self.inflation_factor = inflation_factor
+        self.inflated_bounds = inflated_bounds
+        self.landmarks = landmarks
+        self.roll_angle = _get_face_roll_angle(*_get_left_and_right_eye_centres(landmarks[_LEFT_EYE_LANDMARK_INDICES], landmarks[_RIGHT_EYE_LANDMARK_INDICES]))
+        self._face_images = {}
+
+        top, bottom, left, right = inflated_bounds
+        crop_top, crop_bottom, crop_left, crop_right = _clip_bounds(
+            (bottom - top + 1, right - left + 1),
+            *_get_landmarks_bounds(np.ndarray.astype(np.rint(_get_landmark_pixel_coordinates(landmarks, (bottom - top + 1, right - left + 1)).T), int)))
+        self.crop_bounds = (top + crop_top, top + crop_bottom, left + crop_left, left + crop_right)
+        self.quality = _get_face_quality(landmarks, (bottom - top + 1, right - left + 1), score)
+
+
+    @property
+    def inflated_face_image(self):
+        """
+        The inflated face crop that landmarks were detected in (a view of the image rather than a copy).
+        """
+
+        return self.image[self.inflated_bounds[0]:self.inflated_bounds[1] + 1, self.inflated_bounds[2]:self.inflated_bounds[3] + 1]
+
+
+    @property
+    def landmark_coordinates(self):
+        """
+        (n, 2) array containing the [x, y] pixel coordinates of the landmarks in the image.
+        """
+
+        return _get_landmark_pixel_coordinates(self.landmarks, self.inflated_face_image.shape) + (self.inflated_bounds[2], self.inflated_bounds[0])
+
+
+    @property
+    def cropped_image(self):
+        """
+        The cropped face, as returned by FaceCropper.get_faces() with remove_background=False and correct_roll=False.
+        """
+
+        return self.get_face_image(remove_background=False, correct_roll=False)
+
+
+    @property
+    def segmented_image(self):
+        """
+        The cropped face with its background removed, as returned by FaceCropper.get_faces() with remove_background=True and correct_roll=False.
+        """
+
+        return self.get_face_image(remove_background=True, correct_roll=False)
+
+
+    @property
+    def roll_corrected_image(self):
+        """
+        The cropped face with its roll corrected, as returned by FaceCropper.get_faces() with remove_background=False and correct_roll=True.
+        """
+
+        return self.get_face_image(remove_background=False, correct_roll=True)
+
+
+    def get_face_image(self, remove_background=False, correct_roll=True, out=None):
+        """
+        Crop out (and optionally correct the roll and/or remove background of) the face, as in FaceCropper.get_faces(). The result is cached.
+        :param remove_background: Whether non-face (i.e. background) pixels should be set to 0. Defaults to False
+        :param correct_roll: Whether the roll in the face should be corrected. Defaults to True
+        :param out: A preallocated numpy.ndarray image to write the cropped face into (see FaceCropper.get_faces()). The result is not cached
+        if specified, as out belongs to the caller. Defaults to None to return it in a new (cached) array.
+        :return: A numpy.ndarray RGB image containing the cropped face
+        """
+
+        if out is not None:
+            return self.face_cropper._get_face_image(self.inflated_face_image, remove_background, correct_roll, self.landmarks, out)
+
+        if (remove_background, correct_roll) not in self._face_images:
+            self._face_images[(remove_background, correct_roll)] = self.face_cropper._get_face_image(
+                self.inflated_face_image, remove_background, correct_roll, self.landmarks)
+
+        return self._face_images[(remove_background, correct_roll)]
+
+
+    def get_face_landmarks(self, correct_roll=True):
+        """
+        :param correct_roll: Whether the roll in the face is corrected (as in get_face_image()). Defaults to True
+        :return: An (n, 2) float64 numpy array containing the [x, y] pixel coordinates of the landmarks in the cropped face image returned by
+        get_face_image() (with the same correct_roll)
+        """
+
+        return self.face_cropper._get_face_landmark_coordinates(self.inflated_face_image.shape, self.landmarks, correct_roll)
+
+
+
+class FaceTracker:
+    """
+    Crops out the faces in a sequence of frames (e.g. a video) using a FaceCropper object, while tracking the faces across frames so that
+    mp.solutions.face_detection.FaceDetection only has to run on some of the frames:
+        1. mp.solutions.face_mesh.FaceMesh is run on the region of interest of each tracked face, i.e. the minimum rectangle spanning its
+           landmarks in the previous frame, inflated to allow for movement. A track is lost if no landmarks are found in its region of interest
+        2. mp.solutions.face_detection.FaceDetection is only run every detection_interval frames, when a track is lost, or when no faces are
+           tracked. Detected faces that are not already tracked are cropped as in FaceCropper.get_faces() and start new tracks
+        3. Each track has an id that stays the same for as long as the face is tracked. If two tracks end up on the same face, the newer one is dropped
+        4. Faces rejected by the quality thresholds of the FaceCropper object (e.g. max_yaw_asymmetry) are still tracked, but not cropped out
+
+    - A FaceTracker object should only be used for one sequence of frames at a time (see reset())
+    """
+
+    def __init__(self, face_cropper, detection_interval=10, roi_inflation=0.5):
+        """
+        Initialise a FaceTracker object.
+        :param face_cropper: The FaceCropper object used to detect faces and landmarks, and crop faces. It should be in FaceCropper.STATIC_MODE,
+        as its mp.solutions.face_mesh.FaceMesh network is run on the regions of interest of different faces.
+        :param detection_interval: The maximum number of frames between runs of mp.solutions.face_detection.FaceDetection. Defaults to 10.
+        :param roi_inflation: The factor by which the rectangle spanning the landmarks of a face is inflated to get its region of interest in
+        the next frame. Larger values allow faster movement, but may include more of other faces. Defaults to 0.5 (50%).
+        """
+
+        self.face_cropper = face_cropper
+        self.detection_interval = detection_interval
+        self.roi_inflation = roi_inflation
+        self.reset()
+
+
+    def reset(self):
+        """
+        Forget all tracked faces, e.g. before processing the frames of a different video.
+        """
+
+        self.tracks = []  # (track_id, landmark_bounds) tuples
+        self.next_track_id = 0
+        self.frames_since_detection = 0
+
+
+    def get_faces(self, image, remove_background=False, correct_roll=True):
+        """
+        Crop out (and optionally correct the roll and/or remove background of) each tracked face in the specified frame, and update the tracks.
+        :param image: A numpy.ndarray RGB image containing the next frame of the sequence
+        :param remove_background: Whether non-face (i.e. background) pixels should be set to 0. Defaults to False
+        :param correct_roll: Whether the roll in faces should be corrected. Defaults to True
+        :return: A list of (track_id, face_image) tuples for the tracked faces accepted by the quality thresholds of the FaceCropper object,
+        where face_image is a numpy.ndarray RGB image containing a cropped face
+        """
+
+        tracked_faces = []  # (track_id, landmark_bounds, face_image) tuples
+
+        for track_id, landmark_bounds in self.tracks:
+            roi_bounds = _clip_bounds(image.shape, *_get_inflated_bounds(landmark_bounds, self.roi_inflation))
+            tracked_face = self._get_face_in_roi(image, roi_bounds, remove_background, correct_roll)
+            if tracked_face is not None: tracked_faces.append((track_id,) + tracked_face)
+
+        self.frames_since_detection += 1
+        if len(tracked_faces) < len(self.tracks) or not tracked_faces or self.frames_since_detection >= self.detection_interval:
+            self.frames_since_detection = 0
+
+            for face_box, inflation_factor, _ in self.face_cropper._detect_faces(image):
+                # Skip faces that are already tracked, i.e. whose detection box contains the centre of a tracked face
+                top, bottom, left, right = _get_inflated_face_bounds(face_box, 0, image.shape)
+                if any(top <= (bounds[0] + bounds[1]) / 2 <= bottom and left <= (bounds[2] + bounds[3]) / 2 <= right for _, bounds, _ in tracked_faces):
+                    continue
+
+                roi_bounds = _clip_bounds(image.shape, *_get_inflated_face_bounds(face_box, inflation_factor, image.shape))
+                tracked_face = self._get_face_in_roi(image, roi_bounds, remove_background, correct_roll)
+                if tracked_face is not None:
+                    tracked_faces.append((self.next_track_id,) + tracked_face)
+                    self.next_track_id += 1
+
+        face_images = []
+        self.tracks = []
+        for track_id, landmark_bounds, face_image in tracked_faces:
+            # Tracks are in ascending order of id, so a track on the same face as an older track is dropped
+            if all(_get_bounds_iou(landmark_bounds, bounds) <= 0.5 for _, bounds in self.tracks):
+                self.tracks.append((track_id, landmark_bounds))
+                if face_image is not None: face_images.append((track_id, face_image))
+
+        return face_images
+
+
+    def _get_face_in_roi(self, image, roi_bounds, remove_background, correct_roll):
+        """
+        Detect the landmarks of the face in a region of interest of an image, and crop the face out of it.
+        :param image: A numpy.ndarray RGB image containing the face
+        :param roi_bounds: (top, bottom, left, right) tuple containing the inclusive pixel boundaries of the region of interest (within the image).
+        :param remove_background: Whether non-face (i.e. background) pixels should be set to 0
+        :param correct_roll: Whether the roll in the face should be corrected
+        :return: A (landmark_bounds, face_image) tuple, where landmark_bounds is a (top, bottom, left, right) tuple containing the pixel boundaries
+        of the minimum rectangle spanning the landmarks in the image, and face_image is None if the face is rejected by the quality thresholds
+        of the FaceCropper object (see FaceCropper._is_accepted_quality()), or None if no landmarks were detected
+        """
+
+        top, bottom, left, right = roi_bounds
+        roi_image = image[top:bottom + 1, left:right + 1]
+
+        face_landmarks = self.face_cropper._detect_landmarks(roi_image)
+        if face_landmarks is None: return None
+
+        landmark_top, landmark_bottom, landmark_left, landmark_right = _get_landmarks_bounds(
+            np.ndarray.astype(np.rint(_get_landmark_pixel_coordinates(face_landmarks, roi_image.shape).T), int))
+        landmark_bounds = (top + landmark_top, top + landmark_bottom, left + landmark_left, left + landmark_right)
+
+        if self.face_cropper._filters_quality and not self.face_cropper._is_accepted_quality(_get_face_quality(face_landmarks, roi_image.shape)):
+            return landmark_bounds, None
+
+        return landmark_bounds, self.face_cropper._get_face_image(roi_image, remove_background, correct_roll, face_landmarks)
+
+
+
+class FaceCropperStats:
+    """
+    Records the time spent in each stage of the pipeline of a FaceCropper object, and counters of the images and faces it processed, e.g. to
+    find out where the time of a slow FaceCropper.get_faces() call went. Pass it to the FaceCropper constructor (or set its stats attribute)
+    to enable recording. The stages are:
+        - detection: mp.solutions.face_detection.FaceDetection (including downscaling the image, see detection_max_side)
+        - landmarks: mp.solutions.face_mesh.FaceMesh, once for each face (including downscaling the face crop, see landmark_max_side)
+        - segmentation: removing the background of a face
+        - roll_correction: correcting the roll of a face and cropping it out (crop if the roll is not corrected)
+        - alignment: the single warp used instead of segmentation and roll_correction when FaceCropper.output_size is specified
+    The counters are:
+        - images: images passed to mp.solutions.face_detection.FaceDetection
+        - faces_detected: faces detected by mp.solutions.face_detection.FaceDetection
+        - faces_out_of_bounds: detected faces ignored because they were outside the image
+        - faces_too_small, faces_overlapping, faces_over_limit: detected faces ignored by FaceCropper's min_face_size, max_face_overlap and max_faces
+        - faces_without_landmarks: faces in which mp.solutions.face_mesh.FaceMesh detected no landmarks
+        - faces_low_quality: faces rejected by FaceCropper's quality thresholds (e.g. max_yaw_asymmetry) after their landmarks were detected
+        - faces_cropped: face images returned
+        - output_pixels: the total number of pixels (height * width) of the face images returned
+        - cache_hits, cache_misses: images whose faces were (or were not) found in FaceCropper.cache
+
+    - Recording takes a lock, so a FaceCropperStats object can be shared by FaceCropper objects in different threads (e.g. FaceCropper.iter_video()),
+      but not across processes (e.g. the workers of a FaceCropperPool)
+    - The totals only ever increase (until reset()), so the average latency of a stage over an interval is the increase of its total seconds
+      divided by the increase of its calls
+    """
+
+    STAGES = ('detection', 'landmarks', 'segmentation', 'roll_correction', 'crop', 'alignment')
+    COUNTERS = ('images', 'faces_detected', 'faces_out_of_bounds', 'faces_too_small', 'faces_overlapping', 'faces_over_limit', 'faces_without_landmarks',
+                'faces_low_quality', 'faces_cropped', 'output_pixels', 'cache_hits', 'cache_misses')
+
+    def __init__(self):
+        """
+        Initialise a FaceCropperStats object with all totals set to 0.
+        """
+
+        self._lock = threading.Lock()
+        self.reset()
+
+
+    def reset(self):
+        """
+        Set all stage times and counters back to 0.
+        """
+
+        with self._lock:
+            self.stage_seconds = dict.fromkeys(FaceCropperStats.STAGES, 0.0)
+            self.stage_calls = dict.fromkeys(FaceCropperStats.STAGES, 0)
+            self.counters = dict.fromkeys(FaceCropperStats.COUNTERS, 0)
+
+
+    def add_stage_time(self, stage, seconds):
+        """
+        Record a run of a stage of the pipeline.
+        :param stage: The name of the stage (see FaceCropperStats.STAGES)
+        :param seconds: The wall time the stage took (in seconds)
+        """
+
+        with self._lock:
+            self.stage_seconds[stage] += seconds
+            self.stage_calls[stage] += 1
+
+
+    def increment(self, counter, value=1):
+        """
+        Increase a counter.
+        :param counter: The name of the counter (see FaceCropperStats.COUNTERS)
+        :param value: The amount to increase the counter by. Defaults to 1
+        """
+
+        with self._lock:
+            self.counters[counter] += value
+
+
+    def get_snapshot(self):
+        """
+        :return: A dict containing a copy of the 'stage_seconds', 'stage_calls' and 'counters' dicts, taken at the same time
+        """
+
+        with self._lock:
+            return {'stage_seconds': dict(self.stage_seconds), 'stage_calls': dict(self.stage_calls), 'counters': dict(self.counters)}
+
+
+    def get_metrics_text(self, prefix='face_cropper'):
+        """
+        Format the totals in the Prometheus text exposition format, e.g. to be served to, or collected from a file by, a metrics scraper.
+        :param prefix: The prefix of the metric names. Defaults to 'face_cropper'
+        :return: A string containing a <prefix>_stage_seconds_total and a <prefix>_stage_calls_total metric labelled with each stage, and
+        a <prefix>_<counter>_total metric for each counter
+        """
+
+        snapshot = self.get_snapshot()
+        lines = []
+
+        for metric, help_text in (('stage_seconds', 'Total wall time spent in each stage of the pipeline.'),
+                                  ('stage_calls', 'Total number of runs of each stage of the pipeline.')):
+            lines.append('# HELP {}_{}_total {}'.format(prefix, metric, help_text))
+            lines.append('# TYPE {}_{}_total counter'.format(prefix, metric))
+            for stage, value in snapshot[metric].items():
+                lines.append('{}_{}_total{{stage="{}"}} {}'.format(prefix, metric, stage, value))
+
+        for counter, value in snapshot['counters'].items():
+            lines.append('# TYPE {}_{}_total counter'.format(prefix, counter))
+            lines.append('{}_{}_total {}'.format(prefix, counter, value))
+
+        return '\n'.join(lines) + '\n'
+
+
+    def write_metrics_file(self, path, prefix='face_cropper'):
+        """
+        Write the totals to a file in the Prometheus text exposition format (see get_metrics_text()), e.g. for the textfile collector of the
+        Prometheus node exporter. The file is replaced atomically, so it is never read half written.
+        :param path: The path of the file
+        :param prefix: The prefix of the metric names. Defaults to 'face_cropper'
+        """
+
+        temporary_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temporary_path, 'w') as metrics_file:
+            metrics_file.write(self.get_metrics_text(prefix))
+        os.replace(temporary_path, path)
+
+
+
+class FaceCache:
+    """
+    Stores the faces detected in images by FaceCropper.get_face_records() (their detection scores, bounding boxes and landmarks, rather than the
+    cropped faces), so that images seen again are cropped without running the MediaPipe networks, under any remove_background and correct_roll.
+        - In memory, the most recently used entries are kept up to max_memory_bytes
+        - If a directory is specified, entries are also stored in it as <key>.npz files, and the least recently used files are deleted when
+          they take up more than max_disk_bytes. Entries evicted from memory are loaded from the directory when they are needed again
+
+    - The directory can be shared by the FaceCache objects of several processes (files are written atomically), although each process only
+      keeps track of the disk usage of the files it knows about
+    """
+
+    # The approximate memory used by an entry in addition to its landmark arrays
+    _ENTRY_OVERHEAD_BYTES = 256
+    _FACE_OVERHEAD_BYTES = 512
+
+    def __init__(self, max_memory_bytes=64 * 1024 * 1024, directory=None, max_disk_bytes=1024 * 1024 * 1024):
+        """
+        Initialise a FaceCache object.
+        :param max_memory_bytes: The maximum (approximate) memory used by the entries kept in memory. Defaults to 64 MiB.
+        :param directory: The path of a directory to store entries in, which is created if it doesn't exist. Defaults to None to only keep entries in memory.
+        :param max_disk_bytes: The maximum total size of the files in the directory. Defaults to 1 GiB.
+        """
+
+        self.max_memory_bytes = max_memory_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+
+        self._lock = threading.Lock()
+        self._memory_entries = collections.OrderedDict()  # key: (faces, size) in least to most recently used order
+        self.memory_bytes = 0
+
+        self.disk_bytes = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            with os.scandir(directory) as directory_entries:
+                self.disk_bytes = sum(entry.stat().st_size for entry in directory_entries if entry.name.endswith('.npz'))
+
+
+    def get(self, key):
+        """
+        Get the faces stored under a key.
+        :param key: The key of an image (see FaceCropper._get_cache_key())
+        :return: A list of (score, face_box, inflation_factor, inflated_bounds, landmarks) tuples (see FaceRecord), or None if the key isn't cached
+        """
+
+        with self._lock:
+            if key in self._memory_entries:
+                self._memory_entries.move_to_end(key)
+                return self._memory_entries[key][0]
+
+        if self.directory is None: return None
+
+        path = os.path.join(self.directory, key + '.npz')
+        try:
+            with np.load(path) as arrays:
+                faces = [(float(score), tuple(float(value) for value in face_box), float(inflation_factor), tuple(int(bound) for bound in inflated_bounds), landmarks)
+                         for score, face_box, inflation_factor, inflated_bounds, landmarks in zip(
+                             arrays['scores'], arrays['face_boxes'], arrays['inflation_factors'], arrays['inflated_bounds'], arrays['landmarks'])]
+            os.utime(path)  # Mark the file as recently used
+        except (OSError, KeyError, ValueError):
+            return None  # The file doesn't exist, was evicted, or is damaged
+
+        with self._lock: self._put_in_memory(key, faces)
+        return faces
+
+
+    def put(self, key, faces):
+        """
+        Store faces under a key.
+        :param key: The key of an image (see FaceCropper._get_cache_key())
+        :param faces: A list of (score, face_box, inflation_factor, inflated_bounds, landmarks) tuples (see FaceRecord)
+        """
+
+        with self._lock: self._put_in_memory(key, faces)
+        if self.directory is None: return
+
+        path = os.path.join(self.directory, key + '.npz')
+        temporary_path = '{}.{}.{}.tmp.npz'.format(path[:-4], os.getpid(), threading.get_ident())
+        np.savez(
+            temporary_path,
+            scores=np.array([face[0] for face in faces], dtype=np.float64),
+            face_boxes=np.array([face[1] for face in faces], dtype=np.float64).reshape((-1, 4)),
+            inflation_factors=np.array([face[2] for face in faces], dtype=np.float64),
+            inflated_bounds=np.array([face[3] for face in faces], dtype=np.int64).reshape((-1, 4)),
+            landmarks=np.array([face[4] for face in faces], dtype=np.float32) if faces else np.zeros((0, 0, 3), dtype=np.float32)
+        )
+        file_size = os.path.getsize(temporary_path)
+
+        with self._lock:
+            # A file replaced for the same key no longer takes up space
+            try:
+                file_size -= os.path.getsize(path)
+            except OSError:
+                pass
+            os.replace(temporary_path, path)
+
+            self.disk_bytes += file_size
+            if self.disk_bytes > self.max_disk_bytes: self._evict_from_disk()
+
+
+    def clear(self):
+        """
+        Remove all entries from memory and from the directory.
+        """
+
+        with self._lock:
+            self._memory_entries.clear()
+            self.memory_bytes = 0
+            if self.directory is not None:
+                for file_name in os.listdir(self.directory):
+                    if file_name.endswith('.npz'): os.remove(os.path.join(self.directory, file_name))
+                self.disk_bytes = 0
+
+
+    def _put_in_memory(self, key, faces):
+        """
+        Store faces under a key in memory, evicting the least recently used entries if needed. Must be called with the lock held.
+        """
+
+        if key in self._memory_entries: self.memory_bytes -= self._memory_entries.pop(key)[1]
+
+        size = FaceCache._ENTRY_OVERHEAD_BYTES + sum(FaceCache._FACE_OVERHEAD_BYTES + face[4].nbytes for face in faces)
+        self._memory_entries[key] = (faces, size)
+        self.memory_bytes += size
+
+        while self.memory_bytes > self.max_memory_bytes and self._memory_entries:
+            self.memory_bytes -= self._memory_entries.popitem(last=False)[1][1]
+
+
+    def _evict_from_disk(self):
+        """
+        Delete the least recently used files in the directory until they take up at most 90% of max_disk_bytes (so that evictions, which list
+        the directory, are not needed on every put()). Must be called with the lock held.
+        """
+
+        with os.scandir(self.directory) as directory_entries:
+            files = sorted((entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in directory_entries if entry.name.endswith('.npz'))
+
+        self.disk_bytes = sum(file_size for _, file_size, _ in files)
+        for _, file_size, path in files:
+            if self.disk_bytes <= 0.9 * self.max_disk_bytes: break
+            try:
+                os.remove(path)
+            except OSError:
+                pass  # Already removed (e.g. by another process)
+            self.disk_bytes -= file_size
+
+
+
+def _get_face_output_image(face_output):
+    """
+    :param face_output: An output of FaceCropper.get_faces() for a face, i.e. an image or an (image, mask) tuple (see mask_format in FaceCropper.__init__())
+    :return: The numpy.ndarray RGB (or RGBA) image of the face
+    """
+
+    return face_output[0] if isinstance(face_output, tuple) else face_output
+
+
+def _get_rgb_image(image, colour_order):
+    """
+    Convert an image (or a face image, whose alpha channel is dropped) to RGB.
+    :param image: A numpy.ndarray image
+    :param colour_order: The colour order of the image (see colour_order in FaceCropper.__init__())
+    :return: A numpy.ndarray RGB image (a view of the image if it already is RGB)
+    """
+
+    if image.ndim == 3 and image.shape[2] in (2, 4): image = image[:, :, :-1]
+    if colour_order == FaceCropper.RGB: return image
+
+    return cv2.cvtColor(image, FaceCropper._COLOUR_CONVERSIONS[(colour_order, FaceCropper.RGB)])
+
+
+def render_debug_images(image, debug_record, face_images=()):
+    """
+    Render the intermediate results of the pipeline recorded by a DebugCapture object (or FaceCropper.get_faces_debug()) as annotated images.
+    :param image: The numpy.ndarray RGB image the faces were cropped from
+    :param debug_record: The debug record of the image (see FaceCropper._get_faces_and_debug_record())
+    :param face_images: A list of numpy.ndarray RGB images containing the cropped faces. Defaults to ()
+    :return: A dict of numpy.ndarray RGB images:
+        - 'image_debug': The image annotated with the face detection boxes (green, or grey if the face was ignored), eye keypoints and
+          approximate roll angle from mp.solutions.face_detection.FaceDetection, inflation factors, and inflated face detection boxes (blue)
+        - 'face_<i>_debug': The inflated face crop of the i-th kept face annotated with its landmarks (eye landmarks in red), eye centres, eyes
+          midpoint, and roll angle, next to its cropped face (if landmarks were detected and the face was not rejected by the quality thresholds)
+    """
+
+    debug_images = {}
+    image_debug = image.copy()
+    height, width = image.shape[:2]
+
+    for detection in debug_record['detections']:
+        xmin, ymin, box_width, box_height = detection['face_box']
+        (right_eye_x, right_eye_y), (left_eye_x, left_eye_y) = detection['eye_keypoints']
+        colour = (0, 255, 0) if detection['kept'] else (128, 128, 128)
+
+        # Face detection box, eye keypoints, roll line and horizontal line
+        cv2.rectangle(image_debug, (round(xmin * width), round(ymin * height)), (round((xmin + box_width) * width), round((ymin + box_height) * height)), colour)
+        for eye_x, eye_y in detection['eye_keypoints']: cv2.circle(image_debug, (round(eye_x * width), round(eye_y * height)), 1, colour)
+        cv2.line(image_debug, (round(right_eye_x * width), round(right_eye_y * height)), (round(left_eye_x * width), round(left_eye_y * height)), (255, 0, 0))
+        cv2.line(image_debug, (round(right_eye_x * width), round(right_eye_y * height)), (round(left_eye_x * width), round(right_eye_y * height)), (255, 0, 0))
+
+        # Roll angle and inflation factor
+        cv2.putText(image_debug, 'roll_angle: {:.2f}'.format(detection['roll_angle']), (round(right_eye_x * width), round(right_eye_y * height + 40)),
+                    cv2.FONT_HERSHEY_PLAIN, 1, (255, 0, 255))
+        cv2.putText(image_debug, 'inflation_factor: {:.2f}'.format(detection['inflation_factor']),
+                    (round(right_eye_x * width), round(right_eye_y * height + 80)), cv2.FONT_HERSHEY_PLAIN, 1, (255, 0, 255))
+
+    face_images = iter(face_images)
+    for i, face in enumerate(debug_record['faces']):
+        top, bottom, left, right = face['inflated_bounds']
+        cv2.rectangle(image_debug, (left, top), (right, bottom), (0, 0, 255))
+        if face['landmarks'] is None: continue
+
+        inflated_face_image_debug = image[top:bottom + 1, left:right + 1].copy()
+        face_landmarks = np.array(face['landmarks'], dtype=np.float32)
+        inflated_size = inflated_face_image_debug.shape
+
+        # Landmarks (eye landmarks in red)
+        eye_landmark_indices = set(_LEFT_EYE_LANDMARK_INDICES) | set(_RIGHT_EYE_LANDMARK_INDICES)
+        for j, landmark in enumerate(np.rint(_get_landmark_pixel_coordinates(face_landmarks, inflated_size)).astype(int)):
+            cv2.circle(inflated_face_image_debug, tuple(landmark.tolist()), 1, (255, 0, 0) if j in eye_landmark_indices else (0, 255, 0))
+
+        # Eye centres, eyes midpoint, roll line and roll angle
+        left_eye_centre, right_eye_centre = _get_left_and_right_eye_centres(face_landmarks[_LEFT_EYE_LANDMARK_INDICES], face_landmarks[_RIGHT_EYE_LANDMARK_INDICES])
+        eye_centres = [(round(eye_centre[0] * inflated_size[1]), round((1 - eye_centre[1]) * inflated_size[0])) for eye_centre in (left_eye_centre, right_eye_centre)]
+        for eye_centre in eye_centres: cv2.circle(inflated_face_image_debug, eye_centre, 2, (255, 255, 0))
+        eyes_midpoint = _get_eyes_midpoint(left_eye_centre, right_eye_centre, inflated_size)
+        cv2.circle(inflated_face_image_debug, (int(eyes_midpoint[0]), int(inflated_size[0] - eyes_midpoint[1])), 2, (0, 0, 255))
+        cv2.line(inflated_face_image_debug, eye_centres[0], eye_centres[1], (255, 0, 0))
+        cv2.putText(inflated_face_image_debug, 'roll_angle: {:.2f}'.format(face['roll_angle']), (eye_centres[1][0], eye_centres[1][1] + 20),
+                    cv2.FONT_HERSHEY_PLAIN, 1, (255, 0, 255))
+
+        if face.get('rejected'):
+            cv2.putText(inflated_face_image_debug, 'rejected (quality)', (eye_centres[1][0], eye_centres[1][1] + 40), cv2.FONT_HERSHEY_PLAIN, 1,
+                        (255, 0, 0))
+
+        # Faces rejected by the quality thresholds were not cropped
+        face_image = next(face_images, None) if face.get('face_image_size') is not None else None
+        if face_image is not None:
+            face_image = _get_face_output_image(face_image)[:, :, :3]
+            # Place the cropped face next to the inflated face crop
+            output_height = max(inflated_size[0], face_image.shape[0])
+            inflated_face_image_debug = np.column_stack((
+                cv2.copyMakeBorder(inflated_face_image_debug, 0, output_height - inflated_size[0], 0, 0, cv2.BORDER_CONSTANT),
+                cv2.copyMakeBorder(face_image, 0, output_height - face_image.shape[0], 0, 0, cv2.BORDER_CONSTANT)
+            ))
+
+        debug_images['face_{}_debug'.format(i)] = inflated_face_image_debug
+
+    debug_images['image_debug'] = image_debug
+    return debug_images
+
+
+class DebugCapture:
+    """
+    Records the intermediate results of a sample of FaceCropper.get_faces() calls (detection boxes, eye keypoints, inflation factors, landmarks,
+    roll angles), to debug bad crops in production without a display. Pass it to the FaceCropper constructor. The sampled calls take the normal
+    path of the pipeline, while their record, image and cropped faces are written in a background thread to <directory>/<capture id>/:
+        - record.json: The debug record (see FaceCropper._get_faces_and_debug_record())
+        - image.png and face_<i>.png: The image and the cropped faces
+    Annotated images are only rendered on demand, e.g. with render_debug_images(*DebugCapture.load(capture_directory)).
+
+    - At most max_pending captures are waiting to be written at a time. Further sampled calls are not captured (and are counted in dropped),
+      so writing never slows down get_faces()
+    - close() waits for the pending captures to be written
+    """
+
+    def __init__(self, directory, sample_rate=0.01, max_pending=8):
+        """
+        Initialise a DebugCapture object.
+        :param directory: The path of the directory to write captures to, which is created if it doesn't exist.
+        :param sample_rate: The fraction of get_faces() calls (between 0 and 1) that are captured, chosen at random. Defaults to 0.01 (1%).
+        :param max_pending: The maximum number of captures waiting to be written. Defaults to 8.
+        """
+
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.max_pending = max_pending
+        self.captured = 0
+        self.dropped = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._random = random.Random()
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._closed = False
+        self._executor = concurrent.futures.ThreadPoolExecutor(1, 'DebugCapture')
+
+
+    def is_sampled(self):
+        """
+        :return: Whether the next call should be captured
+        """
+
+        return self._random.random() < self.sample_rate
+
+
+    def submit(self, image, debug_record, face_images):
+        """
+        Write a capture in the background, unless max_pending captures are already waiting to be written.
+        :param image: The numpy.ndarray RGB image the faces were cropped from. It is copied, so it can be modified after this returns
+        :param debug_record: The debug record of the image (see FaceCropper._get_faces_and_debug_record())
+        :param face_images: A list of numpy.ndarray RGB images containing the cropped faces (or other outputs of FaceCropper.get_faces(), see
+        mask_format in FaceCropper.__init__(), whose images are written without their masks)
+        :return: The path of the directory the capture is written to, or None if it was dropped
+        """
+
+        with self._lock:
+            if self._pending >= self.max_pending or self._closed:
+                self.dropped += 1
+                return None
+            self._pending += 1
+            self.captured += 1
+            # The random suffix keeps the captures of different processes (and DebugCapture objects) sharing the directory apart
+            capture_directory = os.path.join(self.directory, '{}_{:06d}_{}'.format(time.strftime('%Y%m%d-%H%M%S'), self.captured, uuid.uuid4().hex[:8]))
+
+        self._executor.submit(self._write, capture_directory, image.copy(), debug_record,
+                              [_get_face_output_image(face_image)[:, :, :3].copy() for face_image in face_images])
+        return capture_directory
+
+
+    def _write(self, capture_directory, image, debug_record, face_images):
+        """
+        Write a capture to a directory (see submit()).
+        """
+
+        # Images are stored losslessly, but with the fastest PNG compression to take as little CPU time as possible from the pipeline
+        parameters = [cv2.IMWRITE_PNG_COMPRESSION, 1]
+
+        try:
+            os.makedirs(capture_directory, exist_ok=True)
+            cv2.imwrite(os.path.join(capture_directory, 'image.png'), cv2.cvtColor(image, cv2.COLOR_RGB2BGR), parameters)
+            for i, face_image in enumerate(face_images):
+                cv2.imwrite(os.path.join(capture_directory, 'face_{}.png'.format(i)), cv2.cvtColor(face_image, cv2.COLOR_RGB2BGR), parameters)
+            # The record is written last, so a capture with a record.json is complete
+            with open(os.path.join(capture_directory, 'record.json'), 'w') as record_file:
+                json.dump(debug_record, record_file)
+        finally:
+            with self._lock: self._pending -= 1
+
+
+    def close(self):
+        """
+        Wait for the pending captures to be written. Later calls are no longer captured.
+        """
+
+        with self._lock: self._closed = True
+        self._executor.shutdown()
+
+
+    @staticmethod
+    def load(capture_directory):
+        """
+        Read a capture written by a DebugCapture object.
+        :param capture_directory: The path of the directory of the capture
+        :return: An (image, debug_record, face_images) tuple, which can be passed to render_debug_images()
+        """
+
+        with open(os.path.join(capture_directory, 'record.json')) as record_file:
+            debug_record = json.load(record_file)
+
+        image = cv2.cvtColor(cv2.imread(os.path.join(capture_directory, 'image.png')), cv2.COLOR_BGR2RGB)
+        face_images = []
+        while os.path.exists(os.path.join(capture_directory, 'face_{}.png'.format(len(face_images)))):
+            face_images.append(cv2.cvtColor(cv2.imread(os.path.join(capture_directory, 'face_{}.png'.format(len(face_images)))), cv2.COLOR_BGR2RGB))
+
+        return image, debug_record, face_images
+
+
+
+# The FaceCropper object of a FaceCropperPool worker process (each worker process has its own)
+_worker_face_cropper = None
+
+
+def _initialise_worker(face_cropper_kwargs):
+    """
+    Initialise the FaceCropper object of a FaceCropperPool worker process.
+    :param face_cropper_kwargs: Keyword arguments to pass to the FaceCropper constructor.
+    """
+
+    global _worker_face_cropper
+    _worker_face_cropper = FaceCropper(**face_cropper_kwargs)
+
+
+def _map_in_worker(function, chunk, return_exceptions=False):
+    """
+    Call a function on each item of a chunk of tasks in a FaceCropperPool worker process.
+    :param function: The function to call (e.g. _get_faces_in_worker)
+    :param chunk: A list of the arguments of each call
+    :param return_exceptions: Whether an exception raised by a call should be returned as its output, rather than failing the whole chunk.
+    Defaults to False
+    :return: A list of the outputs of the calls
+    """
+
+    if not return_exceptions: return [function(args) for args in chunk]
+
+    outputs = []
+    for args in chunk:
+        try:
+            outputs.append(function(args))
+        except Exception as exception:
+            outputs.append(exception)
+
+    return outputs
+
+
+def _get_faces_in_worker(args):
+    """
+    Call get_faces() on the FaceCropper object of a FaceCropperPool worker process.
+    :param args: (image, remove_background, correct_roll) tuple of arguments to pass to get_faces().
+    :return: The output of get_faces().
+    """
+
+    return _worker_face_cropper.get_faces(*args)
+
+
+def _get_faces_and_geometry_in_worker(args):
+    """
+    Crop the faces out of an image with the FaceCropper object of a FaceCropperPool worker process, along with their geometry.
+    :param args: (image, remove_background, correct_roll) tuple of arguments to pass to get_face_records() and FaceRecord.get_face_image().
+    :return: A list containing a (face_image, geometry) tuple for each face (see FaceCropperPool.get_faces_and_geometry()).
+    """
+
+    image, remove_background, correct_roll = args
+
+    return [(face_record.get_face_image(remove_background, correct_roll), {
+        'face_box': face_record.face_box,
+        'roll_angle': face_record.roll_angle,
+        'landmarks': face_record.get_face_landmarks(correct_roll)
+    }) for face_record in _worker_face_cropper.get_face_records(image)]
+
+
+class FaceCropperPool:
+    """
+    Crops faces from many images in parallel using a pool of worker processes, each with its own FaceCropper object (the
+    mp.solutions.face_detection.FaceDetection and mp.solutions.face_mesh.FaceMesh networks of a FaceCropper object can't be shared).
+
+    - Images (and the cropped faces) are sent between processes in chunks of chunk_size images to reduce the overhead of inter-process
+      communication. Larger chunks have less overhead, but the images of a chunk are held in memory until the whole chunk is done
+
+    - At most 2 chunks per worker process are sent ahead of the results read by the caller, so images supplied lazily (e.g. by a generator)
+      are only read as fast as they are cropped
+
+    - Worker processes are spawned (i.e. they import the __main__ module), so the pool must be created inside an if __name__ == '__main__': block
+
+    - Can be used as a context manager, which closes the pool on exit
+    """
+
+    def __init__(self, workers=None, chunk_size=8, **face_cropper_kwargs):
+        """
+        Initialise a FaceCropperPool object.
+        :param workers: The number of worker processes. Defaults to None to use the number of CPUs.
+        :param chunk_size: The number of images sent to a worker process at a time. Defaults to 8.
+        :param face_cropper_kwargs: Keyword arguments to pass to the FaceCropper constructor of each worker process, e.g. min_face_detector_confidence.
+        """
+
+        self.chunk_size = chunk_size
+        self.max_pending_chunks = 2 * (workers or os.cpu_count() or 1)
+        # Worker processes are spawned rather than forked, as forking a process with running MediaPipe graphs (e.g. one that has
+        # created a FaceCropper object) can corrupt the state of the worker processes
+        self.pool = multiprocessing.get_context('spawn').Pool(workers, initializer=_initialise_worker, initargs=(face_cropper_kwargs,))
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def iter_faces(self, images, remove_background=False, correct_roll=True, return_exceptions=False):
+        """
+        Identical to get_faces(), except the cropped faces of each image are yielded (in input order) as soon as they are available, so
+        images can be supplied lazily (e.g. from a generator reading them from disk) without holding all of them in memory.
+        :param images: An iterable of numpy.ndarray RGB images containing faces to be cropped
+        :param remove_background: Whether non-face (i.e. background) pixels should be set to 0. Defaults to False
+        :param correct_roll: Whether the roll in faces should be corrected. Defaults to True
+        :param return_exceptions: Whether an exception raised while cropping an image should be yielded in place of its faces, rather than
+        raised (failing the rest of the images). Defaults to False
+        :return: A generator yielding a list of numpy.ndarray RGB images containing the cropped faces for each image
+        """
+
+        yield from self._iter_tasks(_get_faces_in_worker, ((image, remove_background, correct_roll) for image in images), return_exceptions)
+
+
+    def get_faces(self, images, remove_background=False, correct_roll=True, return_exceptions=False):
+        """
+        Crop out (and optionally correct the roll and/or remove background of) each detected face in each of the specified images.
+        :param images: An iterable of numpy.ndarray RGB images containing faces to be cropped
+        :param remove_background: Whether non-face (i.e. background) pixels should be set to 0. Defaults to False
+        :param correct_roll: Whether the roll in faces should be corrected. Defaults to True
+        :param return_exceptions: Whether an exception raised while cropping an image should be returned in place of its faces, rather than
+        raised. Defaults to False
+        :return: A list containing a list of numpy.ndarray RGB images with the cropped faces for each image (in the same order as the images)
+        """
+
+        return list(self.iter_faces(images, remove_background, correct_roll, return_exceptions))
+
+
+    def iter_faces_and_geometry(self, images, remove_background=False, correct_roll=True, return_exceptions=False):
+        """
+        Identical to get_faces_and_geometry(), except the faces of each image are yielded as soon as they are available (see iter_faces()).
+        :param images: An iterable of numpy.ndarray images containing faces to be cropped
+        :param remove_background: Whether non-face (i.e. background) pixels should be set to 0. Defaults to False
+        :param correct_roll: Whether the roll in faces should be corrected. Defaults to True
+        :param return_exceptions: Whether an exception raised while cropping an image should be yielded in place of its faces, rather than
+        raised. Defaults to False
+        :return: A generator yielding a list with a (face_image, geometry) tuple for each face of each image (see get_faces_and_geometry())
+        """
+
+        yield from self._iter_tasks(_get_faces_and_geometry_in_worker, ((image, remove_background, correct_roll) for image in images),
+                                    return_exceptions)
+
+
+    def get_faces_and_geometry(self, images, remove_background=False, correct_roll=True, return_exceptions=False):
+        """
+        Identical to get_faces(), except the geometry of each face is returned along with it (e.g. to append the faces to a FaceDataset).
+        :param images: An iterable of numpy.ndarray images containing faces to be cropped
+        :param remove_background: Whether non-face (i.e. background) pixels should be set to 0. Defaults to False
+        :param correct_roll: Whether the roll in faces should be corrected. Defaults to True
+        :param return_exceptions: Whether an exception raised while cropping an image should be returned in place of its faces, rather than
+        raised. Defaults to False
+        :return: A list containing, for each image, a list with a (face_image, geometry) tuple for each face, where geometry is a dict with the
+        normalised detection 'face_box' and the 'roll_angle' of the face (see FaceRecord), and the 'landmarks' of the face in face_image (see
+        FaceRecord.get_face_landmarks())
+        """
+
+        return list(self.iter_faces_and_geometry(images, remove_background, correct_roll, return_exceptions))
+
+
+    def _iter_tasks(self, function, tasks, return_exceptions=False):
+        """
+        Run a function on each task in the worker processes, sending the tasks in chunks of chunk_size tasks, with at most max_pending_chunks
+        chunks sent ahead of the outputs yielded (multiprocessing.Pool.imap() would read the whole iterable of tasks straight away).
+        :param function: The function to call on each task in the worker processes (e.g. _get_faces_in_worker)
+        :param tasks: An iterable of the arguments of each call
+        :param return_exceptions: Whether an exception raised by a call should be yielded as its output (see _map_in_worker()). Defaults to False
+        :return: A generator yielding the output of each call (in the order of the tasks)
+        """
+
+        pending_chunks = collections.deque()
+        task_iterator = iter(tasks)
+
+        while True:
+            while len(pending_chunks) < self.max_pending_chunks:
+                chunk = list(itertools.islice(task_iterator, self.chunk_size))
+                if not chunk: break
+                pending_chunks.append(self.pool.apply_async(_map_in_worker, (function, chunk, return_exceptions)))
+
+            if not pending_chunks: return
+            yield from pending_chunks.popleft().get()
+
+
+    def close(self):
+        """
+        Wait for the worker processes to finish their work and close them.
+        """
+
+        self.pool.close()
+        self.pool.join()
+
+
+
+class AsyncFaceCropper:
+    """
+    Crops faces from images in an asyncio event loop without blocking it, using a bounded pool of FaceCropper objects, each confined to its
+    own thread (the mp.solutions.face_detection.FaceDetection and mp.solutions.face_mesh.FaceMesh networks of a FaceCropper object can't
+    be used from several threads at once). MediaPipe and OpenCV release the GIL while they run, so several FaceCropper objects process
+    images concurrently within one process.
+
+    - Each call of get_faces() waits for an idle FaceCropper object, so at most `instances` images are processed at a time. At most
+      max_pending calls can be in progress (waiting or processing) at a time, beyond which get_faces() raises asyncio.QueueFull, so
+      callers can shed load instead of queueing unbounded work
+
+    - Cancelling get_faces() (e.g. with a timeout) before its image is processed frees its place immediately. An image that is already being
+      processed can't be interrupted, so its FaceCropper object only becomes idle again when it is done
+
+    - Can be used from several event loops one after another (e.g. successive asyncio.run() calls), but not from several at once
+
+    - Can be used as an asynchronous context manager, which closes it on exit
+    """
+
+    def __init__(self, instances=2, max_pending=None, **face_cropper_kwargs):
+        """
+        Initialise an AsyncFaceCropper object. Blocks while the FaceCropper objects are created in their threads.
+        :param instances: The number of FaceCropper objects (and threads). Defaults to 2.
+        :param max_pending: The maximum number of get_faces() calls in progress at a time. Defaults to None for 4 * instances.
+        :param face_cropper_kwargs: Keyword arguments to pass to the FaceCropper constructor of each instance, e.g. min_face_detector_confidence.
+        """
+
+        self.max_pending = 4 * instances if max_pending is None else max_pending
+        self.pending = 0
+        self.closed = False
+
+        self._executors = [concurrent.futures.ThreadPoolExecutor(1, 'AsyncFaceCropper-{}'.format(i)) for i in range(instances)]
+        self._face_croppers = [executor.submit(FaceCropper, **face_cropper_kwargs).result() for executor in self._executors]
+        self._idle_instances = None  # (event loop, asyncio.Queue of the indices of idle instances) tuple, see _get_idle_instances()
+
+
+    async def __aenter__(self):
+        return self
+
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+
+    async def get_faces(self, image, remove_background=False, correct_roll=True, timeout=None):
+        """
+        Crop out (and optionally correct the roll and/or remove background of) each detected face in the specified image in one of the
+        FaceCropper threads (see FaceCropper.get_faces()).
+        :param image: A numpy.ndarray RGB image containing faces to be cropped. It should not be modified until the call returns
+        :param remove_background: Whether non-face (i.e. background) pixels should be set to 0. Defaults to False
+        :param correct_roll: Whether the roll in faces should be corrected. Defaults to True
+        :param timeout: The maximum number of seconds to wait for the faces (including waiting for an idle FaceCropper object), after which
+        asyncio.TimeoutError is raised. Defaults to None to wait indefinitely
+        :return: A list of numpy.ndarray RGB images containing the cropped faces
+        """
+
+        if self.closed: raise RuntimeError('AsyncFaceCropper is closed')
+        if self.pending >= self.max_pending: raise asyncio.QueueFull('{} get_faces() calls are already in progress'.format(self.pending))
+
+        self.pending += 1
+        try:
+            return await asyncio.wait_for(self._get_faces(image, remove_background, correct_roll), timeout)
+        finally:
+            self.pending -= 1
+
+
+    async def _get_faces(self, image, remove_background, correct_roll):
+        """
+        Wait for an idle FaceCropper object and call its get_faces() in its thread (see get_faces()).
+        """
+
+        idle_instances = self._get_idle_instances()
+        index = await idle_instances.get()
+        loop = asyncio.get_running_loop()
+
+        try:
+            future = self._executors[index].submit(self._face_croppers[index].get_faces, image, remove_background, correct_roll)
+        except BaseException:
+            idle_instances.put_nowait(index)
+            raise
+
+        # The instance is only idle again once its thread is done with the image, even if this call is cancelled before then
+        def release_instance(_):
+            try:
+                loop.call_soon_threadsafe(idle_instances.put_nowait, index)
+            except RuntimeError:
+                pass  # The event loop was closed before the image was done
+
+        future.add_done_callback(release_instance)
+
+        return await asyncio.wrap_future(future)
+
+
+    def _get_idle_instances(self):
+        """
+        Get the queue of the indices of idle instances for the running event loop. An asyncio.Queue object can only be used by one event loop,
+        so a new queue (with every instance idle) is created whenever the event loop changes. An instance still processing an image of a
+        previous event loop then processes its next image once it is done, as each instance has a single thread.
+        :return: The asyncio.Queue of the indices of idle instances
+        """
+
+        loop = asyncio.get_running_loop()
+        if self._idle_instances is None or self._idle_instances[0] is not loop:
+            idle_instances = asyncio.Queue()
+            for index in range(len(self._face_croppers)): idle_instances.put_nowait(index)
+            self._idle_instances = (loop, idle_instances)
+
+        return self._idle_instances[1]
+
+
+    async def close(self):
+        """
+        Stop accepting images, wait for the images being processed to finish, and close the FaceCropper objects (see FaceCropper.close()).
+        """
+
+        if self.closed: return
+        self.closed = True
+
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(executor, face_cropper.close)
+                               for executor, face_cropper in zip(self._executors, self._face_croppers)))
+        for executor in self._executors: executor.shutdown()
+
+
+
+# Length prefix of the JSON messages sent over the socket of a FaceCropperServer (a big-endian unsigned 32-bit integer), and the
+# maximum length of a message
+_MESSAGE_HEADER = struct.Struct('>I')
+_MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+
+# Alignment (in bytes) of the arrays written into a shared memory segment by _write_shared_arrays()
+_SHARED_ARRAY_ALIGNMENT = 64
+
+# Directory of the shared memory segments (see multiprocessing.shared_memory) on Linux, and the maximum number of segments a
+# FaceCropperServer worker process keeps attached
+_SHARED_MEMORY_DIRECTORY = '/dev/shm'
+_MAX_ATTACHED_SEGMENTS = 64
+
+
+def _send_message(connection, message):
+    """
+    Send a length-prefixed JSON message over a socket.
+    :param connection: The socket.socket object.
+    :param message: A JSON serialisable object.
+    """
+
+    data = json.dumps(message).encode()
+    connection.sendall(_MESSAGE_HEADER.pack(len(data)) + data)
+
+
+def _receive_exactly(connection, size):
+    """
+    Receive the specified number of bytes from a socket.
+    :param connection: The socket.socket object.
+    :param size: The number of bytes.
+    :return: A bytearray, or None if the connection was closed first.
+    """
+
+    data = bytearray(size)
+    view = memoryview(data)
+    while view:
+        received = connection.recv_into(view)
+        if received == 0: return None
+        view = view[received:]
+
+    return data
+
+
+def _receive_message(connection):
+    """
+    Receive a message sent with _send_message() from a socket.
+    :param connection: The socket.socket object.
+    :return: The JSON deserialised message, or None if the connection was closed.
+    """
+
+    header = _receive_exactly(connection, _MESSAGE_HEADER.size)
+    if header is None: return None
+
+    size = _MESSAGE_HEADER.unpack(header)[0]
+    if size > _MAX_MESSAGE_SIZE: raise ValueError('Message of {} bytes is too large'.format(size))
+
+    data = _receive_exactly(connection, size)
+    return None if data is None else json.loads(data)
+
+
+def _write_shared_arrays(buffer, capacity, arrays):
+    """
+    Write arrays one after another (each aligned to _SHARED_ARRAY_ALIGNMENT bytes) into a buffer, e.g. of a shared memory segment.
+    :param buffer: The buffer (e.g. a memoryview).
+    :param capacity: The number of bytes of the buffer that can be written.
+    :param arrays: A list of numpy.ndarray objects.
+    :return: A (layouts, size) tuple, where layouts is a list containing an {'offset', 'shape', 'dtype'} dict for each array (see
+    _read_shared_arrays()), and size is the number of bytes needed. Nothing is written if size is greater than capacity.
+    """
+
+    layouts = []
+    size = 0
+    for array in arrays:
+        layouts.append({'offset': size, 'shape': list(array.shape), 'dtype': array.dtype.str})
+        size += -(-array.nbytes // _SHARED_ARRAY_ALIGNMENT) * _SHARED_ARRAY_ALIGNMENT
+
+    if size <= capacity:
+        for array, layout in zip(arrays, layouts):
+            np.copyto(np.ndarray(array.shape, dtype=array.dtype, buffer=buffer, offset=layout['offset']), array)
+
+    return layouts, size
+
+
+def _read_shared_arrays(buffer, layouts, copy=True):
+    """
+    Read the arrays written by _write_shared_arrays() from a buffer.
+    :param buffer: The buffer (e.g. a memoryview).
+    :param layouts: The list of {'offset', 'shape', 'dtype'} dicts returned by _write_shared_arrays().
+    :param copy: Whether to return copies of the arrays, rather than views of the buffer. Defaults to True.
+    :return: A list of numpy.ndarray objects.
+    """
+
+    arrays = [np.ndarray(layout['shape'], dtype=np.dtype(layout['dtype']), buffer=buffer, offset=layout['offset']) for layout in layouts]
+    return [array.copy() for array in arrays] if copy else arrays
+
+
+def _attach_shared_memory(name):
+    """
+    Attach to a shared memory segment created by another process, without taking ownership of it.
+    :param name: The name of the segment.
+    :return: A multiprocessing.shared_memory.SharedMemory object.
+    """
+
+    if sys.version_info >= (3, 13): return multiprocessing.shared_memory.SharedMemory(name, track=False)
+
+    # Before Python 3.13, attaching registers the segment with the resource tracker, which would unlink it when this process exits (and
+    # unregistering it instead would also unregister it for the client, if the client shares the resource tracker), so registering is skipped
+    register = multiprocessing.resource_tracker.register
+    multiprocessing.resource_tracker.register = lambda name, rtype: None
+    try:
+        return multiprocessing.shared_memory.SharedMemory(name)
+    finally:
+        multiprocessing.resource_tracker.register = register
+
+
+# The shared memory segments of the clients attached by a FaceCropperServer worker process, by name (least recently used first)
+_worker_shared_memory = collections.OrderedDict()
+
+
+def _get_worker_shared_memory(name):
+    """
+    Get a shared memory segment of a client in a FaceCropperServer worker process, attaching to it if it isn't already attached.
+    :param name: The name of the segment.
+    :return: A multiprocessing.shared_memory.SharedMemory object.
+    """
+
+    segment = _worker_shared_memory.pop(name, None)
+    if segment is None:
+        segment = _attach_shared_memory(name)
+        while len(_worker_shared_memory) >= _MAX_ATTACHED_SEGMENTS: _worker_shared_memory.popitem(last=False)[1].close()
+
+    _worker_shared_memory[name] = segment
+    return segment
+
+
+def _close_unlinked_worker_shared_memory():
+    """
+    Detach the segments in _worker_shared_memory that their clients have unlinked (e.g. replaced by a larger segment, or closed), as
+    their memory is only freed once no process has them attached.
+    """
+
+    for name in list(_worker_shared_memory):
+        if not os.path.exists(os.path.join(_SHARED_MEMORY_DIRECTORY, name.lstrip('/'))):
+            _worker_shared_memory.pop(name).close()
+
+
+def _process_shared_frames_in_worker(requests):
+    """
+    Process a batch of FaceCropperServer requests with the FaceCropper object of a worker process (see _initialise_worker()).
+    :param requests: A list of request dicts (see FaceCropperClient._request()).
+    :return: A list containing a reply dict for each request.
+    """
+
+    _close_unlinked_worker_shared_memory()
+
+    replies = []
+    for request in requests:
+        try:
+            replies.append(_process_shared_frame(request))
+        except Exception as exception:
+            replies.append({'id': request.get('id'), 'status': 'error', 'error': repr(exception)})
+
+    return replies
+
+
+def _process_shared_frame(request):
+    """
+    Crop the faces (or get the geometry of the faces) in a frame in the input shared memory segment of a client, and write them into
+    its output segment.
+    :param request: The request dict (see FaceCropperClient._request()).
+    :return: A reply dict, containing the 'id' of the request, its 'status' ('ok', 'output_too_small' along with the 'output_bytes'
+    needed, or 'invalid_frame' along with the 'error' if the shape of the frame doesn't match the colour_order of the FaceCropper object),
+    and the 'faces': a list containing, for each face, the layouts of its arrays in the output segment (see _write_shared_arrays()),
+    or a dict with its geometry (see FaceCropperClient.get_face_geometry()) where 'landmarks' is the layout of its landmarks.
+    """
+
+    input_segment = _get_worker_shared_memory(request['input'])
+    shape = tuple(request['shape'])
+    # Frames are (height, width) for FaceCropper.GRAY, and (height, width, 3) otherwise
+    if (len(shape) != 2 if _worker_face_cropper.colour_order == FaceCropper.GRAY else len(shape) != 3 or shape[2] != 3) \
+            or int(np.prod(shape)) > input_segment.size:
+        return {'id': request['id'], 'status': 'invalid_frame', 'error': 'Invalid frame shape {} for the colour_order of the FaceCropperServer'.format(shape)}
+    image = np.ndarray(shape, dtype=np.uint8, buffer=input_segment.buf)
+
+    if request['geometry']:
+        face_records = _worker_face_cropper.get_face_records(image)
+        face_arrays = [[face_record.landmarks] for face_record in face_records]
+    else:
+        face_outputs = _worker_face_cropper.get_faces(image, request['remove_background'], request['correct_roll'])
+        face_arrays = [list(face_output) if isinstance(face_output, tuple) else [face_output] for face_output in face_outputs]
+
+    output_segment = _get_worker_shared_memory(request['output'])
+    layouts, output_bytes = _write_shared_arrays(output_segment.buf, min(request['output_size'], output_segment.size),
+                                                 [array for arrays in face_arrays for array in arrays])
+    if output_bytes > min(request['output_size'], output_segment.size):
+        return {'id': request['id'], 'status': 'output_too_small', 'output_bytes': output_bytes}
+
+    faces = []
+    for arrays in face_arrays:
+        faces.append(layouts[:len(arrays)])
+        layouts = layouts[len(arrays):]
+
+    if request['geometry']:
+        faces = [{
+            'score': float(face_record.score),
+            'face_box': [float(value) for value in face_record.face_box],
+            'inflation_factor': float(face_record.inflation_factor),
+            'inflated_bounds': [int(bound) for bound in face_record.inflated_bounds],
+            'roll_angle': float(face_record.roll_angle),
+            'crop_bounds': [int(bound) for bound in face_record.crop_bounds],
+            'quality': face_record.quality,
+            'landmarks': face_layouts[0]
+        } for face_record, face_layouts in zip(face_records, faces)]
+
+    return {'id': request['id'], 'status': 'ok', 'faces': faces}
+
+
+
+class FaceCropperServer:
+    """
+    Serves the FaceCropperClient objects of other processes on the same (Linux) machine over a Unix socket, so that they share one pool of
+    FaceCropper worker processes (and one copy of the mp.solutions.face_detection.FaceDetection and mp.solutions.face_mesh.FaceMesh
+    networks per worker) instead of each creating their own FaceCropper object:
+        1. A client writes its frame into a shared memory segment it owns (see multiprocessing.shared_memory), and sends a small JSON
+           request naming the segment over the socket, so the frame itself isn't copied through the socket or pickled
+        2. The requests of all clients are grouped into batches of up to max_batch_size, waiting at most max_batch_delay seconds for a
+           batch to fill up, and each batch is sent to a worker process as one task
+        3. The worker process reads the frame directly from the segment, and writes the cropped faces (or the landmarks) into a second
+           segment owned by the client, whose layout is sent back in the JSON reply
+
+    - Clients can read and write any shared memory segment the server can, so only trusted processes should be able to connect (the
+      permissions of the socket file control which users can)
+
+    - Worker processes are spawned (i.e. they import the __main__ module), so the server must be created inside an if __name__ == '__main__': block
+
+    - Can be used as a context manager, which closes the server on exit
+    """
+
+    def __init__(self, socket_path, workers=None, max_batch_size=8, max_batch_delay=0.002, **face_cropper_kwargs):
+        """
+        Initialise a FaceCropperServer object, and start listening on the socket. Call serve_forever() (or start()) to accept clients.
+        :param socket_path: The path of the Unix socket. A socket file left behind by a server that is no longer running is replaced.
+        :param workers: The number of worker processes. Defaults to None to use the number of CPUs.
+        :param max_batch_size: The maximum number of requests sent to a worker process at a time. Defaults to 8.
+        :param max_batch_delay: The maximum number of seconds a request waits for more requests to batch it with. Defaults to 0.002.
+        :param face_cropper_kwargs: Keyword arguments to pass to the FaceCropper constructor of each worker process, e.g. min_face_detector_confidence.
+        """
+
+        self.socket_path = socket_path
+        self.max_batch_size = max_batch_size
+        self.max_batch_delay = max_batch_delay
+
+        if os.path.exists(socket_path):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                if probe.connect_ex(socket_path) == 0: raise OSError('A server is already listening on {}'.format(socket_path))
+            os.unlink(socket_path)
+
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listener.bind(socket_path)
+        self._listener.listen()
+        # accept() is polled, so that serve_forever() returns soon after close() is called from another thread
+        self._listener.settimeout(0.1)
+
+        # Worker processes are spawned rather than forked, for the same reason as in FaceCropperPool
+        self.pool = multiprocessing.get_context('spawn').Pool(workers, initializer=_initialise_worker, initargs=(face_cropper_kwargs,))
+
+        self._requests = queue.Queue()  # (connection, send_lock, request) tuples, or None to stop the dispatcher
+        self._connections = set()
+        self._connections_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._serving_thread = None
+        self._dispatcher = threading.Thread(target=self._dispatch_requests, name='FaceCropperServer-dispatcher', daemon=True)
+        self._dispatcher.start()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def serve_forever(self):
+        """
+        Accept clients until close() is called (e.g. from a signal handler or another thread). Each client is served in its own thread.
+        """
+
+        while not self._stopped.is_set():
+            try:
+                connection, _ = self._listener.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                if self._stopped.is_set(): return
+                raise
+
+            connection.settimeout(None)
+            with self._connections_lock: self._connections.add(connection)
+            threading.Thread(target=self._serve_connection, args=(connection,), name='FaceCropperServer-connection', daemon=True).start()
+
+
+    def start(self):
+        """
+        Call serve_forever() in a background thread.
+        :return: This FaceCropperServer object.
+        """
+
+        self._serving_thread = threading.Thread(target=self.serve_forever, name='FaceCropperServer', daemon=True)
+        self._serving_thread.start()
+        return self
+
+
+    def _serve_connection(self, connection):
+        """
+        Receive the requests of a client and queue them for the dispatcher, until the client disconnects.
+        :param connection: The socket.socket object connected to the client.
+        """
+
+        # Replies are sent from the thread handling the results of the pool, possibly for several batches at once
+        send_lock = threading.Lock()
+
+        try:
+            while True:
+                request = _receive_message(connection)
+                if request is None: break
+                self._requests.put((connection, send_lock, request))
+        except (OSError, ValueError):
+            pass
+        finally:
+            with self._connections_lock: self._connections.discard(connection)
+            connection.close()
+
+
+    def _dispatch_requests(self):
+        """
+        Group the queued requests into batches and send each batch to a worker process, until None is queued. Meant to be run in a background thread.
+        """
+
+        stopping = False
+        while not stopping:
+            item = self._requests.get()
+            if item is None: return
+
+            batch = [item]
+            deadline = time.perf_counter() + self.max_batch_delay
+            while len(batch) < self.max_batch_size:
+                try:
+                    item = self._requests.get(timeout=max(deadline - time.perf_counter(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            self.pool.apply_async(_process_shared_frames_in_worker, ([request for _, _, request in batch],),
+                                  callback=lambda replies, batch=batch: self._send_replies(batch, replies),
+                                  error_callback=lambda exception, batch=batch: self._send_replies(
+                                      batch, [{'id': request.get('id'), 'status': 'error', 'error': repr(exception)} for _, _, request in batch]))
+
+
+    @staticmethod
+    def _send_replies(batch, replies):
+        """
+        Send the replies to a batch of requests to their clients. Clients that have disconnected are skipped.
+        :param batch: The list of (connection, send_lock, request) tuples of the batch.
+        :param replies: The list of reply dicts returned by _process_shared_frames_in_worker().
+        """
+
+        for (connection, send_lock, _), reply in zip(batch, replies):
+            try:
+                with send_lock: _send_message(connection, reply)
+            except OSError:
+                pass
+
+
+    def close(self):
+        """
+        Stop accepting clients and requests, wait for the requests already sent to the worker processes, and close the worker processes and
+        the connections.
+        """
+
+        if self._stopped.is_set(): return
+        self._stopped.set()
+
+        self._listener.close()
+        if self._serving_thread is not None: self._serving_thread.join()
+        if os.path.exists(self.socket_path): os.unlink(self.socket_path)
+
+        self._requests.put(None)
+        self._dispatcher.join()
+        self.pool.close()
+        self.pool.join()
+
+        with self._connections_lock: connections = list(self._connections)
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+
+class FaceCropperClient:
+    """
+    Crops faces with a FaceCropperServer of the same machine, instead of creating a FaceCropper object in this process.
+
+    - Frames are passed to the server in a shared memory segment owned by the client. Passing an array returned by get_frame_buffer() (e.g.
+      after decoding a frame straight into it) avoids copying the frame into the segment
+
+    - The cropped faces (or landmarks) are returned in a second segment owned by the client, which grows when the faces of a frame don't fit
+      (the frame is then processed again)
+
+    - A client sends one request at a time (calls from several threads wait for each other), so use a client per thread to send several
+      requests at once. The server batches the requests of all its clients
+
+    - Can be used as a context manager, which closes the client on exit
+    """
+
+    def __init__(self, socket_path, timeout=None):
+        """
+        Initialise a FaceCropperClient object, and connect to the server.
+        :param socket_path: The path of the Unix socket of the server.
+        :param timeout: The maximum number of seconds to wait for a reply of the server, after which socket.timeout is raised (and the
+        client can't be used anymore). Defaults to None to wait indefinitely.
+        """
+
+        self._connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._connection.settimeout(timeout)
+        self._connection.connect(socket_path)
+
+        self._lock = threading.Lock()
+        self._next_request_id = 0
+        self._input_segment = None
+        self._output_segment = None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    @staticmethod
+    def _release_segment(segment):
+        """
+        Unlink and close a shared memory segment of the client.
+        :param segment: The multiprocessing.shared_memory.SharedMemory object, or None.
+        """
+
+        if segment is None: return
+
+        segment.unlink()
+        try:
+            segment.close()
+        except BufferError:
+            pass  # Arrays returned by get_frame_buffer() (or with copy=False) still use it, so it's unmapped once they're garbage collected
+
+
+    @staticmethod
+    def _replace_segment(segment, size):
+        """
+        Create a shared memory segment, and release the segment it replaces.
+        :param segment: The multiprocessing.shared_memory.SharedMemory object to replace, or None.
+        :param size: The size of the new segment in bytes.
+        :return: The new multiprocessing.shared_memory.SharedMemory object.
+        """
+
+        FaceCropperClient._release_segment(segment)
+        return multiprocessing.shared_memory.SharedMemory(create=True, size=max(size, 1))
+
+
+    def get_frame_buffer(self, shape):
+        """
+        Get a uint8 array in the shared memory segment that frames are passed to the server in. Passing it to get_faces() or
+        get_face_geometry() avoids copying the frame (e.g. cv2.VideoCapture.read(frame_buffer) decodes a frame straight into it, but the
+        frame must then be converted to RGB in place with cv2.cvtColor(frame_buffer, cv2.COLOR_BGR2RGB, frame_buffer), unless the server's
+        FaceCropper objects are created with colour_order=FaceCropper.BGR).
+        :param shape: The (height, width, 3) shape of the frames, or (height, width) if the server's FaceCropper objects are created with
+        colour_order=FaceCropper.GRAY.
+        :return: A numpy.ndarray, which is only valid until a larger frame is passed.
+        """
+
+        size = int(np.prod(shape))
+        if self._input_segment is None or self._input_segment.size < size:
+            self._input_segment = self._replace_segment(self._input_segment, size)
+
+        return np.ndarray(shape, dtype=np.uint8, buffer=self._input_segment.buf)
+
+
+    def _request(self, image, remove_background, correct_roll, geometry):
+        """
+        Send a frame to the server, and wait for its reply.
+        :param image: A numpy.ndarray image in the colour_order of the server.
+        :param remove_background: Whether non-face (i.e. background) pixels should be set to 0.
+        :param correct_roll: Whether the roll in faces should be corrected.
+        :param geometry: Whether to get the geometry of the faces rather than the cropped faces.
+        :return: The reply dict (see _process_shared_frame()).
+        """
+
+        # The shape is checked against the colour_order of the server by the worker process (see _process_shared_frame())
+        if image.dtype != np.uint8 or not (image.ndim == 2 or (image.ndim == 3 and image.shape[2] == 3)):
+            raise ValueError('Expected a (height, width, 3) or (height, width) uint8 image')
+
+        frame_buffer = self.get_frame_buffer(image.shape)
+        if frame_buffer.ctypes.data != image.ctypes.data or not image.flags['C_CONTIGUOUS']: np.copyto(frame_buffer, image)
+        del frame_buffer
+
+        if self._output_segment is None: self._output_segment = self._replace_segment(None, image.nbytes)
+
+        while True:
+            self._next_request_id += 1
+            _send_message(self._connection, {
+                'id': self._next_request_id,
+                'input': self._input_segment.name,
+                'shape': list(image.shape),
+                'output': self._output_segment.name,
+                'output_size': self._output_segment.size,
+                'remove_background': remove_background,
+                'correct_roll': correct_roll,
+                'geometry': geometry
+            })
+
+            reply = _receive_message(self._connection)
+            if reply is None: raise ConnectionError('The FaceCropperServer closed the connection')
+            if reply['status'] == 'error': raise RuntimeError('The FaceCropperServer failed to process the frame: {}'.format(reply['error']))
+            if reply['status'] == 'invalid_frame': raise ValueError(reply['error'])
+            if reply['status'] != 'output_too_small': return reply
+
+            self._output_segment = self._replace_segment(self._output_segment, reply['output_bytes'] * 3 // 2)
+
+
+    def get_faces(self, image, remove_background=False, correct_roll=True, copy=True):
+        """
+        Crop out (and optionally correct the roll and/or remove background of) each detected face in the specified image, as in
+        FaceCropper.get_faces() with the configuration of the server.
+        :param image: A numpy.ndarray image in the colour_order of the server (RGB by default) containing faces to be cropped (e.g. from get_frame_buffer())
+        :param remove_background: Whether non-face (i.e. background) pixels should be set to 0. Defaults to False
+        :param correct_roll: Whether the roll in faces should be corrected. Defaults to True
+        :param copy: Whether to return copies of the cropped faces, rather than views of the output segment, which are only valid until the
+        next call. Defaults to True
+        :return: A list of numpy.ndarray RGB images containing the cropped faces (or tuples, depending on the mask_format of the server)
+        """
+
+        with self._lock:
+            reply = self._request(image, remove_background, correct_roll, False)
+            faces = [_read_shared_arrays(self._output_segment.buf, layouts, copy) for layouts in reply['faces']]
+
+        return [arrays[0] if len(arrays) == 1 else tuple(arrays) for arrays in faces]
+
+
+    def get_face_geometry(self, image, copy=True):
+        """
+        Detect each face in the specified image along with its landmarks, without cropping it out (see FaceCropper.get_face_records()).
+        :param image: A numpy.ndarray image in the colour_order of the server (RGB by default) containing faces (e.g. from get_frame_buffer())
+        :param copy: Whether to return copies of the landmarks, rather than views of the output segment, which are only valid until the
+        next call. Defaults to True
+        :return: A list containing a dict for each face, with the 'score', 'face_box', 'inflation_factor', 'inflated_bounds', 'landmarks',
+        'roll_angle', 'crop_bounds' and 'quality' of the face (see FaceRecord)
+        """
+
+        with self._lock:
+            reply = self._request(image, False, False, True)
+            for face in reply['faces']:
+                face['landmarks'] = _read_shared_arrays(self._output_segment.buf, [face['landmarks']], copy)[0]
+
+        return reply['faces']
+
+
+    def close(self):
+        """
+        Disconnect from the server, and unlink the shared memory segments of the client.
+        """
+
+        self._connection.close()
+        self._release_segment(self._input_segment)
+        self._release_segment(self._output_segment)
+        self._input_segment = self._output_segment = None
+
+
+
+# The record of each face in the index.bin file of a FaceDataset: the id of the image it was cropped from, the position of its pixels in
+# faces.bin (in bytes), its size, the normalised detection box and roll angle of the face (see FaceRecord), and its landmarks normalised
+# to the face image (468 landmarks of mp.solutions.face_mesh.FaceMesh), all little-endian so datasets can be read on any machine
+_FACE_DATASET_INDEX_DTYPE = np.dtype([('image_id', '<u8'), ('offset', '<u8'), ('height', '<u2'), ('width', '<u2'), ('face_box', '<f2', (4,)),
+                                      ('roll_angle', '<f2'), ('landmarks', '<f2', (468, 2))])
+
+
+def _get_image_id(source):
+    """
+    :param source: A string identifying an image, e.g. its path.
+    :return: A 64-bit integer id of the image (the first 8 bytes of a BLAKE2b hash of the string).
+    """
+
+    return int.from_bytes(hashlib.blake2b(source.encode(), digest_size=8).digest(), 'little')
+
+
+class FaceDataset:
+    """
+    A dataset of cropped faces stored in memory-mappable files, which cropped faces can be appended to instead of writing an image file for
+    each face (e.g. python -m face_cropper --dataset), and which training code can memory-map and slice without decoding anything. A dataset
+    is a directory containing:
+        - faces.bin: The uint8 pixels of the faces, one after another in C order
+        - index.bin: A record of _FACE_DATASET_INDEX_DTYPE for each face, containing its 'image_id', 'offset' (in bytes in faces.bin), 'height',
+          'width', 'face_box', 'roll_angle', and 'landmarks' normalised to the face image (the geometry is stored as float16)
+        - sources.jsonl: The source string (e.g. path) of each image whose id was hashed from a string (see append())
+        - dataset.json: The 'face_shape' of the faces (for datasets of fixed size faces, e.g. with FaceCropper's output_size) and their number of 'channels'
+        - lock: The file appends are locked with
+
+    - Appends take an exclusive lock (with fcntl.flock where available, and a threading.Lock), so several threads and processes can append to
+      the same dataset, and datasets can be appended to across runs. Without fcntl (e.g. on Windows), only one process may append at a time
+    - The faces of an append are written before their index records, and each append first truncates any partial index record or unindexed
+      faces left by an interrupted append, so an interrupted append never corrupts the dataset. Readers only see faces with a complete record
+    - Can be used as a context manager, which closes the dataset on exit
+    """
+
+    def __init__(self, directory, face_shape=None, channels=None):
+        """
+        Open a FaceDataset, creating it if it doesn't exist.
+        :param directory: The path of the directory of the dataset, which is created if it doesn't exist.
+        :param face_shape: The (height, width, channels) (or (height, width) for grayscale) shape of every face, so the faces can be read as one
+        (n, *face_shape) array (see faces). Must match the shape of an existing dataset. Defaults to None to use the shape of an existing
+        dataset, or to store faces of any size in a new one.
+        :param channels: The number of channels of the faces of a dataset of faces of any size (1 for (height, width) grayscale faces). Must match
+        the number of channels of an existing dataset. Defaults to None to use the number of an existing dataset, or 3 for a new one.
+        """
+
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+        self._thread_lock = threading.Lock()
+        self._lock_file = open(os.path.join(directory, 'lock'), 'ab')
+        self._faces_file = self._index_file = None
+        self._written_sources = set()
+        self._index = (0, np.zeros(0, dtype=_FACE_DATASET_INDEX_DTYPE))  # (face count, numpy.memmap) tuple of the mapped index.bin
+        self._face_data = (0, None)  # (size, numpy.memmap) tuple of the mapped faces.bin
+
+        metadata_path = os.path.join(directory, 'dataset.json')
+        with self._thread_lock:
+            self._lock()
+            try:
+                if os.path.exists(metadata_path):
+                    with open(metadata_path) as metadata_file: metadata = json.load(metadata_file)
+                else:
+                    if channels is None: channels = 3 if face_shape is None else (face_shape[2] if len(face_shape) == 3 else 1)
+                    metadata = {'version': 1, 'face_shape': None if face_shape is None else list(face_shape), 'channels': channels}
+                    with open(metadata_path + '.tmp', 'w') as metadata_file: json.dump(metadata, metadata_file)
+                    os.replace(metadata_path + '.tmp', metadata_path)
+            finally:
+                self._unlock()
+
+        if face_shape is not None and metadata['face_shape'] != list(face_shape):
+            raise ValueError('The faces of the dataset in {} have shape {}, not {}'.format(directory, metadata['face_shape'], tuple(face_shape)))
+        if channels is not None and metadata['channels'] != channels:
+            raise ValueError('The faces of the dataset in {} have {} channels, not {}'.format(directory, metadata['channels'], channels))
+
+        self.face_shape = None if metadata['face_shape'] is None else tuple(metadata['face_shape'])
+        self.channels = metadata['channels']
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def __len__(self):
+        """
+        :return: The number of faces in the dataset (with a complete index record)
+        """
+
+        return os.path.getsize(os.path.join(self.directory, 'index.bin')) // _FACE_DATASET_INDEX_DTYPE.itemsize \
+            if os.path.exists(os.path.join(self.directory, 'index.bin')) else 0
+
+
+    def _lock(self):
+        if fcntl is not None: fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+
+
+    def _unlock(self):
+        if fcntl is not None: fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+
+
+    def _get_face_nbytes(self, height, width):
+        return int(height) * int(width) * self.channels
+
+
+    def _truncate_incomplete_append(self):
+        """
+        Truncate any partial index record and unindexed faces left by an interrupted append. Must be called with the lock held.
+        :return: The number of faces in the dataset, and the size of faces.bin (in bytes)
+        """
+
+        index_size = os.fstat(self._index_file.fileno()).st_size
+        face_count = index_size // _FACE_DATASET_INDEX_DTYPE.itemsize
+        if index_size != face_count * _FACE_DATASET_INDEX_DTYPE.itemsize: self._index_file.truncate(face_count * _FACE_DATASET_INDEX_DTYPE.itemsize)
+
+        faces_size = 0
+        if face_count:
+            last_record = np.fromfile(os.path.join(self.directory, 'index.bin'), _FACE_DATASET_INDEX_DTYPE, 1,
+                                      offset=(face_count - 1) * _FACE_DATASET_INDEX_DTYPE.itemsize)[0]
+            faces_size = int(last_record['offset']) + self._get_face_nbytes(last_record['height'], last_record['width'])
+        if os.fstat(self._faces_file.fileno()).st_size != faces_size: self._faces_file.truncate(faces_size)
+
+        return face_count, faces_size
+
+
+    def _get_index(self, face_count=None):
+        """
+        :param face_count: The number of faces that the index must contain at least. Defaults to None to contain every face in the dataset.
+        :return: The mapped index.bin, which is only mapped again when it has grown beyond the mapped face count (and face_count)
+        """
+
+        mapped_count, index = self._index
+        if face_count is None or face_count > mapped_count:
+            face_count = len(self)
+            if face_count > mapped_count:
+                index = np.memmap(os.path.join(self.directory, 'index.bin'), _FACE_DATASET_INDEX_DTYPE, 'r', shape=(face_count,))
+                self._index = (face_count, index)
+
+        return index
+
+
+    def append(self, image_id, faces):
+        """
+        Append the faces cropped from an image to the dataset.
+        :param image_id: A string identifying the image (e.g. its path), whose 64-bit hash is stored as the image_id of the faces (and which is
+        written to sources.jsonl, see sources), or an integer id (between 0 and 2 ** 64 - 1) to store as it is.
+        :param faces: A list containing a (face_image, geometry) tuple for each face (see FaceCropperPool.get_faces_and_geometry()), where
+        face_image is a uint8 numpy.ndarray image, and geometry is a dict with the normalised detection 'face_box' and the 'roll_angle' of the
+        face, and the [x, y] pixel coordinates of its 'landmarks' in face_image (see FaceRecord.get_face_landmarks()).
+        :return: The indices of the appended faces in the dataset
+        """
+
+        source = image_id if isinstance(image_id, str) else None
+        if source is not None: image_id = _get_image_id(source)
+
+        records = np.zeros(len(faces), dtype=_FACE_DATASET_INDEX_DTYPE)
+        face_images = []
+        for record, (face_image, geometry) in zip(records, faces):
+            if face_image.dtype != np.uint8 or (face_image.shape != self.face_shape if self.face_shape is not None else
+                                                (face_image.shape[2] if face_image.ndim == 3 else 1) != self.channels):
+                raise ValueError('Face of shape {} and type {} does not match the dataset in {}'.format(face_image.shape, face_image.dtype, self.directory))
+            face_images.append(np.ascontiguousarray(face_image))
+            record['image_id'] = image_id
+            record['height'], record['width'] = face_image.shape[:2]
+            record['face_box'] = geometry['face_box']
+            record['roll_angle'] = geometry['roll_angle']
+            record['landmarks'] = np.asarray(geometry['landmarks'])[:, :2] / (face_image.shape[1], face_image.shape[0])
+
+        with self._thread_lock:
+            if self._faces_file is None:
+                self._faces_file = open(os.path.join(self.directory, 'faces.bin'), 'ab', buffering=0)
+                self._index_file = open(os.path.join(self.directory, 'index.bin'), 'ab', buffering=0)
+
+            self._lock()
+            try:
+                face_count, faces_size = self._truncate_incomplete_append()
+                for record, face_image in zip(records, face_images):
+                    record['offset'] = faces_size
+                    faces_size += face_image.nbytes
+                    self._faces_file.write(memoryview(face_image).cast('B'))
+
+                if source is not None and source not in self._written_sources:
+                    with open(os.path.join(self.directory, 'sources.jsonl'), 'a') as sources_file:
+                        sources_file.write(json.dumps({'image_id': image_id, 'source': source}) + '\n')
+                    self._written_sources.add(source)
+
+                # The records are written last (in one write), so the faces they point to are always complete
+                self._index_file.write(records.tobytes())
+            finally:
+                self._unlock()
+
+        return range(face_count, face_count + len(records))
+
+
+    @property
+    def index(self):
+        """
+        A read-only numpy.memmap structured array with the index record of each face (see _FACE_DATASET_INDEX_DTYPE), e.g. index['image_id'].
+        The landmarks of face i are at index['landmarks'][i] * (index['width'][i], index['height'][i]) in its pixel coordinates.
+        """
+
+        return self._get_index()
+
+
+    @property
+    def faces(self):
+        """
+        A read-only (n, *face_shape) numpy.memmap array containing every face of a dataset of fixed size faces, which can be sliced without
+        reading the other faces (e.g. faces[batch_indices]).
+        """
+
+        if self.face_shape is None: raise ValueError('The faces of the dataset in {} have different sizes, use get_face()'.format(self.directory))
+
+        face_count = len(self)
+        if face_count == 0: return np.zeros((0,) + self.face_shape, dtype=np.uint8)
+
+        return np.memmap(os.path.join(self.directory, 'faces.bin'), np.uint8, 'r', shape=(face_count,) + self.face_shape)
+
+
+    def get_face(self, index):
+        """
+        :param index: The index of a face in the dataset.
+        :return: A read-only view of the face in the memory-mapped faces.bin
+        """
+
+        # The mapped index is used as it is for the faces it contains, without checking the size of index.bin
+        record = self._get_index(index + 1 if index >= 0 else None)[index]
+        start = int(record['offset'])
+        end = start + self._get_face_nbytes(record['height'], record['width'])
+
+        # faces.bin is only mapped again when it has grown beyond the mapped size
+        mapped_size, face_data = self._face_data
+        if end > mapped_size:
+            mapped_size = os.path.getsize(os.path.join(self.directory, 'faces.bin'))
+            face_data = np.memmap(os.path.join(self.directory, 'faces.bin'), np.uint8, 'r', shape=(mapped_size,))
+            self._face_data = (mapped_size, face_data)
+
+        return face_data[start:end].reshape((int(record['height']), int(record['width'])) + ((self.channels,) if self.channels != 1 else ()))
+
+
+    @property
+    def sources(self):
+        """
+        A dict of the source strings (e.g. paths) of the images appended with a string id, keyed by their image_id.
+        """
+
+        sources_path = os.path.join(self.directory, 'sources.jsonl')
+        if not os.path.exists(sources_path): return {}
+
+        with open(sources_path) as sources_file:
+            return {entry['image_id']: entry['source'] for entry in map(json.loads, sources_file) if entry}
+
+
+    def close(self):
+        """
+        Close the files of the dataset. The memory-mapped arrays returned by it stay valid.
+        """
+
+        for file in (self._faces_file, self._index_file, self._lock_file):
+            if file is not None: file.close()
+        self._faces_file = self._index_file = None
+
+
+
+# File extensions of the images cropped by the command line interface (see main())
+_IMAGE_EXTENSIONS = ('.bmp', '.jpeg', '.jpg', '.png', '.tif', '.tiff', '.webp')
+
+# cv2.imwrite flags setting the quality of each output format of the command line interface
+_IMAGE_QUALITY_FLAGS = {'jpg': cv2.IMWRITE_JPEG_QUALITY, 'webp': cv2.IMWRITE_WEBP_QUALITY, 'png': cv2.IMWRITE_PNG_COMPRESSION}
+
+
+def _find_images(directory):
+    """
+    Find the image files in a directory tree.
+    :param directory: The path of the directory
+    :return: A sorted list of the paths of the images, relative to the directory (with '/' separators)
+    """
+
+    image_paths = []
+
+    for root, directories, file_names in os.walk(directory):
+        directories.sort()
+        for file_name in sorted(file_names):
+            if os.path.splitext(file_name)[1].lower() in _IMAGE_EXTENSIONS:
+                image_paths.append(os.path.relpath(os.path.join(root, file_name), directory).replace(os.sep, '/'))
+
+    return image_paths
+
+
+def _read_manifest(manifest_path):
+    """
+    Read the paths of the images already processed by earlier runs of the command line interface. If the last line of the manifest was
+    cut short (i.e. an earlier run was killed while writing it), it is ended so that new entries start on a line of their own.
+    :param manifest_path: The path of the JSONL manifest (see main())
+    :return: A set of the relative paths of the images with an entry in the manifest
+    """
+
+    finished_paths = set()
+    if not os.path.exists(manifest_path): return finished_paths
+
+    line = '\n'
+    with open(manifest_path) as manifest_file:
+        for line in manifest_file:
+            try:
+                finished_paths.add(json.loads(line)['path'])
+            except (ValueError, KeyError):
+                pass  # Skip lines that were cut short
+
+    if not line.endswith('\n'):
+        with open(manifest_path, 'a') as manifest_file: manifest_file.write('\n')
+
+    return finished_paths
+
+
+def _read_image(path, colour_order=None):
+    """
+    Read an image file in the specified colour order.
+    :param path: The path of the image
+    :param colour_order: The colour order to read the image in (see colour_order in FaceCropper.__init__()). Defaults to None for FaceCropper.RGB
+    :return: A numpy.ndarray image, or None if the image could not be read
+    """
+
+    if colour_order is None: colour_order = FaceCropper.RGB
+
+    image = cv2.imread(path, _IMREAD_FLAGS[1][colour_order == FaceCropper.GRAY])
+    # OpenCV reads colour images as BGR, which is converted in place rather than into a copy
+    if image is not None and colour_order == FaceCropper.RGB: cv2.cvtColor(image, cv2.COLOR_BGR2RGB, image)
+    return image
+
+
+def _write_face_images(face_images, output_path, image_format, quality):
+    """
+    Write the faces cropped from an image to files named <output_path>_<face index>.<image_format>.
+    :param face_images: A list of numpy.ndarray BGR (or grayscale) images containing the cropped faces, as written by cv2.imwrite()
+    :param output_path: The path of the output files, without the face index and output extension (e.g. <output directory>/<image path>)
+    :param image_format: The file extension (and hence format) of the output files, e.g. 'jpg'
+    :param quality: The quality (for jpg and webp) or compression level (for png) of the output files, or None for the OpenCV default
+    """
+
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    parameters = [] if quality is None or image_format not in _IMAGE_QUALITY_FLAGS else [_IMAGE_QUALITY_FLAGS[image_format], quality]
+
+    for face_index, face_image in enumerate(face_images):
+        if not cv2.imwrite('{}_{}.{}'.format(output_path, face_index, image_format), face_image, parameters):
+            raise OSError('Could not write {}_{}.{}'.format(output_path, face_index, image_format))
+
+
+def _iter_read_images(image_paths, directory, executor, read_ahead, colour_order=None):
+    """
+    Read images in a thread pool, keeping at most read_ahead images read (or being read) ahead of the consumer of the generator.
+    :param image_paths: A list of image paths relative to the directory
+    :param directory: The path of the directory containing the images
+    :param executor: The concurrent.futures.ThreadPoolExecutor object to read the images with
+    :param read_ahead: The maximum number of images read ahead
+    :param colour_order: The colour order to read the images in (see _read_image()). Defaults to None for FaceCropper.RGB
+    :return: A generator yielding an (image_path, image) tuple for each image path (in order), where image is None if it could not be read
+    """
+
+    futures = collections.deque()
+    image_path_iterator = iter(image_paths)
+
+    for image_path in image_path_iterator:
+        futures.append((image_path, executor.submit(_read_image, os.path.join(directory, image_path), colour_order)))
+        if len(futures) >= read_ahead: break
+
+    while futures:
+        image_path, future = futures.popleft()
+        next_image_path = next(image_path_iterator, None)
+        if next_image_path is not None:
+            futures.append((next_image_path, executor.submit(_read_image, os.path.join(directory, next_image_path), colour_order)))
+        yield image_path, future.result()
+
+
+def main(args=None):
+    """
+    Command line interface cropping the faces out of every image in a directory tree (python -m face_cropper --help):
+        - Images are read in a thread pool, their faces are cropped by a FaceCropperPool, and the faces are written in the thread pool to
+          <output directory>/<image path>_<face index>.<format>, or appended (with their geometry) to a FaceDataset in the output directory
+          with --dataset. The image path keeps its extension, so the faces of images that only differ by extension (e.g. a.jpg and a.png)
+          don't overwrite each other (a.jpg_0.jpg and a.png_0.jpg)
+        - The images stream through the stages: at most 2 chunks per worker process are read ahead of the pool, and the faces of at most
+          --batch-size images wait to be written, so the memory used doesn't grow with the number of images, and writing overlaps cropping
+        - A line is appended to a JSONL manifest for each image once its faces are written (or it is found to be unreadable), containing
+          its relative path, status ('ok', 'no_faces', 'unreadable' or 'error') and number of faces. Images already in the manifest are
+          skipped, so an interrupted run resumes where it stopped
+        - With --dataset, an image is recorded in the manifest as soon as its faces are appended. Images whose faces are already in the
+          dataset (i.e. appended by an interrupted run just before it recorded them) are recorded without being cropped again, so a resumed
+          run never appends the faces of an image twice
+        - The progress and throughput (images per second) are reported on stderr as the run goes
+    :param args: A list of command line arguments. Defaults to None to use sys.argv
+    :return: The number of images that could not be read or raised an exception
+    """
+
+    parser = argparse.ArgumentParser(prog='python -m face_cropper', description='Crop the faces out of every image in a directory tree.')
+    parser.add_argument('input_directory', help='The directory containing the images (searched recursively).')
+    parser.add_argument('output_directory', help='The directory to write the cropped faces to, mirroring the input directory tree.')
+    parser.add_argument('--manifest', default=None, help='The path of the JSONL manifest. Defaults to <output_directory>/manifest.jsonl.')
+    parser.add_argument('--format', default='jpg', choices=['jpg', 'png', 'webp', 'bmp'], help='The format of the cropped faces. Defaults to jpg.')
+    parser.add_argument('--quality', type=int, default=None,
+                        help='The quality (0-100 for jpg and webp) or compression level (0-9 for png) of the cropped faces. Defaults to the OpenCV default.')
+    parser.add_argument('--remove-background', action='store_true', help='Set non-face (i.e. background) pixels to 0.')
+    parser.add_argument('--no-roll-correction', action='store_true', help='Do not correct the roll of faces.')
+    parser.add_argument('--workers', type=int, default=None, help='The number of worker processes cropping faces. Defaults to the number of CPUs.')
+    parser.add_argument('--io-threads', type=int, default=8, help='The number of threads reading images and writing faces. Defaults to 8.')
+    parser.add_argument('--chunk-size', type=int, default=8, help='The number of images sent to a worker process at a time. Defaults to 8.')
+    parser.add_argument('--batch-size', type=int, default=256,
+                        help='The maximum number of cropped images whose faces wait to be written (and are held in memory). Defaults to 256.')
+    parser.add_argument('--min-face-detector-confidence', type=float, default=0.5, help='See FaceCropper. Defaults to 0.5.')
+    parser.add_argument('--detection-max-side', type=int, default=None, help='See FaceCropper. Defaults to detecting faces at full resolution.')
+    parser.add_argument('--landmark-max-side', type=int, default=None, help='See FaceCropper. Defaults to detecting landmarks at full resolution.')
+    parser.add_argument('--output-size', type=int, nargs=2, default=None, metavar=('WIDTH', 'HEIGHT'),
+                        help='Scale each face (keeping its aspect ratio) to fit this size, see FaceCropper. Defaults to cropping faces at their size in the image.')
+    parser.add_argument('--dataset', action='store_true',
+                        help='Append the faces to a memory-mapped FaceDataset in the output directory instead of writing image files.')
+    args = parser.parse_args(args)
+
+    manifest_path = args.manifest or os.path.join(args.output_directory, 'manifest.jsonl')
+    os.makedirs(os.path.dirname(os.path.abspath(manifest_path)), exist_ok=True)
+
+    finished_paths = _read_manifest(manifest_path)
+    image_paths = [image_path for image_path in _find_images(args.input_directory) if image_path not in finished_paths]
+    print('{} images to crop ({} already in the manifest)'.format(len(image_paths), len(finished_paths)), file=sys.stderr)
+
+    failed_count = image_count = face_count = 0
+    start_time = report_time = time.perf_counter()
+
+    # Images are cropped in the BGR order OpenCV reads and writes them in, so neither the images nor the faces are converted (except the
+    # faces appended to a dataset, which are stored as RGB)
+    with concurrent.futures.ThreadPoolExecutor(args.io_threads) as executor, \
+            FaceCropperPool(args.workers, args.chunk_size, min_face_detector_confidence=args.min_face_detector_confidence,
+                            detection_max_side=args.detection_max_side, landmark_max_side=args.landmark_max_side,
+                            output_size=None if args.output_size is None else tuple(args.output_size), colour_order=FaceCropper.BGR,
+                            output_colour_order=FaceCropper.RGB if args.dataset else None) as face_cropper_pool, \
+            open(manifest_path, 'a') as manifest_file:
+
+        face_dataset = None
+        if args.dataset:
+            face_dataset = FaceDataset(args.output_directory, None if args.output_size is None else (args.output_size[1], args.output_size[0], 3))
+
+        record_lock = threading.Lock()
+
+        def record(entry):
+            nonlocal failed_count, image_count, face_count, report_time
+            with record_lock:
+                manifest_file.write(json.dumps(entry) + '\n')
+                manifest_file.flush()
+                failed_count += entry['status'] in ('unreadable', 'error')
+                face_count += entry['faces']
+                image_count += 1
+
+                if time.perf_counter() - report_time >= 5 or image_count == len(image_paths):
+                    report_time = time.perf_counter()
+                    print('{}/{} images, {} faces, {} failed, {:.1f} images/s'.format(
+                        image_count, len(image_paths), face_count, failed_count, image_count / (report_time - start_time)), file=sys.stderr)
+
+        def write_and_record(entry, write, *write_args):
+            # Run in the thread pool, so that an image is in the manifest as soon as its faces are written (appending to a dataset, unlike
+            # writing files, isn't idempotent, so a resumed run must not crop an image whose faces were appended again)
+            try:
+                write(*write_args)
+            except Exception as exception:
+                entry = {'path': entry['path'], 'status': 'error', 'faces': 0, 'error': repr(exception)}
+            record(entry)
+
+        paths_to_crop = image_paths
+        if face_dataset is not None and image_paths:
+            # Images whose faces were appended by an interrupted run just before it recorded them are recorded now, rather than appended again
+            image_ids, appended_counts = np.unique(face_dataset.index['image_id'], return_counts=True)
+            appended_face_counts = dict(zip(image_ids.tolist(), appended_counts.tolist()))
+            paths_to_crop = []
+            for image_path in image_paths:
+                appended_face_count = appended_face_counts.get(_get_image_id(image_path))
+                if appended_face_count is None:
+                    paths_to_crop.append(image_path)
+                else:
+                    record({'path': image_path, 'status': 'ok', 'faces': appended_face_count})
+
+        # The paths of the images sent to the pool, in order (unreadable images are recorded as soon as they are read instead). A manifest
+        # entry is only written once an image is done, so entries don't need to be in the order of the images
+        cropped_paths = collections.deque()
+
+        def iter_readable_images():
+            read_ahead = face_cropper_pool.max_pending_chunks * face_cropper_pool.chunk_size
+            for image_path, image in _iter_read_images(paths_to_crop, args.input_directory, executor, read_ahead, FaceCropper.BGR):
+                if image is None:
+                    record({'path': image_path, 'status': 'unreadable', 'faces': 0})
+                else:
+                    cropped_paths.append(image_path)
+                    yield image
+
+        iter_faces = face_cropper_pool.iter_faces if face_dataset is None else face_cropper_pool.iter_faces_and_geometry
+        write_futures = collections.deque()  # Futures of write_and_record() for the images whose faces are being written, in order
+
+        for result in iter_faces(iter_readable_images(), args.remove_background, not args.no_roll_correction, return_exceptions=True):
+            image_path = cropped_paths.popleft()
+            if isinstance(result, Exception):
+                record({'path': image_path, 'status': 'error', 'faces': 0, 'error': repr(result)})
+                continue
+
+            entry = {'path': image_path, 'status': 'ok' if result else 'no_faces', 'faces': len(result)}
+            if face_dataset is not None:
+                write_futures.append(executor.submit(write_and_record, entry, face_dataset.append, image_path, result))
+            else:
+                write_futures.append(executor.submit(write_and_record, entry, _write_face_images, result,
+                                                     os.path.join(args.output_directory, image_path), args.format, args.quality))
+
+            while write_futures and (write_futures[0].done() or len(write_futures) > args.batch_size):
+                write_futures.popleft().result()
+
+        for write_future in write_futures: write_future.result()
+
+        if face_dataset is not None: face_dataset.close()
+
+    return failed_count
+
+
+
+if __name__ == '__main__':
+    sys.exit(1 if main() else 0)
@@ -1,3 +1,11 @@
+import asyncio
+import concurrent.futures
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 import face_cropper
 import numpy as np
@@ -14,10 +22,11 @@ class TestFaceCropper(unittest.TestCase):
             self.height = height
 
 
-    class Landmark:
-        def __init__(self, x, y):
-            self.x = x
-            self.y = y
+    DEMO_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'demo')
+
+    @staticmethod
+    def read_demo_image():
+        return cv2.cvtColor(cv2.imread(os.path.join(TestFaceCropper.DEMO_DIRECTORY, 'demo_1.jpg')), cv2.COLOR_BGR2RGB)
 
 
     def test__get_face_roll_angle(self):
@@ -50,6 +59,76 @@ class TestFaceCropper(unittest.TestCase):
         self.assertEqual(np.array_equal(face_cropper._get_inflated_face_image(image, TestFaceCropper.FaceBox(0.50, 0.25, 0.50, 0.25), 1), image[19:44 + 1, 38:88 + 1]), True)
 
 
+    def test__get_landmark_array(self):
+        class Landmark:
+            def __init__(self, x, y, z):
+                self.x = x
+                self.y = y
+                self.z = z
+
+        landmarks = face_cropper._get_landmark_array([Landmark(0.25, 0.5, 0), Landmark(0.75, 1, -0.5)])
+        self.assertEqual(landmarks.dtype, np.float32)
+        self.assertEqual(np.array_equal(landmarks, np.array([[0.25, 0.5, 0], [0.75, 1, -0.5]])), True)
+
+
+    def test__get_landmark_pixel_coordinates(self):
+        self.assertEqual(
+            np.array_equal(
+                face_cropper._get_landmark_pixel_coordinates(np.array([[0.25, 0.5, 0], [0.75, 1, 0]], dtype=np.float32), (100, 200)),
+                np.array([[50, 50], [150, 100]])
+            ),
+            True
+        )
+
+
+    def test__get_inflated_bounds(self):
+        self.assertEqual(face_cropper._get_inflated_bounds((10, 30, 20, 60), 0), (10, 30, 20, 60))
+        self.assertEqual(face_cropper._get_inflated_bounds((10, 30, 20, 60), 1), (0, 40, 0, 80))
+        self.assertEqual(face_cropper._get_inflated_bounds((10, 30, 20, 60), 0.5), (5, 35, 10, 70))
+
+
+    def test__get_bounds_iou(self):
+        self.assertEqual(face_cropper._get_bounds_iou((0, 9, 0, 9), (0, 9, 0, 9)), 1)
+        self.assertEqual(face_cropper._get_bounds_iou((0, 9, 0, 9), (10, 19, 0, 9)), 0)
+        self.assertEqual(face_cropper._get_bounds_iou((0, 9, 0, 9), (5, 14, 0, 9)), 50 / 150)
+        self.assertEqual(face_cropper._get_bounds_iou((0, 9, 0, 9), (2, 6, 2, 6)), 25 / 100)
+
+
+    def test_FaceTracker(self):
+        video = cv2.VideoCapture(os.path.join(TestFaceCropper.DEMO_DIRECTORY, 'demo_1.mp4'))
+        frames = [cv2.cvtColor(video.read()[1], cv2.COLOR_BGR2RGB) for _ in range(20)]
+        video.release()
+
+        stats = face_cropper.FaceCropperStats()
+        face_cropper_object = face_cropper.FaceCropper(stats=stats)
+        face_tracker = face_cropper.FaceTracker(face_cropper_object, detection_interval=5)
+
+        # The face keeps its track id, and faces are only detected every detection_interval frames
+        track_ids = [[track_id for track_id, _ in face_tracker.get_faces(frame)] for frame in frames]
+        self.assertEqual(track_ids, [[0]] * len(frames))
+        self.assertEqual(stats.counters['images'], len(frames) // 5)
+        self.assertEqual(stats.counters['faces_cropped'], len(frames))
+
+        # A lost track (e.g. a frame without the face) triggers detection, and the face starts a new track when it is detected again
+        self.assertEqual(face_tracker.get_faces(np.zeros_like(frames[0])), [])
+        self.assertEqual(stats.counters['images'], len(frames) // 5 + 1)
+        self.assertEqual([track_id for track_id, _ in face_tracker.get_faces(frames[0])], [1])
+        self.assertEqual(stats.counters['images'], len(frames) // 5 + 2)
+
+        face_tracker.reset()
+        self.assertEqual([track_id for track_id, _ in face_tracker.get_faces(frames[0])], [0])
+        face_cropper_object.close()
+
+
+    def test__get_downscaled_image(self):
+        image = np.zeros((300, 200, 3), dtype=np.uint8)
+
+        self.assertEqual(face_cropper._get_downscaled_image(image, 300) is image, True)
+        self.assertEqual(face_cropper._get_downscaled_image(image, 1000) is image, True)
+        self.assertEqual(face_cropper._get_downscaled_image(image, 150).shape, (150, 100, 3))
+        self.assertEqual(face_cropper._get_downscaled_image(image, 100).shape, (100, 67, 3))
+
+
     def test__get_segmented_face_image(self):
         image = np.array([i for i in range(200 * 100)], dtype=np.uint8).reshape((200, 100))
         result = np.empty(image.shape, dtype=np.uint8)
@@ -65,21 +144,41 @@ class TestFaceCropper(unittest.TestCase):
                 face_cropper._get_segmented_face_image(
                     image,
                     [(0, 1, 2), (3, 2, 1)],
-                    [TestFaceCropper.Landmark(0.25, 0.25), TestFaceCropper.Landmark(0.75, 0.25), TestFaceCropper.Landmark(0.25, 0.75), TestFaceCropper.Landmark(0.75, 0.75)]),
+                    np.array([[0.25, 0.25, 0], [0.75, 0.25, 0], [0.25, 0.75, 0], [0.75, 0.75, 0]], dtype=np.float32)),
                 result
             ),
             True
         )
+        self.assertEqual(
+            np.array_equal(
+                face_cropper._get_segmented_face_image(
+                    image,
+                    [(0, 1, 3, 2)],
+                    np.array([[0.25, 0.25, 0], [0.75, 0.25, 0], [0.25, 0.75, 0], [0.75, 0.75, 0]], dtype=np.float32)),
+                result
+            ),
+            True
+        )
+
+
+    def test__get_mesh_outline(self):
+        outline = face_cropper._get_mesh_outline([(0, 1, 2), (3, 2, 1)])
+        self.assertEqual(outline in ([0, 1, 3, 2], [0, 2, 3, 1]), True)
+
+        outline = face_cropper._get_mesh_outline([(0, 1, 4), (1, 2, 4), (2, 3, 4), (3, 0, 4)])
+        self.assertEqual(outline in ([0, 1, 2, 3], [0, 3, 2, 1]), True)
+
+        self.assertEqual(len(face_cropper._FACE_OUTLINE[0]), 36)
 
 
     def test__get_left_and_right_eye_centres(self):
         self.assertEqual(
             np.array_equal(
-                face_cropper._get_left_and_right_eye_centres([TestFaceCropper.Landmark(0, 0), TestFaceCropper.Landmark(0, 0), TestFaceCropper.Landmark(0, 0)], [TestFaceCropper.Landmark(0, 0), TestFaceCropper.Landmark(0, 0), TestFaceCropper.Landmark(0, 0)])[0],
+                face_cropper._get_left_and_right_eye_centres(np.array([[0, 0, 0], [0, 0, 0], [0, 0, 0]], dtype=np.float32), np.array([[0, 0, 0], [0, 0, 0], [0, 0, 0]], dtype=np.float32))[0],
                 np.array([0, 1])
             ) and
             np.array_equal(
-                face_cropper._get_left_and_right_eye_centres([TestFaceCropper.Landmark(0, 0), TestFaceCropper.Landmark(0, 0), TestFaceCropper.Landmark(0, 0)], [TestFaceCropper.Landmark(0, 0), TestFaceCropper.Landmark(0, 0), TestFaceCropper.Landmark(0, 0)])[1],
+                face_cropper._get_left_and_right_eye_centres(np.array([[0, 0, 0], [0, 0, 0], [0, 0, 0]], dtype=np.float32), np.array([[0, 0, 0], [0, 0, 0], [0, 0, 0]], dtype=np.float32))[1],
                 np.array([0, 1])
             ),
             True
@@ -87,11 +186,11 @@ class TestFaceCropper(unittest.TestCase):
 
         self.assertEqual(
             np.array_equal(
-                face_cropper._get_left_and_right_eye_centres([TestFaceCropper.Landmark(0, -1), TestFaceCropper.Landmark(0.5, 0), TestFaceCropper.Landmark(1, 1)], [TestFaceCropper.Landmark(0, -1), TestFaceCropper.Landmark(0.5, 0), TestFaceCropper.Landmark(1, 1)])[0],
+                face_cropper._get_left_and_right_eye_centres(np.array([[0, -1, 0], [0.5, 0, 0], [1, 1, 0]], dtype=np.float32), np.array([[0, -1, 0], [0.5, 0, 0], [1, 1, 0]], dtype=np.float32))[0],
                 np.array([0.5, 1])
             ) and
             np.array_equal(
-                face_cropper._get_left_and_right_eye_centres([TestFaceCropper.Landmark(0, -1), TestFaceCropper.Landmark(0.5, 0), TestFaceCropper.Landmark(1, 1)], [TestFaceCropper.Landmark(0, -1), TestFaceCropper.Landmark(0.5, 0), TestFaceCropper.Landmark(1, 1)])[1],
+                face_cropper._get_left_and_right_eye_centres(np.array([[0, -1, 0], [0.5, 0, 0], [1, 1, 0]], dtype=np.float32), np.array([[0, -1, 0], [0.5, 0, 0], [1, 1, 0]], dtype=np.float32))[1],
                 np.array([0.5, 1])
             ),
             True
@@ -108,30 +207,806 @@ class TestFaceCropper(unittest.TestCase):
     def test__rotate_landmarks(self):
         self.assertEqual(
             np.array_equal(
-                face_cropper._rotate_landmarks([TestFaceCropper.Landmark(0.5, 0.5), TestFaceCropper.Landmark(0.5, 0.25)], cv2.getRotationMatrix2D((100, 50), 0, 1), (100, 200)),
+                face_cropper._rotate_landmarks(np.array([[0.5, 0.5, 0], [0.5, 0.25, 0]], dtype=np.float32), cv2.getRotationMatrix2D((100, 50), 0, 1), (100, 200)),
                 np.column_stack(([100, 50], [100, 25]))
             ),
             True
         )
         self.assertEqual(
             np.array_equal(
-                face_cropper._rotate_landmarks([TestFaceCropper.Landmark(0.5, 0.5), TestFaceCropper.Landmark(0.5, 0.25)], cv2.getRotationMatrix2D((100, 50), 90, 1), (100, 200)),
+                face_cropper._rotate_landmarks(np.array([[0.5, 0.5, 0], [0.5, 0.25, 0]], dtype=np.float32), cv2.getRotationMatrix2D((100, 50), 90, 1), (100, 200)),
                 np.column_stack(([100, 50], [75, 50]))
             ),
             True
         )
         self.assertEqual(
             np.array_equal(
-                face_cropper._rotate_landmarks([TestFaceCropper.Landmark(0.5, 0.5), TestFaceCropper.Landmark(0.5, 0.25)], cv2.getRotationMatrix2D((100, 50), -90, 1), (100, 200)),
+                face_cropper._rotate_landmarks(np.array([[0.5, 0.5, 0], [0.5, 0.25, 0]], dtype=np.float32), cv2.getRotationMatrix2D((100, 50), -90, 1), (100, 200)),
                 np.column_stack(([100, 50], [125, 50]))
             ),
             True
         )
         self.assertEqual(
             np.array_equal(
-                face_cropper._rotate_landmarks([TestFaceCropper.Landmark(0.25, 0.5), TestFaceCropper.Landmark(0.5, 0.25)], cv2.getRotationMatrix2D((100, 50), 180, 1), (100, 200)),
+                face_cropper._rotate_landmarks(np.array([[0.25, 0.5, 0], [0.5, 0.25, 0]], dtype=np.float32), cv2.getRotationMatrix2D((100, 50), 180, 1), (100, 200)),
                 np.column_stack(([150, 50], [100, 75]))
             ),
             True
         )
 
+
+    def test__get_landmarks_bounds(self):
+        self.assertEqual(face_cropper._get_landmarks_bounds(np.column_stack(([10, 50], [30, 20], [20, 40]))), (20, 50, 10, 30))
+
+
+    def test__get_roll_corrected_face_crop(self):
+        random_generator = np.random.default_rng(0)
+        image = cv2.resize(random_generator.integers(0, 256, (15, 20, 3), dtype=np.uint8), (200, 150), interpolation=cv2.INTER_LINEAR)
+
+        for roll_angle in [0, 20, -45, 90, 160]:
+            landmarks = np.column_stack((random_generator.uniform(0.2, 0.8, (468, 2)), np.zeros(468))).astype(np.float32)
+            eye_offset = 0.1 * np.array([np.cos(np.radians(roll_angle)), -np.sin(np.radians(roll_angle))])
+            landmarks[face_cropper._LEFT_EYE_LANDMARK_INDICES, :2] = 0.5 + eye_offset
+            landmarks[face_cropper._RIGHT_EYE_LANDMARK_INDICES, :2] = 0.5 - eye_offset
+
+            corrected_image, corrected_landmarks = face_cropper._get_roll_corrected_image_and_landmarks(image, landmarks)
+            expected_crop = face_cropper._crop_within_bounds(corrected_image, *face_cropper._get_landmarks_bounds(corrected_landmarks))
+            crop, crop_landmarks = face_cropper._get_roll_corrected_face_crop(image, landmarks)
+
+            self.assertEqual(crop.shape, expected_crop.shape)
+            self.assertLessEqual(np.max(np.abs(crop.astype(int) - expected_crop.astype(int))), 2)
+            self.assertEqual(face_cropper._get_landmarks_bounds(crop_landmarks)[0], 0)
+            self.assertEqual(face_cropper._get_landmarks_bounds(crop_landmarks)[2], 0)
+
+
+    def test__get_face_crop_matrix(self):
+        random_generator = np.random.default_rng(0)
+
+        for roll_angle in [0, 20, -45, 90, 160]:
+            landmarks = np.column_stack((random_generator.uniform(0.2, 0.8, (468, 2)), np.zeros(468))).astype(np.float32)
+            eye_offset = 0.1 * np.array([np.cos(np.radians(roll_angle)), -np.sin(np.radians(roll_angle))])
+            landmarks[face_cropper._LEFT_EYE_LANDMARK_INDICES, :2] = 0.5 + eye_offset
+            landmarks[face_cropper._RIGHT_EYE_LANDMARK_INDICES, :2] = 0.5 - eye_offset
+
+            for correct_roll in [False, True]:
+                transformation_matrix = face_cropper._get_face_crop_matrix((150, 200), landmarks, correct_roll)
+                crop_landmarks = np.rint(np.matmul(face_cropper._get_landmark_pixel_coordinates(landmarks, (150, 200)), transformation_matrix[:, :2].T) +
+                                         transformation_matrix[:, 2]).astype(int).T
+                if correct_roll:
+                    expected_crop_landmarks = face_cropper._get_roll_corrected_face_crop(np.zeros((150, 200, 3), dtype=np.uint8), landmarks)[1]
+                    self.assertLessEqual(np.max(np.abs(crop_landmarks - expected_crop_landmarks)), 1)
+                else:
+                    self.assertEqual(face_cropper._get_landmarks_bounds(crop_landmarks)[0], 0)
+                    self.assertEqual(face_cropper._get_landmarks_bounds(crop_landmarks)[2], 0)
+
+
+    def test__get_face_quality(self):
+        landmarks = np.full((468, 3), 0.5, dtype=np.float32)
+        landmarks[face_cropper._LEFT_EYE_LANDMARK_INDICES, :2] = [0.65, 0.4]
+        landmarks[face_cropper._RIGHT_EYE_LANDMARK_INDICES, :2] = [0.35, 0.4]
+        landmarks[face_cropper._FACE_EDGE_LANDMARK_INDICES, :2] = [[0.2, 0.45], [0.8, 0.45]]
+        landmarks[face_cropper._FOREHEAD_AND_CHIN_LANDMARK_INDICES, :2] = [[0.5, 0.1], [0.5, 0.9]]
+        landmarks[face_cropper._NOSE_TIP_LANDMARK_INDEX, :2] = [0.5, 0.5]
+
+        quality = face_cropper._get_face_quality(landmarks, (100, 100), 0.9)
+        self.assertAlmostEqual(quality['score'], 0.9, places=6)
+        self.assertEqual(quality['face_size'], 61)
+        self.assertAlmostEqual(quality['yaw_asymmetry'], 0, places=6)
+        self.assertAlmostEqual(quality['pitch_asymmetry'], 0, places=6)
+        self.assertEqual(quality['clipped_fraction'], 0)
+
+        # Turned towards the right of the image and looking down, with the chin below the image
+        landmarks[face_cropper._NOSE_TIP_LANDMARK_INDEX, :2] = [0.65, 0.82]
+        landmarks[face_cropper._FOREHEAD_AND_CHIN_LANDMARK_INDICES[1], :2] = [0.5, 1.2]
+        quality = face_cropper._get_face_quality(landmarks, (100, 100))
+        self.assertIsNone(quality['score'])
+        self.assertAlmostEqual(quality['yaw_asymmetry'], 0.5, places=6)
+        self.assertAlmostEqual(quality['pitch_asymmetry'], (0.72 - 0.38) / 1.1, places=5)
+        self.assertAlmostEqual(quality['clipped_fraction'], 1 - 90 / 111)
+
+        # The same face rotated by 90 degrees (i.e. with a roll) has the same quality
+        rotated_landmarks = landmarks.copy()
+        rotated_landmarks[:, 0], rotated_landmarks[:, 1] = 1 - landmarks[:, 1], landmarks[:, 0]
+        rotated_quality = face_cropper._get_face_quality(rotated_landmarks, (100, 100))
+        self.assertAlmostEqual(rotated_quality['yaw_asymmetry'], quality['yaw_asymmetry'], places=5)
+        self.assertAlmostEqual(rotated_quality['pitch_asymmetry'], quality['pitch_asymmetry'], places=5)
+
+        stats = face_cropper.FaceCropperStats()
+        self.assertEqual(face_cropper.FaceCropper(stats=stats)._is_accepted_quality(quality), True)
+        self.assertEqual(face_cropper.FaceCropper(max_yaw_asymmetry=0.6, max_clipped_fraction=0.2, stats=stats)._is_accepted_quality(quality), True)
+        self.assertEqual(face_cropper.FaceCropper(max_yaw_asymmetry=0.4, stats=stats)._is_accepted_quality(quality), False)
+        self.assertEqual(face_cropper.FaceCropper(max_pitch_asymmetry=0.2, stats=stats)._is_accepted_quality(quality), False)
+        self.assertEqual(face_cropper.FaceCropper(max_clipped_fraction=0.1, stats=stats)._is_accepted_quality(quality), False)
+        self.assertEqual(face_cropper.FaceCropper(min_landmark_face_size=62, stats=stats)._is_accepted_quality(quality), False)
+        self.assertEqual(stats.counters['faces_low_quality'], 4)
+
+
+    def test__get_aligned_face_image(self):
+        image = np.full((150, 200, 3), 255, dtype=np.uint8)
+        landmarks = np.column_stack((np.random.default_rng(0).uniform(0.3, 0.7, (468, 2)), np.zeros(468))).astype(np.float32)
+        landmarks[face_cropper._LEFT_EYE_LANDMARK_INDICES, :2] = [0.6, 0.4]
+        landmarks[face_cropper._RIGHT_EYE_LANDMARK_INDICES, :2] = [0.4, 0.45]
+
+        for output_size in [(112, 112), (160, 120)]:
+            for align_to_template in [False, True]:
+                aligned_face_image = face_cropper._get_aligned_face_image(image, landmarks, output_size, align_to_template=align_to_template)
+                self.assertEqual(aligned_face_image.shape, (output_size[1], output_size[0], 3))
+
+        # Without roll correction, the rectangle spanning the landmarks fills the output along one dimension and is centred along the other
+        landmark_coordinates = np.rint(face_cropper._get_landmark_pixel_coordinates(landmarks, image.shape)).astype(int)
+        rectangle_image = np.zeros(image.shape, dtype=np.uint8)
+        rectangle_image[np.min(landmark_coordinates[:, 1]):np.max(landmark_coordinates[:, 1]) + 1, np.min(landmark_coordinates[:, 0]):np.max(landmark_coordinates[:, 0]) + 1] = 255
+        aligned_face_image = face_cropper._get_aligned_face_image(rectangle_image, landmarks, (100, 100), correct_roll=False)
+        rows, columns = np.nonzero(aligned_face_image[:, :, 0] > 127)
+        self.assertLessEqual(abs(np.min(columns) - (99 - np.max(columns))), 1)
+        self.assertLessEqual(abs(np.min(rows) - (99 - np.max(rows))), 1)
+        self.assertGreaterEqual(max(np.max(columns) - np.min(columns), np.max(rows) - np.min(rows)), 98)
+
+        aligned_face_image = face_cropper._get_aligned_face_image(image, landmarks, (100, 100))
+        segmented_face_image = face_cropper._get_aligned_face_image(image, landmarks, (100, 100), segmentation_mesh=[(0, 1, 2)])
+        self.assertLess(np.count_nonzero(segmented_face_image), np.count_nonzero(aligned_face_image))
+
+        # Landmarks that can't be aligned to the template are aligned as without it
+        degenerate_landmarks = np.full((468, 3), 0.5, dtype=np.float32)
+        self.assertEqual(np.array_equal(face_cropper._get_alignment_matrix(image.shape, degenerate_landmarks, (112, 112), align_to_template=True),
+                                        face_cropper._get_alignment_matrix(image.shape, degenerate_landmarks, (112, 112))), True)
+        self.assertEqual(face_cropper._get_aligned_face_image(image, degenerate_landmarks, (112, 112), align_to_template=True).shape, (112, 112, 3))
+
+
+    def test_FaceCropperStats(self):
+        stats = face_cropper.FaceCropperStats()
+        stats.add_stage_time('detection', 0.25)
+        stats.add_stage_time('detection', 0.5)
+        stats.increment('faces_detected', 3)
+        stats.increment('faces_without_landmarks')
+
+        snapshot = stats.get_snapshot()
+        self.assertEqual(snapshot['stage_seconds']['detection'], 0.75)
+        self.assertEqual(snapshot['stage_calls']['detection'], 2)
+        self.assertEqual(snapshot['stage_calls']['landmarks'], 0)
+        self.assertEqual(snapshot['counters']['faces_detected'], 3)
+        self.assertEqual(snapshot['counters']['faces_without_landmarks'], 1)
+
+        metrics_text = stats.get_metrics_text()
+        self.assertIn('face_cropper_stage_seconds_total{stage="detection"} 0.75\n', metrics_text)
+        self.assertIn('face_cropper_stage_calls_total{stage="detection"} 2\n', metrics_text)
+        self.assertIn('face_cropper_faces_detected_total 3\n', metrics_text)
+
+        stats.reset()
+        self.assertEqual(stats.get_snapshot()['counters']['faces_detected'], 0)
+
+
+    def test__read_manifest(self):
+        with tempfile.TemporaryDirectory() as directory:
+            manifest_path = os.path.join(directory, 'manifest.jsonl')
+            self.assertEqual(face_cropper._read_manifest(manifest_path), set())
+
+            with open(manifest_path, 'w') as manifest_file:
+                manifest_file.write('{"path": "a.jpg", "status": "ok", "faces": 1}\n{"path": "b.jpg", "status": "no_faces", "faces": 0}\n{"path": "c.j')
+            self.assertEqual(face_cropper._read_manifest(manifest_path), {'a.jpg', 'b.jpg'})
+
+            with open(manifest_path) as manifest_file:
+                self.assertEqual(manifest_file.read()[-1], '\n')
+
+
+    def test_main(self):
+        with tempfile.TemporaryDirectory() as input_directory, tempfile.TemporaryDirectory() as output_directory:
+            os.makedirs(os.path.join(input_directory, 'nested'))
+            shutil.copy(os.path.join(TestFaceCropper.DEMO_DIRECTORY, 'demo_1.jpg'), os.path.join(input_directory, 'nested', 'demo_1.jpg'))
+            with open(os.path.join(input_directory, 'broken.jpg'), 'wb') as broken_file: broken_file.write(b'not an image')
+
+            self.assertEqual(face_cropper.main([input_directory, output_directory, '--workers', '1', '--format', 'png']), 1)
+            self.assertEqual(os.listdir(os.path.join(output_directory, 'nested')), ['demo_1.jpg_0.png'])
+            self.assertEqual(os.path.exists(os.path.join(output_directory, 'broken.jpg_0.png')), False)
+
+            # The images are cropped (and the faces written) in the BGR order OpenCV reads and writes them in
+            face_cropper_object = face_cropper.FaceCropper(colour_order=face_cropper.FaceCropper.BGR)
+            expected_face, = face_cropper_object.get_faces(cv2.imread(os.path.join(TestFaceCropper.DEMO_DIRECTORY, 'demo_1.jpg')))
+            face_cropper_object.close()
+            self.assertEqual(np.array_equal(cv2.imread(os.path.join(output_directory, 'nested', 'demo_1.jpg_0.png')), expected_face), True)
+
+            with open(os.path.join(output_directory, 'manifest.jsonl')) as manifest_file:
+                entries = sorted((json.loads(line) for line in manifest_file), key=lambda entry: entry['path'])
+            self.assertEqual(entries, [{'path': 'broken.jpg', 'status': 'unreadable', 'faces': 0},
+                                       {'path': os.path.join('nested', 'demo_1.jpg'), 'status': 'ok', 'faces': 1}])
+
+            # Images already in the manifest are skipped
+            os.remove(os.path.join(output_directory, 'nested', 'demo_1.jpg_0.png'))
+            self.assertEqual(face_cropper.main([input_directory, output_directory, '--workers', '1', '--format', 'png']), 0)
+            self.assertEqual(os.listdir(os.path.join(output_directory, 'nested')), [])
+            with open(os.path.join(output_directory, 'manifest.jsonl')) as manifest_file:
+                self.assertEqual(len(manifest_file.readlines()), 2)
+
+        # Faces appended to a dataset by a run interrupted before it recorded their image in the manifest aren't appended again
+        with tempfile.TemporaryDirectory() as input_directory, tempfile.TemporaryDirectory() as output_directory:
+            shutil.copy(os.path.join(TestFaceCropper.DEMO_DIRECTORY, 'demo_1.jpg'), os.path.join(input_directory, 'demo_1.jpg'))
+            cv2.imwrite(os.path.join(input_directory, 'blank.png'), np.zeros((60, 80, 3), dtype=np.uint8))
+
+            self.assertEqual(face_cropper.main([input_directory, output_directory, '--workers', '1', '--dataset']), 0)
+            os.remove(os.path.join(output_directory, 'manifest.jsonl'))
+            self.assertEqual(face_cropper.main([input_directory, output_directory, '--workers', '1', '--dataset']), 0)
+
+            with open(os.path.join(output_directory, 'manifest.jsonl')) as manifest_file:
+                entries = sorted((json.loads(line) for line in manifest_file), key=lambda entry: entry['path'])
+            self.assertEqual(entries, [{'path': 'blank.png', 'status': 'no_faces', 'faces': 0}, {'path': 'demo_1.jpg', 'status': 'ok', 'faces': 1}])
+            with face_cropper.FaceDataset(output_directory) as face_dataset:
+                self.assertEqual(len(face_dataset), 1)
+                self.assertEqual(face_dataset.sources[int(face_dataset.index['image_id'][0])], 'demo_1.jpg')
+
+        # Images that only differ by extension don't overwrite each other's faces
+        with tempfile.TemporaryDirectory() as input_directory, tempfile.TemporaryDirectory() as output_directory:
+            image = cv2.imread(os.path.join(TestFaceCropper.DEMO_DIRECTORY, 'demo_1.jpg'))
+            cv2.imwrite(os.path.join(input_directory, 'a.jpg'), image)
+            cv2.imwrite(os.path.join(input_directory, 'a.png'), cv2.flip(image, 1))
+
+            self.assertEqual(face_cropper.main([input_directory, output_directory, '--workers', '1', '--format', 'png']), 0)
+            self.assertEqual(sorted(os.listdir(output_directory)), ['a.jpg_0.png', 'a.png_0.png', 'manifest.jsonl'])
+            self.assertEqual(np.array_equal(cv2.imread(os.path.join(output_directory, 'a.jpg_0.png')),
+                                            cv2.imread(os.path.join(output_directory, 'a.png_0.png'))), False)
+
+
+    def test_FaceCache(self):
+        faces = [(0.9, (0.1, 0.2, 0.3, 0.4), 1.5, (1, 2, 3, 4), np.arange(478 * 3, dtype=np.float32).reshape((478, 3)))]
+
+        with tempfile.TemporaryDirectory() as directory:
+            face_cache = face_cropper.FaceCache(max_memory_bytes=10000, directory=directory)
+            face_cache.put('a', faces)
+            face_cache.put('b', [])
+            self.assertIsNone(face_cache.get('c'))
+            self.assertEqual(face_cache.get('b'), [])
+
+            # 'a' is evicted from memory by 'b' and 'c', but is loaded back from the directory
+            face_cache.put('c', faces)
+            self.assertNotIn('a', face_cache._memory_entries)
+            cached_faces = face_cache.get('a')
+            self.assertEqual(cached_faces[0][:4], faces[0][:4])
+            self.assertEqual(np.array_equal(cached_faces[0][4], faces[0][4]), True)
+
+            # Putting a key again only counts the size of its latest file
+            disk_bytes = face_cache.disk_bytes
+            face_cache.put('c', faces)
+            self.assertEqual(face_cache.disk_bytes, disk_bytes)
+            face_cache.put('c', [])
+            self.assertEqual(face_cache.disk_bytes, sum(entry.stat().st_size for entry in os.scandir(directory)))
+
+            # Least recently used files are deleted when the directory is over max_disk_bytes
+            face_cache = face_cropper.FaceCache(directory=directory, max_disk_bytes=face_cache.disk_bytes)
+            face_cache.put('d', faces)
+            self.assertLessEqual(face_cache.disk_bytes, face_cache.max_disk_bytes)
+            self.assertEqual(os.path.exists(os.path.join(directory, 'd.npz')), True)
+
+
+    def test__detect_landmarks_in_mosaic(self):
+        class Landmark:
+            def __init__(self, x, y, z):
+                self.x = x
+                self.y = y
+                self.z = z
+
+        class Landmarks:
+            def __init__(self, coordinates):
+                self.landmark = [Landmark(*point) for point in coordinates]
+
+        class LandmarkDetector:
+            # Finds the 'face' in each tile at its (normalised) landmarks in the tile images, in reverse order, except in the last tile
+            def __init__(self, images, landmarks):
+                self.images = images
+                self.landmarks = landmarks
+
+            def process(self, mosaic_image):
+                _, placements, _ = face_cropper._get_mosaic_image(self.images, 64)
+                multi_face_landmarks = []
+                for image, landmarks, (top, left, (scale_x, scale_y)) in list(zip(self.images, self.landmarks, placements))[-2::-1]:
+                    multi_face_landmarks.append(Landmarks(np.column_stack((
+                        (landmarks[:, 0] * image.shape[1] * scale_x + left) / mosaic_image.shape[1],
+                        (landmarks[:, 1] * image.shape[0] * scale_y + top) / mosaic_image.shape[0],
+                        landmarks[:, 2] * image.shape[1] * scale_x / mosaic_image.shape[1]))))
+                return type('Result', (), {'multi_face_landmarks': multi_face_landmarks})
+
+        images = [np.full((100, 80, 3), 1, dtype=np.uint8), np.full((50, 120, 3), 2, dtype=np.uint8), np.full((90, 90, 3), 3, dtype=np.uint8)]
+        landmarks = [np.random.default_rng(i).uniform(0.2, 0.8, (468, 3)).astype(np.float32) for i in range(len(images))]
+
+        mosaic_image, placements, columns = face_cropper._get_mosaic_image(images, 64)
+        self.assertEqual(mosaic_image.shape, (128, 128, 3))
+        self.assertEqual(columns, 2)
+        for image, (top, left, (scale_x, scale_y)) in zip(images, placements):
+            self.assertEqual(mosaic_image[top, left, 0], image[0, 0, 0])
+            self.assertLessEqual(max(image.shape[0] * scale_y, image.shape[1] * scale_x), 64)
+
+        mosaic_landmarks = face_cropper._detect_landmarks_in_mosaic(LandmarkDetector(images, landmarks), images, 64)
+        for face_landmarks, expected_face_landmarks in zip(mosaic_landmarks[:-1], landmarks[:-1]):
+            self.assertLess(np.max(np.abs(face_landmarks - expected_face_landmarks)), 1e-5)
+        self.assertIsNone(mosaic_landmarks[-1])
+
+
+    def test__filter_faces(self):
+        # (face_box, inflation_factor, score) tuples in a 100x100 image
+        faces = [
+            (self.FaceBox(0.1, 0.2, 0.1, 0.2), 1, 0.9),    # 20x20 pixels
+            (self.FaceBox(0.12, 0.2, 0.1, 0.2), 1, 0.95),  # Overlaps the first face
+            (self.FaceBox(0.5, 0.05, 0.5, 0.05), 1, 0.99), # 5x5 pixels
+            (self.FaceBox(0.6, 0.3, 0.6, 0.3), 1, 0.6)     # 30x30 pixels
+        ]
+
+        face_cropper_object = face_cropper.FaceCropper.__new__(face_cropper.FaceCropper)
+        face_cropper_object.stats = face_cropper.FaceCropperStats()
+        face_cropper_object.min_face_size, face_cropper_object.max_faces, face_cropper_object.max_face_overlap = 10, None, None
+        self.assertEqual(face_cropper_object._filter_faces(faces, (100, 100)), [faces[0], faces[1], faces[3]])
+
+        face_cropper_object.max_face_overlap = 0.5
+        self.assertEqual(face_cropper_object._filter_faces(faces, (100, 100)), [faces[1], faces[3]])
+
+        face_cropper_object.min_face_size, face_cropper_object.max_face_overlap, face_cropper_object.max_faces = None, None, 2
+        face_cropper_object.face_ranking = face_cropper.FaceCropper.SCORE_RANKING
+        self.assertEqual(face_cropper_object._filter_faces(faces, (100, 100)), [faces[1], faces[2]])
+        face_cropper_object.face_ranking = face_cropper.FaceCropper.SIZE_RANKING
+        self.assertEqual(face_cropper_object._filter_faces(faces, (100, 100)), [faces[0], faces[3]])
+
+        counters = face_cropper_object.stats.get_snapshot()['counters']
+        self.assertEqual((counters['faces_too_small'], counters['faces_overlapping'], counters['faces_over_limit']), (2, 1, 4))
+
+
+    def test_DebugCapture(self):
+        image = np.random.default_rng(0).integers(0, 256, (100, 120, 3), dtype=np.uint8)
+        face_image = image[30:60, 40:70].copy()
+        landmarks = np.column_stack((np.random.default_rng(1).uniform(0.3, 0.7, (468, 2)), np.zeros(468))).astype(np.float32)
+        debug_record = {
+            'image_size': [100, 120], 'remove_background': False, 'correct_roll': True,
+            'detections': [{'face_box': [0.3, 0.3, 0.3, 0.3], 'score': 0.9, 'eye_keypoints': [[0.4, 0.4], [0.5, 0.4]], 'roll_angle': 0.0,
+                            'inflation_factor': 1.0, 'kept': True}],
+            'faces': [{'inflated_bounds': [10, 80, 20, 90], 'landmarks': landmarks.tolist(), 'roll_angle': 0.0, 'face_image_size': [30, 30]}]
+        }
+
+        with tempfile.TemporaryDirectory() as directory:
+            debug_capture = face_cropper.DebugCapture(directory, sample_rate=1)
+            self.assertEqual(debug_capture.is_sampled(), True)
+            capture_directory = debug_capture.submit(image, debug_record, [face_image])
+            debug_capture.close()
+            self.assertIsNone(debug_capture.submit(image, debug_record, [face_image]))
+
+            loaded_image, loaded_debug_record, loaded_face_images = face_cropper.DebugCapture.load(capture_directory)
+            self.assertEqual(np.array_equal(loaded_image, image), True)
+            self.assertEqual(loaded_debug_record, debug_record)
+            self.assertEqual(np.array_equal(loaded_face_images[0], face_image), True)
+
+        debug_images = face_cropper.render_debug_images(image, debug_record, [face_image])
+        self.assertEqual(sorted(debug_images), ['face_0_debug', 'image_debug'])
+        self.assertEqual(debug_images['image_debug'].shape, image.shape)
+        self.assertEqual(debug_images['face_0_debug'].shape, (71, 71 + 30, 3))
+
+
+    def test__BufferPool(self):
+        buffer_pool = face_cropper._BufferPool()
+        large_buffer = buffer_pool.get('mask', (20, 30))
+        small_buffer = buffer_pool.get('mask', (10, 10))
+        self.assertEqual((large_buffer.shape, small_buffer.shape, small_buffer.flags['C_CONTIGUOUS']), ((20, 30), (10, 10), True))
+        self.assertEqual(np.shares_memory(large_buffer, small_buffer), True)
+        self.assertEqual(np.shares_memory(large_buffer, buffer_pool.get('segmented', (20, 30))), False)
+        self.assertEqual(buffer_pool.get('mask', (5, 5), np.float32).dtype, np.float32)
+        self.assertEqual(buffer_pool.nbytes, 2 * 20 * 30 + 5 * 5 * 4)
+
+        # Buffers with stale contents give the same results as new arrays
+        image = np.arange(200 * 100, dtype=np.uint8).reshape((200, 100))
+        mesh = [(0, 1, 2), (3, 2, 1)]
+        landmarks = np.array([[0.25, 0.25, 0], [0.75, 0.25, 0], [0.25, 0.75, 0], [0.75, 0.75, 0]], dtype=np.float32)
+        buffer_pool.get('mask', (200, 100)).fill(255)
+        out = np.full(image.shape, 255, dtype=np.uint8)
+        segmented_image = face_cropper._get_segmented_face_image(image, mesh, landmarks, out, buffer_pool)
+        self.assertEqual(np.shares_memory(segmented_image, out), True)
+        self.assertEqual(np.array_equal(segmented_image, face_cropper._get_segmented_face_image(image, mesh, landmarks)), True)
+
+        # Crops are written into the top-left corner of a larger out image, and new arrays are returned when out can't hold them
+        image = np.random.default_rng(0).integers(0, 256, (150, 200, 3), dtype=np.uint8)
+        landmarks = np.column_stack((np.random.default_rng(1).uniform(0.2, 0.8, (468, 2)), np.zeros(468))).astype(np.float32)
+        crop = face_cropper._get_roll_corrected_face_crop(image, landmarks)[0]
+        out = np.zeros((150, 200, 3), dtype=np.uint8)
+        out_crop = face_cropper._get_roll_corrected_face_crop(image, landmarks, out)[0]
+        self.assertEqual(np.shares_memory(out_crop, out), True)
+        self.assertEqual(np.array_equal(out_crop, crop), True)
+        self.assertIsNone(face_cropper._get_output_view(np.zeros((10, 10, 3), dtype=np.uint8), crop.shape, crop.dtype))
+        self.assertIsNone(face_cropper._get_output_view(np.zeros((150, 200, 4), dtype=np.uint8), crop.shape, crop.dtype))
+        self.assertIsNone(face_cropper._get_output_view(np.zeros((150, 200, 3), dtype=np.float32), crop.shape, crop.dtype))
+
+
+    def test_FaceCropper_warm_up(self):
+        face_cropper_object = face_cropper.FaceCropper(landmark_batch_size=2, stats=face_cropper.FaceCropperStats())
+        graphs = (face_cropper_object._face_detector, face_cropper_object._landmark_detector, face_cropper_object._mosaic_landmark_detector)
+        self.assertEqual(graphs, (None, None, None))
+
+        face_cropper_object.warm_up()
+        graphs = (face_cropper_object._face_detector, face_cropper_object._landmark_detector, face_cropper_object._mosaic_landmark_detector)
+        self.assertEqual(any(graph is None for graph in graphs), False)
+        self.assertEqual(sum(face_cropper_object.stats.get_snapshot()['stage_calls'].values()), 0)
+        self.assertEqual(face_cropper_object.get_faces(np.zeros((100, 100, 3), dtype=np.uint8)), [])
+        face_cropper_object.close()
+
+        self.assertIsNone(face_cropper.FaceCropper().mosaic_landmark_detector)
+
+
+    def test_FaceCropper_landmark_max_side(self):
+        class Landmark:
+            def __init__(self, x, y, z):
+                self.x = x
+                self.y = y
+                self.z = z
+
+        class LandmarkDetector:
+            # Records the shape of each image and finds the 'face' at the same normalised landmarks in every image
+            def __init__(self, landmarks):
+                self.landmarks = landmarks
+                self.image_shapes = []
+
+            def process(self, image):
+                self.image_shapes.append(image.shape)
+                landmarks = type('Landmarks', (), {'landmark': [Landmark(*point) for point in self.landmarks]})
+                return type('Result', (), {'multi_face_landmarks': [landmarks]})
+
+        landmarks = np.random.default_rng(0).uniform(0.2, 0.8, (468, 3)).astype(np.float32)
+        inflated_face_image = np.zeros((400, 200, 3), dtype=np.uint8)
+
+        for landmark_max_side, expected_shape in [(None, (400, 200, 3)), (100, (100, 50, 3)), (800, (400, 200, 3))]:
+            face_cropper_object = face_cropper.FaceCropper(landmark_max_side=landmark_max_side)
+            face_cropper_object._landmark_detector = LandmarkDetector(landmarks)
+            self.assertEqual(np.array_equal(face_cropper_object._detect_landmarks(inflated_face_image), landmarks), True)
+            self.assertEqual(face_cropper_object._landmark_detector.image_shapes, [expected_shape])
+
+        self.assertNotEqual(face_cropper.FaceCropper()._cache_key_prefix, face_cropper.FaceCropper(landmark_max_side=100)._cache_key_prefix)
+
+
+    def test_FaceCropper_colour_order(self):
+        class Point:
+            def __init__(self, x, y, z=0):
+                self.x = x
+                self.y = y
+                self.z = z
+
+        class FaceDetector:
+            # Finds one face in the middle of every image, and records the images it is passed
+            def __init__(self):
+                self.images = []
+
+            def process(self, image):
+                self.images.append(image.copy())
+                location_data = type('LocationData', (), {'relative_bounding_box': TestFaceCropper.FaceBox(0.3, 0.4, 0.3, 0.4),
+                                                          'relative_keypoints': [Point(0.4, 0.45), Point(0.6, 0.45)]})
+                return type('Result', (), {'detections': [type('Detection', (), {'location_data': location_data, 'score': [0.9]})]})
+
+        class LandmarkDetector:
+            # Finds the 'face' at the same normalised landmarks in every image, and records the images it is passed
+            def __init__(self, landmarks):
+                self.landmarks = landmarks
+                self.images = []
+
+            def process(self, image):
+                self.images.append(image.copy())
+                landmarks = type('Landmarks', (), {'landmark': [Point(*point) for point in self.landmarks]})
+                return type('Result', (), {'multi_face_landmarks': [landmarks]})
+
+        landmarks = np.random.default_rng(0).uniform(0.3, 0.7, (468, 3)).astype(np.float32)
+        image = np.random.default_rng(1).integers(0, 256, (120, 100, 3), dtype=np.uint8)
+        image_bgr = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+
+        face_croppers = []
+        for colour_order, output_colour_order in [(face_cropper.FaceCropper.RGB, None), (face_cropper.FaceCropper.BGR, face_cropper.FaceCropper.GRAY),
+                                                  (face_cropper.FaceCropper.BGR, None)]:
+            face_cropper_object = face_cropper.FaceCropper(colour_order=colour_order, output_colour_order=output_colour_order)
+            face_cropper_object._face_detector = FaceDetector()
+            face_cropper_object._landmark_detector = LandmarkDetector(landmarks)
+            face_croppers.append(face_cropper_object)
+
+        face_images = face_croppers[0].get_faces(image, remove_background=True)
+        for face_cropper_object in face_croppers[1:]:
+            self.assertEqual(len(face_cropper_object.get_faces(image_bgr)), 1)
+            # The networks are always passed RGB images
+            self.assertEqual(np.array_equal(face_cropper_object._face_detector.images[0], face_croppers[0]._face_detector.images[0]), True)
+            self.assertEqual(np.array_equal(face_cropper_object._landmark_detector.images[0], face_croppers[0]._landmark_detector.images[0]), True)
+
+        self.assertEqual(np.array_equal(face_croppers[1].get_faces(image_bgr, remove_background=True)[0],
+                                        cv2.cvtColor(face_images[0], cv2.COLOR_RGB2GRAY)), True)
+        self.assertEqual(np.array_equal(face_croppers[2].get_faces(image_bgr, remove_background=True)[0],
+                                        cv2.cvtColor(face_images[0], cv2.COLOR_RGB2BGR)), True)
+
+        # Encoded images are decoded straight into the colour order, optionally at reduced resolution
+        png_data = cv2.imencode('.png', image_bgr)[1].tobytes()
+        self.assertEqual(np.array_equal(face_cropper._decode_image(png_data, face_cropper.FaceCropper.RGB), image), True)
+        self.assertEqual(np.array_equal(face_cropper._decode_image(png_data, face_cropper.FaceCropper.BGR), image_bgr), True)
+        self.assertEqual(face_cropper._decode_image(png_data, face_cropper.FaceCropper.GRAY, 2).shape, (60, 50))
+        self.assertEqual(np.array_equal(face_croppers[2].get_faces_from_bytes(png_data)[0], face_croppers[2].get_faces(image_bgr)[0]), True)
+        with self.assertRaises(ValueError): face_cropper._decode_image(png_data, face_cropper.FaceCropper.RGB, 3)
+        with self.assertRaises(ValueError): face_cropper._decode_image(b'not an image', face_cropper.FaceCropper.RGB)
+
+
+    def test_FaceCropper_iter_video(self):
+        video_path = os.path.join(TestFaceCropper.DEMO_DIRECTORY, 'demo_1.mp4')
+        video = cv2.VideoCapture(video_path)
+        frames = [cv2.cvtColor(video.read()[1], cv2.COLOR_BGR2RGB) for _ in range(12)]
+        video.release()
+
+        # The expected faces are cropped by another FaceCropper object, as the detection thread of iter_video() uses the graphs of its own
+        face_cropper_object = face_cropper.FaceCropper()
+        expected_faces = [face_cropper_object.get_faces(frame) for frame in frames]
+        face_cropper_object.close()
+
+        face_cropper_object = face_cropper.FaceCropper()
+        thread_count = threading.active_count()
+
+        for frame_step in (1, 3):
+            video_iterator = face_cropper_object.iter_video(video_path, frame_step=frame_step)
+            for frame_index, _, image, faces in video_iterator:
+                if frame_index >= len(frames): break
+                self.assertEqual(frame_index % frame_step, 0)
+                self.assertEqual(np.array_equal(image, frames[frame_index]), True)
+                self.assertEqual(len(faces), len(expected_faces[frame_index]))
+                self.assertEqual(all(np.array_equal(face, expected_face) for face, expected_face in zip(faces, expected_faces[frame_index])), True)
+
+            # Stopping the iteration early stops the background threads
+            video_iterator.close()
+            self.assertEqual(threading.active_count(), thread_count)
+
+        # A slow consumer of latest_frame_only skips the frames that were decoded while it was busy
+        frame_indices = []
+        for frame_index, _, _, _ in face_cropper_object.iter_video(video_path, latest_frame_only=True):
+            frame_indices.append(frame_index)
+            if len(frame_indices) == 4: break
+            time.sleep(0.2)
+        self.assertEqual(frame_indices, sorted(frame_indices))
+        self.assertEqual(frame_indices[-1] > 3, True)
+
+        face_cropper_object.close()
+
+
+    def test_FaceCropper_get_face_records(self):
+        image = TestFaceCropper.read_demo_image()
+        face_cropper_object = face_cropper.FaceCropper()
+        face_records = face_cropper_object.get_face_records(image)
+        self.assertEqual(len(face_records), 1)
+
+        for remove_background in (False, True):
+            for correct_roll in (False, True):
+                expected_face, = face_cropper_object.get_faces(image, remove_background, correct_roll)
+                face_image = face_records[0].get_face_image(remove_background, correct_roll)
+                self.assertEqual(np.array_equal(face_image, expected_face), True)
+                self.assertEqual(face_records[0].get_face_image(remove_background, correct_roll) is face_image, True)
+
+        self.assertEqual(face_records[0].cropped_image is face_records[0].get_face_image(False, False), True)
+        self.assertEqual(face_records[0].roll_corrected_image is face_records[0].get_face_image(False, True), True)
+
+        top, bottom, left, right = face_records[0].crop_bounds
+        self.assertEqual(0 <= top <= bottom < image.shape[0] and 0 <= left <= right < image.shape[1], True)
+        self.assertEqual(face_records[0].cropped_image.shape[:2], (bottom - top + 1, right - left + 1))
+
+        landmark_coordinates = face_records[0].landmark_coordinates
+        self.assertEqual(landmark_coordinates.shape, (468, 2))
+        self.assertEqual(bool(np.all((landmark_coordinates >= 0) & (landmark_coordinates < (image.shape[1], image.shape[0])))), True)
+        face_cropper_object.close()
+
+
+    def test_AsyncFaceCropper(self):
+        class FaceCropper:
+            # Blocks get_faces() until released, and records whether it was closed
+            def __init__(self):
+                self.released = threading.Event()
+                self.closed = False
+
+            def get_faces(self, image, remove_background, correct_roll):
+                self.released.wait(5)
+                return [image]
+
+            def close(self):
+                self.closed = True
+
+        async_face_cropper = face_cropper.AsyncFaceCropper(instances=1, max_pending=2)
+        async_face_cropper._face_croppers = [FaceCropper()]
+        image = np.zeros((10, 10, 3), dtype=np.uint8)
+
+        async def test_waiting():
+            processing = asyncio.ensure_future(async_face_cropper.get_faces(image))
+            waiting = asyncio.ensure_future(async_face_cropper.get_faces(image))
+            await asyncio.sleep(0.05)
+
+            # Calls beyond max_pending are rejected, and a cancelled or timed out call frees its place while waiting
+            with self.assertRaises(asyncio.QueueFull): await async_face_cropper.get_faces(image)
+            waiting.cancel()
+            with self.assertRaises(asyncio.CancelledError): await waiting
+            self.assertEqual(async_face_cropper.pending, 1)
+            with self.assertRaises(asyncio.TimeoutError): await async_face_cropper.get_faces(image, timeout=0.05)
+            self.assertEqual(async_face_cropper.pending, 1)
+
+            # The instance is only idle again once its image is done, even if its call timed out
+            processing.cancel()
+            with self.assertRaises(asyncio.CancelledError): await processing
+            self.assertEqual(async_face_cropper._get_idle_instances().qsize(), 0)
+            async_face_cropper._face_croppers[0].released.set()
+            self.assertEqual(len(await async_face_cropper.get_faces(image, timeout=1)), 1)
+            self.assertEqual(async_face_cropper._get_idle_instances().qsize(), 1)
+
+        asyncio.run(test_waiting())
+
+        # The instances can be used again from another event loop
+        self.assertEqual(len(asyncio.run(async_face_cropper.get_faces(image, timeout=1))), 1)
+        asyncio.run(async_face_cropper.close())
+        self.assertEqual(async_face_cropper._face_croppers[0].closed, True)
+        with self.assertRaises(RuntimeError): asyncio.run(async_face_cropper.get_faces(image))
+
+        async def get_faces_and_close():
+            async with face_cropper.AsyncFaceCropper(instances=1) as async_face_cropper:
+                return async_face_cropper, await async_face_cropper.get_faces(TestFaceCropper.read_demo_image())
+
+        async_face_cropper, faces = asyncio.run(get_faces_and_close())
+        self.assertEqual(len(faces), 1)
+        self.assertEqual(async_face_cropper._face_croppers[0]._face_detector._graph, None)
+        self.assertEqual(async_face_cropper._face_croppers[0]._landmark_detector._graph, None)
+
+
+    def test_FaceCropper_quality_thresholds(self):
+        image = TestFaceCropper.read_demo_image()
+        video_path = os.path.join(TestFaceCropper.DEMO_DIRECTORY, 'demo_1.mp4')
+        video = cv2.VideoCapture(video_path)
+        frames = [cv2.cvtColor(video.read()[1], cv2.COLOR_BGR2RGB) for _ in range(5)]
+        video.release()
+
+        # The demo face is found with the default thresholds, but no face is frontal enough for max_yaw_asymmetry=0
+        for quality_kwargs, expected_face_count in [({}, 1), ({'max_yaw_asymmetry': 0.0}, 0)]:
+            stats = face_cropper.FaceCropperStats()
+            face_cropper_object = face_cropper.FaceCropper(stats=stats, **quality_kwargs)
+            self.assertEqual(len(face_cropper_object.get_faces(image)), expected_face_count)
+            self.assertEqual(len(face_cropper_object.get_face_records(image)), expected_face_count)
+            self.assertEqual(len(face_cropper_object.get_faces_from_bytes(cv2.imencode('.png', cv2.cvtColor(image, cv2.COLOR_RGB2BGR))[1])), expected_face_count)
+
+            face_tracker = face_cropper.FaceTracker(face_cropper_object, detection_interval=10)
+            self.assertEqual([len(face_tracker.get_faces(frame)) for frame in frames], [expected_face_count] * len(frames))
+            # Rejected faces are still tracked, so faces are only detected once
+            self.assertEqual(len(face_tracker.tracks), 1)
+
+            face_counts = [len(faces) for frame_index, _, _, faces in face_cropper_object.iter_video(video_path) if frame_index < len(frames)]
+            self.assertEqual(face_counts[:len(frames)], [expected_face_count] * len(frames))
+            self.assertEqual(stats.counters['faces_low_quality'] > 0, not expected_face_count)
+            face_cropper_object.close()
+
+            with tempfile.TemporaryDirectory() as directory:
+                face_cropper_object = face_cropper.FaceCropper(debug_capture=face_cropper.DebugCapture(directory, sample_rate=1), **quality_kwargs)
+                self.assertEqual(len(face_cropper_object.get_faces(image)), expected_face_count)
+                face_cropper_object.debug_capture.close()
+                face_cropper_object.close()
+
+            with face_cropper.FaceCropperPool(workers=1, **quality_kwargs) as face_cropper_pool:
+                self.assertEqual([len(faces) for faces in face_cropper_pool.get_faces([image])], [expected_face_count])
+                self.assertEqual([len(faces) for faces in face_cropper_pool.get_faces_and_geometry([image])], [expected_face_count])
+
+            async def get_faces():
+                async with face_cropper.AsyncFaceCropper(instances=1, **quality_kwargs) as async_face_cropper:
+                    return await async_face_cropper.get_faces(image)
+
+            self.assertEqual(len(asyncio.run(get_faces())), expected_face_count)
+
+
+    def test_FaceCropperPool(self):
+        image = TestFaceCropper.read_demo_image()
+        face_cropper_object = face_cropper.FaceCropper()
+        expected_faces = [face_cropper_object.get_faces(image, remove_background) for remove_background in (False, True)]
+        face_cropper_object.close()
+
+        read_image_count = 0
+
+        def iter_images(count):
+            nonlocal read_image_count
+            for _ in range(count):
+                read_image_count += 1
+                yield np.zeros((60, 80, 3), dtype=np.uint8)
+
+        with face_cropper.FaceCropperPool(workers=1, chunk_size=2) as face_cropper_pool:
+            for remove_background in (False, True):
+                faces = face_cropper_pool.get_faces([image, np.zeros((60, 80, 3), dtype=np.uint8), image], remove_background)
+                self.assertEqual([len(image_faces) for image_faces in faces], [len(expected_faces[remove_background]), 0, len(expected_faces[remove_background])])
+                self.assertEqual(all(np.array_equal(face, expected_face) for face, expected_face in zip(faces[2], expected_faces[remove_background])), True)
+
+            (face_image, geometry), = face_cropper_pool.get_faces_and_geometry([image])[0]
+            self.assertEqual(np.array_equal(face_image, expected_faces[False][0]), True)
+            self.assertEqual(geometry['landmarks'].shape, (468, 2))
+
+            # Images are only read from a generator up to max_pending_chunks chunks ahead of the results
+            face_iterator = face_cropper_pool.iter_faces(iter_images(1000))
+            self.assertEqual(next(face_iterator), [])
+            self.assertEqual(read_image_count <= face_cropper_pool.max_pending_chunks * face_cropper_pool.chunk_size, True)
+            self.assertEqual(sum(1 for _ in face_iterator), 999)
+
+            # With return_exceptions, an image that raises doesn't fail the other images of its chunk
+            invalid_image = np.zeros((60, 80), dtype=np.uint8)
+            self.assertRaises(Exception, face_cropper_pool.get_faces, [image, invalid_image])
+            faces = face_cropper_pool.get_faces([image, invalid_image, image], return_exceptions=True)
+            self.assertEqual(isinstance(faces[1], Exception), True)
+            self.assertEqual([len(faces[0]), len(faces[2])], [len(expected_faces[False])] * 2)
+            self.assertEqual(isinstance(face_cropper_pool.get_faces_and_geometry([invalid_image], return_exceptions=True)[0], Exception), True)
+
+
+    def test__write_shared_arrays(self):
+        arrays = [np.arange(30, dtype=np.uint8).reshape((2, 5, 3)), np.ones((468, 3), dtype=np.float32), np.zeros((0, 3), dtype=np.uint8)]
+        buffer = bytearray(8192)
+
+        self.assertEqual(face_cropper._write_shared_arrays(buffer, 64, arrays)[1], 64 + 468 * 3 * 4 + 16)
+        self.assertEqual(any(buffer), False)
+
+        layouts, size = face_cropper._write_shared_arrays(buffer, len(buffer), arrays)
+        self.assertEqual([layout['offset'] % face_cropper._SHARED_ARRAY_ALIGNMENT for layout in layouts], [0, 0, 0])
+        read_arrays = face_cropper._read_shared_arrays(buffer, json.loads(json.dumps(layouts)))
+        self.assertEqual(all(np.array_equal(array, read_array) and array.dtype == read_array.dtype for array, read_array in zip(arrays, read_arrays)), True)
+
+
+    def test_FaceCropperServer(self):
+        with tempfile.TemporaryDirectory() as directory:
+            socket_path = os.path.join(directory, 'face_cropper.sock')
+            with face_cropper.FaceCropperServer(socket_path, workers=1).start():
+                self.assertRaises(OSError, face_cropper.FaceCropperServer, socket_path, workers=1)
+
+                with face_cropper.FaceCropperClient(socket_path) as client:
+                    frame_buffer = client.get_frame_buffer((120, 160, 3))
+                    frame_buffer.fill(0)
+                    self.assertEqual(client.get_faces(frame_buffer), [])
+                    self.assertEqual(client.get_face_geometry(np.zeros((90, 60, 3), dtype=np.uint8)), [])
+                    self.assertRaises(ValueError, client.get_faces, np.zeros((90, 60), dtype=np.uint8))
+
+            self.assertEqual(os.path.exists(socket_path), False)
+
+            # The frames of a FaceCropper.GRAY server are (height, width) images
+            image = cv2.cvtColor(TestFaceCropper.read_demo_image(), cv2.COLOR_RGB2GRAY)
+            face_cropper_object = face_cropper.FaceCropper(colour_order=face_cropper.FaceCropper.GRAY)
+            expected_faces = face_cropper_object.get_faces(image)
+            face_cropper_object.close()
+
+            with face_cropper.FaceCropperServer(socket_path, workers=1, colour_order=face_cropper.FaceCropper.GRAY).start():
+                with face_cropper.FaceCropperClient(socket_path) as client:
+                    faces = client.get_faces(image)
+                    self.assertEqual(len(faces), len(expected_faces))
+                    self.assertEqual(all(np.array_equal(face, expected_face) for face, expected_face in zip(faces, expected_faces)), True)
+                    self.assertEqual(len(client.get_face_geometry(image)), len(expected_faces))
+                    self.assertRaises(ValueError, client.get_faces, np.zeros((90, 60, 3), dtype=np.uint8))
+
+
+    def test_FaceDataset(self):
+        def get_face(height, width, value):
+            return np.full((height, width, 3), value, dtype=np.uint8), {
+                'face_box': [0.1, 0.2, 0.3, 0.4], 'roll_angle': 12.5, 'landmarks': np.tile([[width / 4, height / 2, 0]], (468, 1))}
+
+        with tempfile.TemporaryDirectory() as directory:
+            with face_cropper.FaceDataset(directory) as face_dataset:
+                self.assertEqual(len(face_dataset), 0)
+                self.assertEqual(face_dataset.append('a.jpg', [get_face(4, 6, 1), get_face(8, 2, 2)]), range(0, 2))
+                self.assertRaises(ValueError, face_dataset.append, 'b.jpg', [(np.zeros((4, 4), dtype=np.uint8), get_face(4, 4, 0)[1])])
+                self.assertRaises(ValueError, lambda: face_dataset.faces)
+
+            # Partial writes of an interrupted append are discarded by the next append
+            with open(os.path.join(directory, 'faces.bin'), 'ab') as faces_file: faces_file.write(b'\xff' * 50)
+            with open(os.path.join(directory, 'index.bin'), 'ab') as index_file: index_file.write(b'\xff' * 10)
+
+            with face_cropper.FaceDataset(directory) as face_dataset:
+                self.assertEqual(len(face_dataset), 2)
+                self.assertEqual(face_dataset.append(7, [get_face(3, 3, 3)]), range(2, 3))
+                self.assertEqual(os.path.getsize(os.path.join(directory, 'faces.bin')), (4 * 6 + 8 * 2 + 3 * 3) * 3)
+
+                self.assertEqual([face_dataset.get_face(i).shape for i in range(3)], [(4, 6, 3), (8, 2, 3), (3, 3, 3)])
+                self.assertEqual([int(face_dataset.get_face(i)[0, 0, 0]) for i in range(3)], [1, 2, 3])
+                self.assertEqual(face_dataset.index['image_id'][2], 7)
+                self.assertEqual(face_dataset.index['image_id'][0], face_dataset.index['image_id'][1])
+                self.assertEqual(face_dataset.sources, {int(face_dataset.index['image_id'][0]): 'a.jpg'})
+                self.assertEqual(face_dataset.index['landmarks'].dtype, np.float16)
+                self.assertEqual(np.array_equal(face_dataset.index['landmarks'][1, 0], [0.25, 0.5]), True)
+                self.assertEqual(float(face_dataset.index['roll_angle'][0]), 12.5)
+
+                # The index is only mapped again when a face beyond the mapped ones is read
+                index = face_dataset.index
+                face_dataset.get_face(2)
+                self.assertEqual(face_dataset.index is index, True)
+                face_dataset.append(8, [get_face(2, 2, 4)])
+                self.assertEqual(int(face_dataset.get_face(3)[0, 0, 0]), 4)
+                self.assertEqual(len(face_dataset.index), 4)
+                self.assertRaises(IndexError, face_dataset.get_face, 4)
+
+            self.assertRaises(ValueError, face_cropper.FaceDataset, directory, (4, 4, 3))
+
+        with tempfile.TemporaryDirectory() as directory:
+            with face_cropper.FaceDataset(directory, (4, 4, 3)) as face_dataset:
+                with concurrent.futures.ThreadPoolExecutor(4) as executor:
+                    list(executor.map(lambda i: face_dataset.append(i, [get_face(4, 4, i)] * 2), range(20)))
+
+                self.assertEqual(face_dataset.faces.shape, (40, 4, 4, 3))
+                self.assertEqual(np.array_equal(face_dataset.faces[:, 0, 0, 0], face_dataset.index['image_id']), True)